@@ -0,0 +1,5 @@
+"""Offline benchmarks for the transfer path and the database layer.
+
+Nothing here talks to Telegram; see fake_telegram.py for the stand-in
+file server used by transfer_bench.py.
+"""
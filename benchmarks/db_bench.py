@@ -0,0 +1,274 @@
+"""Database load benchmark and query-plan regression check.
+
+Seeds a throwaway SQLite file with synthetic users, replays a weighted mix
+of bot.database calls at a given concurrency, and reports ops/s plus
+p50/p95/p99 latency per operation. Every distinct statement the workload
+executes is captured and run through EXPLAIN QUERY PLAN; the run fails if
+a statement does a full table scan that is not explicitly allowed, or if
+its plan differs from a --baseline file.
+
+    python -m benchmarks.db_bench --users 100000 --ops 20000 --concurrency 8
+    python -m benchmarks.db_bench --users 1000000 --out db.json --baseline db_old.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+import tempfile
+import platform
+import sqlite3
+from collections import defaultdict
+
+# Mirrors download_handler: one reserve per request, a refund when a transfer fails, a job per link,
+# an archive lookup per link and a save per delivery; the premium sweeper runs now and then.
+# Every query that depends on a particular index is in here, so its plan is checked.
+DEFAULT_MIX = (
+    "get_user=48,reserve_quota=32,refund_quota=4,get_remaining_quota=9.93,"
+    "get_archived=2,save_archived=1,enqueue_job=1.5,claim_jobs=1.5,"
+    "expire_premium_users=0.03,next_premium_expiry=0.02,broadcast_scan=0.02"
+)
+# Statements that scan users on purpose (get_all_users, /stats)
+DEFAULT_ALLOWED_SCANS = (r"^SELECT \* FROM users$", r"COUNT\(\*\) FROM users")
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))]
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+def normalize_sql(sql):
+    """Collapse literals and whitespace so one statement shape maps to one key"""
+    return " ".join(_LITERALS.sub("?", sql).split())
+
+class StatementRecorder:
+    """Collects one expanded example of each statement shape the workload runs"""
+
+    def __init__(self):
+        self.examples = {}
+
+    def __call__(self, sql):
+        text = sql.strip()
+        if not text or text.upper().startswith(("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK")):
+            return
+        self.examples.setdefault(normalize_sql(text), text)
+
+def seed_users(path, count, batch=10000):
+    """Insert `count` synthetic users (and sessions for ~30% of them) matching the live schema"""
+    from bot.session_crypto import seal
+    conn = sqlite3.connect(path)
+    now = int(time.time())
+    today = now - now % 86400
+    rng = random.Random(42)
+    rows, sessions = [], []
+
+    def flush():
+        conn.executemany('''
+            INSERT INTO users (telegram_id, role, downloads_today, last_download_date, is_agreed_terms,
+                premium_expiry_date, is_banned, ads_today, last_ad_date, created_at, updated_at)
+            VALUES (?,?,?,?,?,?,?,?,?,?,?)
+        ''', rows)
+        conn.executemany("INSERT INTO sessions VALUES (?,?,?)", sessions)
+        rows.clear()
+        sessions.clear()
+
+    for user_id in range(1, count + 1):
+        telegram_id = 1000000000 + user_id
+        roll = rng.random()
+        role = "premium" if roll < 0.05 else "admin" if roll < 0.0501 else "free"
+        expiry = now + rng.randint(-30, 60) * 86400 if role == "premium" else None
+        rows.append((
+            telegram_id, role, rng.randint(0, 5), today if rng.random() < 0.5 else None,
+            1, expiry, 1 if rng.random() < 0.01 else 0, 0, None, now, now
+        ))
+        if rng.random() < 0.3:
+            # Packed size of a Pyrogram session string: DC, API id, auth key, user id, flags
+            session = base64.urlsafe_b64encode(rng.randbytes(271)).decode()
+            sessions.append((telegram_id, seal(session), now))
+        if len(rows) >= batch:
+            flush()
+    flush()
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+
+def explain(path, statements):
+    conn = sqlite3.connect(path)
+    plans = {}
+    for key, sql in sorted(statements.items()):
+        try:
+            rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+            plans[key] = [row[-1] for row in rows]
+        except sqlite3.Error as e:
+            plans[key] = [f"ERROR: {e}"]
+    conn.close()
+    return plans
+
+_FULL_SCAN = re.compile(r"^SCAN (\w+)(?!.*USING (?:COVERING )?INDEX)")
+
+def full_scans(plans, allowed):
+    """Statements whose plan scans a whole table without an index"""
+    offenders = []
+    for key, steps in plans.items():
+        if any(re.search(pattern, key) for pattern in allowed):
+            continue
+        for step in steps:
+            if _FULL_SCAN.match(step):
+                offenders.append((key, step))
+    return offenders
+
+def plan_changes(plans, baseline_path):
+    with open(baseline_path) as f:
+        before = json.load(f).get("plans", {})
+    return [(key, before[key], steps) for key, steps in plans.items() if key in before and before[key] != steps]
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark bot/database.py and check query plans")
+    parser.add_argument("--users", type=int, default=100000, help="Synthetic users to seed")
+    parser.add_argument("--ops", type=int, default=20000, help="Operations to replay")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent callers")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="Weighted op mix, name=weight,...")
+    parser.add_argument("--allow-scan", action="append", default=list(DEFAULT_ALLOWED_SCANS),
+                        help="Regex of normalized statements allowed to full-scan (repeatable)")
+    parser.add_argument("--db", help="Reuse an existing seeded database file instead of a temp one")
+    parser.add_argument("--out", default="db_bench.json", help="Where to write results")
+    parser.add_argument("--baseline", help="Previous results JSON; fail if any plan changed")
+    return parser
+
+async def run_workload(database, ops, mix, concurrency, user_count):
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    latencies = defaultdict(list)
+    rng = random.Random(7)
+    # Every op runs at least once, so rare ones still get their plans checked
+    plan = [name for name in names if mix[name] > 0]
+    plan += rng.choices(names, weights=weights, k=max(0, ops - len(plan)))
+    queue = asyncio.Queue()
+    for name in plan:
+        queue.put_nowait(name)
+
+    async def broadcast_scan():
+        # Same access pattern as /broadcast
+        return len(await database.get_active_user_ids())
+
+    async def claim_jobs():
+        # One JobQueue round: lease a batch, then finish it
+        for job in await database.claim_jobs("db-bench", 8, 30):
+            await database.finish_job(job["id"], "done")
+
+    def archive_key(uid):
+        # A small message range per user, so lookups hit saved entries as well as miss
+        return -1000000000000 - uid % 1000, uid % 50
+
+    calls = {
+        "get_user": lambda uid: database.get_user(uid),
+        "get_session_string": lambda uid: database.get_session_string(uid),
+        "get_remaining_quota": lambda uid: database.get_remaining_quota(uid),
+        "reserve_quota": lambda uid: database.reserve_quota(uid, 1),
+        "refund_quota": lambda uid: database.refund_quota(uid, 1),
+        "reserve_ad_slot": lambda uid: database.reserve_ad_slot(uid, 5),
+        "enqueue_job": lambda uid: database.enqueue_job(uid, f"https://t.me/c/1/{uid}", uid, 1),
+        "claim_jobs": lambda uid: claim_jobs(),
+        "get_archived": lambda uid: database.get_archived(*archive_key(uid)),
+        "save_archived": lambda uid: database.save_archived([(*archive_key(uid), f"u{uid}", -1001, [uid % 1000])]),
+        "expire_premium_users": lambda uid: database.expire_premium_users(),
+        "next_premium_expiry": lambda uid: database.next_premium_expiry(),
+        "broadcast_scan": lambda uid: broadcast_scan(),
+    }
+
+    async def worker():
+        while not queue.empty():
+            name = queue.get_nowait()
+            user_id = 1000000000 + rng.randint(1, user_count)
+            started = time.perf_counter()
+            await calls[name](user_id)
+            latencies[name].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - started, latencies
+
+async def main(argv=None):
+    args = build_parser().parse_args(argv)
+    mix = {name: float(weight) for name, weight in (item.split("=") for item in args.mix.split(","))}
+
+    path = args.db or os.path.join(tempfile.mkdtemp(prefix="db_bench_"), "bench.db")
+    os.environ["DATABASE_PATH"] = path
+    os.environ.setdefault("SESSION_SECRET", "db-bench")
+    from bot import database
+
+    fresh = not os.path.exists(path)
+    database.init_db()
+    if fresh:
+        started = time.perf_counter()
+        seed_users(path, args.users)
+        print(f"Seeded {args.users} users in {time.perf_counter() - started:.1f}s -> {path}")
+
+    recorder = StatementRecorder()
+    open_connection = database._get_connection
+
+    def traced_connection():
+        conn = open_connection()
+        conn.set_trace_callback(recorder)
+        return conn
+
+    database._get_connection = traced_connection
+    try:
+        elapsed, latencies = await run_workload(database, args.ops, mix, args.concurrency, args.users)
+    finally:
+        database._get_connection = open_connection
+
+    report_ops = {}
+    for name, values in sorted(latencies.items()):
+        report_ops[name] = {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50) * 1000, 3),
+            "p95_ms": round(_percentile(values, 95) * 1000, 3),
+            "p99_ms": round(_percentile(values, 99) * 1000, 3),
+            "max_ms": round(max(values) * 1000, 3),
+        }
+        print(f"{name:24s} n={len(values):6d}  p50 {report_ops[name]['p50_ms']:8.3f} ms  "
+              f"p95 {report_ops[name]['p95_ms']:8.3f} ms  p99 {report_ops[name]['p99_ms']:8.3f} ms")
+    ops_per_sec = round(args.ops / elapsed, 1)
+    print(f"\n{args.ops} ops in {elapsed:.2f}s = {ops_per_sec} ops/s at concurrency {args.concurrency}\n")
+
+    plans = explain(path, recorder.examples)
+    for key, steps in plans.items():
+        print(f"{key}\n    " + "\n    ".join(steps))
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "users": args.users,
+            "ops": args.ops,
+            "concurrency": args.concurrency,
+            "mix": mix,
+        },
+        "ops_per_sec": ops_per_sec,
+        "operations": report_ops,
+        "plans": plans,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote results to {args.out}")
+
+    failed = False
+    for key, step in full_scans(plans, args.allow_scan):
+        print(f"FULL SCAN: {key}\n    {step}")
+        failed = True
+    if args.baseline:
+        for key, before, after in plan_changes(plans, args.baseline):
+            print(f"PLAN CHANGED: {key}\n    before: {before}\n    after:  {after}")
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
@@ -0,0 +1,235 @@
+"""Local stand-in for Telegram's file DCs.
+
+FakeFileServer answers upload.getFile, upload.saveFilePart and
+upload.saveBigFilePart with configurable latency, a shared bandwidth cap
+and injected FloodWaits. FakeClient exposes just enough of the pyrogram
+Client surface (media_sessions, get_file, download_media, send_*) for
+bot/transfer.py to run unmodified against it.
+"""
+import io
+import os
+import math
+import time
+import random
+import asyncio
+import contextlib
+from types import SimpleNamespace
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from pyrogram.file_id import FileId, FileType, FileUniqueId, FileUniqueType
+
+# Served bytes are sliced out of one random megabyte so large files cost no RAM
+_PATTERN = os.urandom(1024 * 1024)
+LIBRARY_CHUNK = 1024 * 1024
+UPLOAD_PART = 512 * 1024
+
+def _pattern_bytes(offset, length):
+    out = bytearray()
+    while length > 0:
+        start = offset % len(_PATTERN)
+        piece = _PATTERN[start:start + length]
+        out += piece
+        offset += len(piece)
+        length -= len(piece)
+    return bytes(out)
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+class FakeFileServer:
+    """Serves synthetic files and swallows uploads over a simulated link"""
+
+    def __init__(self, latency=0.05, jitter=0.0, bandwidth=None, flood_every=0, flood_seconds=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth  # bytes/s shared by all requests, None = unlimited
+        self.flood_every = flood_every
+        self.flood_seconds = flood_seconds
+        self.files = {}
+        self.uploaded = {}
+        self.requests = 0
+        self.flood_waits = 0
+        self.latencies = {"getFile": [], "saveFilePart": []}
+        self._pipe_free_at = 0.0
+        self._next_id = 1
+
+    def add_file(self, size, dc_id=2, file_name=None, mime_type="application/octet-stream"):
+        """Register a document of `size` bytes and return a message-like object for it"""
+        media_id = self._next_id
+        self._next_id += 1
+        self.files[media_id] = size
+        file_id = FileId(
+            file_type=FileType.DOCUMENT,
+            dc_id=dc_id,
+            media_id=media_id,
+            access_hash=random.getrandbits(63),
+            file_reference=b"bench"
+        ).encode()
+        unique_id = FileUniqueId(file_unique_type=FileUniqueType.DOCUMENT, media_id=media_id).encode()
+        document = SimpleNamespace(
+            file_id=file_id,
+            file_unique_id=unique_id,
+            file_size=size,
+            file_name=file_name or f"bench_{media_id}.bin",
+            mime_type=mime_type,
+            thumbs=None
+        )
+        return SimpleNamespace(id=media_id, document=document, media="document", caption=None)
+
+    async def _transmit(self, nbytes):
+        """Wait for the link: first in line for the shared pipe, then the RTT"""
+        now = time.perf_counter()
+        ready = now
+        if self.bandwidth:
+            start = max(now, self._pipe_free_at)
+            self._pipe_free_at = start + nbytes / self.bandwidth
+            ready = self._pipe_free_at
+        delay = ready - now + self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _maybe_flood(self):
+        self.requests += 1
+        if self.flood_every and self.requests % self.flood_every == 0:
+            self.flood_waits += 1
+            raise FloodWait(value=self.flood_seconds)
+
+    async def handle(self, query):
+        started = time.perf_counter()
+        self._maybe_flood()
+        if isinstance(query, raw.functions.upload.GetFile):
+            size = self.files[query.location.id]
+            length = max(0, min(query.limit, size - query.offset))
+            await self._transmit(length)
+            self.latencies["getFile"].append(time.perf_counter() - started)
+            return raw.types.upload.File(
+                type=raw.types.storage.FilePartial(),
+                mtime=0,
+                bytes=_pattern_bytes(query.offset, length)
+            )
+        if isinstance(query, (raw.functions.upload.SaveFilePart, raw.functions.upload.SaveBigFilePart)):
+            await self._transmit(len(query.bytes))
+            self.uploaded[query.file_id] = self.uploaded.get(query.file_id, 0) + len(query.bytes)
+            self.latencies["saveFilePart"].append(time.perf_counter() - started)
+            return True
+        raise NotImplementedError(type(query).__name__)
+
+    def latency_summary(self, kind):
+        values = self.latencies[kind]
+        return {
+            "requests": len(values),
+            "p50_ms": round(_percentile(values, 50) * 1000, 2),
+            "p99_ms": round(_percentile(values, 99) * 1000, 2),
+        }
+
+class FakeSession:
+    def __init__(self, server):
+        self.server = server
+
+    async def invoke(self, query, *args, **kwargs):
+        return await self.server.handle(query)
+
+class FakeClient:
+    """The slice of pyrogram.Client that bot/transfer.py relies on"""
+
+    def __init__(self, server):
+        self.server = server
+        self.media_sessions = {}
+
+    async def get_file(self, file_id, file_size=0, limit=0, offset=0, progress=None, progress_args=()):
+        # Pyrogram creates the DC media session here before streaming
+        self.media_sessions.setdefault(file_id.dc_id, FakeSession(self.server))
+        session = self.media_sessions[file_id.dc_id]
+        location = raw.types.InputDocumentFileLocation(
+            id=file_id.media_id, access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference, thumb_size=""
+        )
+        offset_bytes = offset * LIBRARY_CHUNK
+        chunks = 0
+        while True:
+            try:
+                r = await session.invoke(raw.functions.upload.GetFile(location=location, offset=offset_bytes, limit=LIBRARY_CHUNK))
+            except FloodWait:
+                # Pyrogram's get_file logs RPC errors and ends the stream
+                return
+            if r.bytes:
+                yield r.bytes
+            chunks += 1
+            offset_bytes += LIBRARY_CHUNK
+            if len(r.bytes) < LIBRARY_CHUNK or (limit and chunks >= limit):
+                break
+
+    async def download_media(self, message, file_name="downloads/", progress=None, progress_args=()):
+        """Sequential 1 MB download, like pyrogram's own fallback path"""
+        media = message.document
+        path = os.path.join(file_name, media.file_name) if file_name.endswith("/") else file_name
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        done = 0
+        with open(path, "wb") as f:
+            async for chunk in self.get_file(FileId.decode(media.file_id)):
+                f.write(chunk)
+                done += len(chunk)
+                if progress:
+                    await progress(done, media.file_size, *progress_args)
+        return path
+
+    async def _save_file(self, path, progress=None, progress_args=()):
+        """Mirror pyrogram's save_file: 512 KB parts, 3 sessions x 4 workers for big files"""
+        if isinstance(path, io.IOBase):
+            # In-memory upload; seek + read never yield, so the workers can share it
+            file_size = path.seek(0, os.SEEK_END)
+            open_file = lambda: contextlib.nullcontext(path)
+        else:
+            file_size = os.path.getsize(path)
+            open_file = lambda: open(path, "rb")
+        total_parts = math.ceil(file_size / UPLOAD_PART)
+        is_big = file_size > 10 * 1024 * 1024
+        workers = 12 if is_big else 1
+        file_id = random.getrandbits(63)
+        session = FakeSession(self.server)
+        parts = asyncio.Queue()
+        for index in range(total_parts):
+            parts.put_nowait(index)
+        done = 0
+
+        async def worker():
+            nonlocal done
+            with open_file() as f:
+                while not parts.empty():
+                    index = parts.get_nowait()
+                    f.seek(index * UPLOAD_PART)
+                    data = f.read(UPLOAD_PART)
+                    if is_big:
+                        query = raw.functions.upload.SaveBigFilePart(
+                            file_id=file_id, file_part=index, file_total_parts=total_parts, bytes=data)
+                    else:
+                        query = raw.functions.upload.SaveFilePart(file_id=file_id, file_part=index, bytes=data)
+                    while True:
+                        try:
+                            await session.invoke(query)
+                            break
+                        except FloodWait as e:
+                            await asyncio.sleep(e.value)
+                    done += len(data)
+                    if progress:
+                        await progress(min(done, file_size), file_size, *progress_args)
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        return file_id
+
+    async def _send(self, chat_id, path, progress=None, progress_args=(), **kwargs):
+        await self._save_file(path, progress, progress_args)
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), document=SimpleNamespace(file_id="uploaded"))
+
+    async def send_document(self, chat_id, document, progress=None, progress_args=(), **kwargs):
+        return await self._send(chat_id, document, progress, progress_args)
+
+    async def send_video(self, chat_id, video, progress=None, progress_args=(), **kwargs):
+        return await self._send(chat_id, video, progress, progress_args)
+
+    async def send_photo(self, chat_id, photo, progress=None, progress_args=(), **kwargs):
+        return await self._send(chat_id, photo, progress, progress_args)
@@ -0,0 +1,210 @@
+"""End-to-end transfer benchmark against the fake file server.
+
+Drives bot.transfer.download_media_fast and upload_media_fast over a matrix
+of file sizes, chunk sizes and worker counts, then writes MB/s, per-request
+p50/p99 latency and peak RSS to JSON.
+
+    python -m benchmarks.transfer_bench --sizes 1M,16M,128M --bandwidth 40M --out bench.json
+    python -m benchmarks.transfer_bench --out new.json --compare bench.json
+
+"smart" in --chunks/--workers leaves the choice to download_media_fast:
+the get_smart_* heuristics from bot/config.py, or the autotuner's suggestion
+for files of at least AUTOTUNE_MIN_BYTES. Results record what was actually
+used. The autotuner starts fresh for every case, so results don't depend on
+case order; pass --autotune to let it learn across cases instead. With
+--compare, the run exits non-zero if any case got more than --tolerance
+slower than in the baseline file.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import argparse
+import platform
+import tempfile
+import psutil
+
+from benchmarks.fake_telegram import FakeFileServer, FakeClient
+from bot.autotune import autotuner
+from bot.transfer import download_media_fast, upload_media_fast
+
+MB = 1024 * 1024
+_UNITS = {"K": 1024, "M": MB, "G": 1024 * MB}
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in _UNITS:
+        return int(float(text[:-1]) * _UNITS[text[-1]])
+    return int(text)
+
+def parse_list(text, parse):
+    return [None if item.strip() == "smart" else parse(item) for item in text.split(",") if item.strip()]
+
+class RssSampler:
+    """Tracks peak RSS while a case runs"""
+
+    def __init__(self, interval=0.02):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.peak = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            await asyncio.sleep(self.interval)
+
+    def __enter__(self):
+        self.peak = self.process.memory_info().rss
+        self._task = asyncio.get_event_loop().create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+async def run_case(size, chunk_size, workers, args, workdir):
+    server = FakeFileServer(
+        latency=args.latency,
+        jitter=args.jitter,
+        bandwidth=args.bandwidth,
+        flood_every=args.flood_every,
+        flood_seconds=args.flood_seconds
+    )
+    client = FakeClient(server)
+    message = server.add_file(size, dc_id=args.dc)
+    case_dir = tempfile.mkdtemp(dir=workdir)
+    if not args.autotune:
+        autotuner.reset()
+    # What download_media_fast fills in for the values left to it
+    suggested_chunk, suggested_workers = autotuner.suggest(args.dc, size)
+
+    try:
+        with RssSampler() as rss:
+            started = time.perf_counter()
+            path = await download_media_fast(
+                client, message, case_dir + "/", chunk_size=chunk_size, workers=workers,
+                in_memory=False
+            )
+            download_seconds = time.perf_counter() - started
+
+            if os.path.getsize(path) != size:
+                raise RuntimeError(f"Downloaded {os.path.getsize(path)} of {size} bytes")
+
+            started = time.perf_counter()
+            await upload_media_fast(client, 0, path)
+            upload_seconds = time.perf_counter() - started
+    finally:
+        shutil.rmtree(case_dir, ignore_errors=True)
+
+    return {
+        "size": size,
+        "chunk_size": chunk_size or suggested_chunk,
+        "workers": workers or suggested_workers,
+        "smart_chunk": chunk_size is None,
+        "smart_workers": workers is None,
+        "download_mbps": round(size / MB / download_seconds, 2),
+        "upload_mbps": round(size / MB / upload_seconds, 2),
+        "download_seconds": round(download_seconds, 3),
+        "upload_seconds": round(upload_seconds, 3),
+        "get_file": server.latency_summary("getFile"),
+        "save_file_part": server.latency_summary("saveFilePart"),
+        "flood_waits": server.flood_waits,
+        "peak_rss_mb": round(rss.peak / MB, 1),
+    }
+
+def case_key(result):
+    # Smart cases compare with smart cases, whatever values they ended up with
+    return (
+        result["size"],
+        "smart" if result.get("smart_chunk") else result["chunk_size"],
+        "smart" if result.get("smart_workers") else result["workers"],
+    )
+
+def compare(results, baseline_path, tolerance):
+    """Return the cases whose download or upload throughput regressed"""
+    with open(baseline_path) as f:
+        baseline = {case_key(r): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        before = baseline.get(case_key(result))
+        if not before:
+            continue
+        for metric in ("download_mbps", "upload_mbps"):
+            if before[metric] and result[metric] < before[metric] * (1 - tolerance):
+                regressions.append((result, metric, before[metric]))
+    return regressions
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark bot/transfer.py against a fake Telegram file server")
+    parser.add_argument("--sizes", default="1M,16M,128M", help="Comma separated file sizes (K/M/G suffixes)")
+    parser.add_argument("--chunks", default="smart,128K,512K,1M", help="Chunk sizes, or 'smart'")
+    parser.add_argument("--workers", default="smart,1,4,8,16", help="Worker counts, or 'smart'")
+    parser.add_argument("--latency", type=float, default=0.05, help="Per-request round trip in seconds")
+    parser.add_argument("--jitter", type=float, default=0.01, help="Extra random latency in seconds")
+    parser.add_argument("--bandwidth", default="40M", help="Shared link bandwidth per second, 0 for unlimited")
+    parser.add_argument("--flood-every", type=int, default=0, help="Raise FloodWait on every Nth request")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="FloodWait duration")
+    parser.add_argument("--autotune", action="store_true", help="Let the autotuner learn across cases instead of resetting it")
+    parser.add_argument("--dc", type=int, default=2, help="DC id encoded in the fake file_id")
+    parser.add_argument("--out", default="transfer_bench.json", help="Where to write results")
+    parser.add_argument("--compare", help="Baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed slowdown versus baseline")
+    return parser
+
+async def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.bandwidth = parse_size(args.bandwidth) or None
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    chunks = parse_list(args.chunks, parse_size)
+    workers = parse_list(args.workers, int)
+
+    workdir = tempfile.mkdtemp(prefix="transfer_bench_")
+    results = []
+    try:
+        for size in sizes:
+            for chunk_size in chunks:
+                for worker_count in workers:
+                    result = await run_case(size, chunk_size, worker_count, args, workdir)
+                    results.append(result)
+                    print(
+                        f"{size / MB:8.1f} MB  chunk {result['chunk_size'] // 1024:5d} KB"
+                        f"{'*' if result['smart_chunk'] else ' '} workers {result['workers']:3d}"
+                        f"{'*' if result['smart_workers'] else ' '}  "
+                        f"down {result['download_mbps']:7.2f} MB/s  up {result['upload_mbps']:7.2f} MB/s  "
+                        f"p50 {result['get_file']['p50_ms']:7.1f} ms  p99 {result['get_file']['p99_ms']:7.1f} ms  "
+                        f"rss {result['peak_rss_mb']:6.1f} MB"
+                    )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "bandwidth": args.bandwidth,
+            "flood_every": args.flood_every,
+            "flood_seconds": args.flood_seconds,
+            "autotune": args.autotune,
+        },
+        "results": results,
+    }
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nWrote {len(results)} results to {args.out} (* = chosen by download_media_fast)")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        for result, metric, before in regressions:
+            print(f"REGRESSION {case_key(result)} {metric}: {before} -> {result[metric]} MB/s")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.compare}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
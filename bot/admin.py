@@ -1,36 +1,119 @@
 import asyncio
 from pyrogram import filters
 from bot.config import app, OWNER_ID, active_downloads, MAX_CONCURRENT_DOWNLOADS
-from bot.database import set_user_role, ban_user, update_setting, get_setting, get_all_users, get_user_count
+from bot.database import (
+    set_user_role, ban_user, update_setting, get_setting, get_users_by_role, get_active_user_ids, get_user_count, format_date
+)
+from bot.premium import premium_expiry
 
 @app.on_message(filters.command("stats") & filters.private)
 async def stats(client, message):
     if str(message.from_user.id) != str(OWNER_ID): return
     
+    from bot.autotune import autotuner
+    from bot.budget import budget
+    from bot.disk import disk
+    from bot.memory import memory_governor
+    from bot.workers import transfer_workers
+
     total_users = await get_user_count()
-    
+    tuned = autotuner.snapshot()
+    autotune_lines = "".join(
+        f"\n   DC{dc}: `{s['chunk_size'] // 1024} KB x {s['workers']}` ({s['throughput'] / 1048576:.1f} MB/s)"
+        for dc, s in tuned.items()
+    ) or " `learning`"
+    storage = disk.snapshot()
+    # Worker processes keep their own reservations in subdirectories; their last pong reports them
+    for worker in transfer_workers.workers:
+        for key in ("reserved", "used", "waiting"):
+            storage[key] += worker.disk.get(key, 0)
+    quota = f"{storage['quota'] / 1073741824:.1f} GB" if storage["quota"] else "volume"
+    memory = memory_governor.snapshot()
+    memory_line = (
+        f"🧠 Memory: `{memory['usage_mb']:.0f}/{memory['limit_mb']:.0f} MB` {memory['measure']}, `{memory['level']}`\n"
+        if memory else ""
+    )
+
     await message.reply(
         f"📊 **Bot Statistics**\n\n"
         f"👥 Total Users: `{total_users}`\n"
-        f"⚡ Active Downloads: `{len(active_downloads)}/{MAX_CONCURRENT_DOWNLOADS}`"
+        f"⚡ Active Downloads: `{len(active_downloads)}/{MAX_CONCURRENT_DOWNLOADS}`\n"
+        f"🚦 Transfer Budget: `{budget.slots_used}/{budget.slots}` slots, "
+        f"`{budget.buffer_used / 1048576:.0f}/{budget.buffer_bytes / 1048576:.0f} MB`, "
+        f"`{len(budget._waiters)}` waiting\n"
+        f"💾 Disk: `{storage['used'] / 1048576:.0f} MB` in downloads/, "
+        f"`{storage['reserved'] / 1048576:.0f} MB` reserved of `{quota}`, "
+        f"`{storage['free'] / 1073741824:.1f}/{storage['total'] / 1073741824:.1f} GB` free, "
+        f"`{storage['waiting']}` waiting\n"
+        f"{memory_line}"
+        f"🎛 Autotune:{autotune_lines}"
     )
 
 @app.on_message(filters.command("killall") & filters.private)
 async def kill_all_processes(client, message):
     if str(message.from_user.id) != str(OWNER_ID): return
     
-    from bot.config import cancel_flags
+    from bot.cancellation import cancellations, wait_aborted
+    from bot.jobs import transfer_jobs
     
-    if not active_downloads:
-        await message.reply("⚠️ No active downloads to kill.")
+    queued = await transfer_jobs.cancel_pending(client)
+    tokens = cancellations.cancel_all()
+    if not tokens:
+        await message.reply(f"✅ Dropped `{queued}` queued downloads." if queued else "⚠️ No active downloads to kill.")
+        return
+
+    status = await message.reply(f"🛑 Cancelling `{len(tokens)}` transfers...")
+    durations, stuck = await wait_aborted(tokens)
+    text = f"✅ Killed `{len(durations)}` of `{len(tokens)}` transfers"
+    if durations:
+        text += f" (abort took avg `{sum(durations) / len(durations):.2f}s`, max `{max(durations):.2f}s`)"
+    if queued:
+        text += f"\n🗑 Dropped `{queued}` queued downloads."
+    if stuck:
+        text += f"\n⚠️ `{stuck}` still unwinding after 30s."
+    await status.edit_text(text)
+
+@app.on_message(filters.command("traces") & filters.private)
+async def show_traces(client, message):
+    if str(message.from_user.id) != str(OWNER_ID): return
+
+    from bot.tracing import recent_traces, format_trace
+
+    parts = message.text.split()
+    slowest = len(parts) > 1 and parts[1].lower() == "slow"
+    limit = next((int(p) for p in parts[1:] if p.isdigit()), 5)
+
+    items = recent_traces(min(limit, 20), slowest=slowest)
+    if not items:
+        await message.reply("No finished transfers traced yet.")
+        return
+
+    header = "🐢 **Slowest Transfers**" if slowest else "🧭 **Recent Transfers**"
+    text = header + "\n\n" + "\n\n".join(format_trace(t) for t in items)
+    for x in range(0, len(text), 4096):
+        await message.reply(text[x:x+4096], disable_web_page_preview=True)
+
+@app.on_message(filters.command("trace_profile") & filters.private)
+async def show_trace_profile(client, message):
+    if str(message.from_user.id) != str(OWNER_ID): return
+
+    from bot.tracing import TRACE_PROFILER, get_trace, format_profile
+
+    if not TRACE_PROFILER:
+        await message.reply("⚠️ Profiler is off. Set `TRACE_PROFILER=True` and restart.")
         return
-        
-    count = len(active_downloads)
-    for uid in list(active_downloads):
-        cancel_flags.add(uid)
-    
-    active_downloads.clear()
-    await message.reply(f"✅ Killed all `{count}` active processes and sent cancellation signals.")
+
+    try:
+        trace_id = int(message.text.split()[1].lstrip("#"))
+    except (IndexError, ValueError):
+        await message.reply("Usage: `/trace_profile <trace_id>` (see `/traces slow`)")
+        return
+
+    trace = get_trace(trace_id)
+    if not trace:
+        await message.reply(f"Trace #{trace_id} is no longer in the buffer.")
+        return
+    await message.reply(format_profile(trace)[:4096])
 
 @app.on_message(filters.command("setrole") & filters.private)
 async def setrole(client, message):
@@ -53,6 +136,8 @@ async def setrole(client, message):
             return
             
         await set_user_role(target_id, new_role, duration)
+        # The new expiry may be sooner than the one the sweeper is waiting for
+        premium_expiry.wake()
         
         resp = f"✅ User `{target_id}` role updated to **{new_role}**."
         if duration and new_role == 'premium':
@@ -188,21 +273,17 @@ async def broadcast(client, message):
                 blocked += 1
             await asyncio.sleep(0.05)
     else:
-        # Broadcast to all users
-        users = await get_all_users()
-        total = len(users)
+        # Broadcast to every user who isn't banned
+        user_ids = await get_active_user_ids()
+        total = len(user_ids)
         
-        for index, row in enumerate(users):
+        for index, tid in enumerate(user_ids):
             try:
-                # Get the telegram_id and ensure it's an integer
-                tid = row.get('telegram_id')
-                if tid:
-                    target_key = int(tid) if str(tid).strip("-").isdigit() else tid
-                    await message.reply_to_message.copy(target_key)
-                    count += 1
+                await message.reply_to_message.copy(tid)
+                count += 1
             except Exception as e:
                 blocked += 1
-                print(f"[ERROR] Broadcast failed for {row.get('telegram_id')}: {e}")
+                print(f"[ERROR] Broadcast failed for {tid}: {e}")
             
             # Periodically update the progress message for transparency
             if (index + 1) % 50 == 0:
@@ -226,8 +307,7 @@ async def list_premium_users(client, message):
         return
         
     try:
-        all_users = await get_all_users()
-        premium_users = [u for u in all_users if u.get("role") == "premium"]
+        premium_users = await get_users_by_role("premium")
         
         if not premium_users:
             await message.reply("No premium users found.")
@@ -236,7 +316,7 @@ async def list_premium_users(client, message):
         text = "💎 **Premium Users List**\n\n"
         for user in premium_users:
             u_id = user.get("telegram_id")
-            expiry = user.get("premium_expiry_date", "Never")
+            expiry = format_date(user.get("premium_expiry_date")) or "Never"
             
             name = "Unknown"
             username_str = ""
@@ -1,15 +1,76 @@
 import aiohttp
+import asyncio
 import logging
 import html
+import time
+import hashlib
+from collections import deque, OrderedDict
 from typing import Optional, Dict, Any, List
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from bot.config import RICHADS_PUBLISHER_ID, RICHADS_WIDGET_ID, AD_DAILY_LIMIT, AD_FOR_PREMIUM
-from bot.database import get_user, increment_ad_count, get_ad_count_today
+from bot.config import (
+    RICHADS_PUBLISHER_ID, RICHADS_WIDGET_ID, AD_DAILY_LIMIT, AD_FOR_PREMIUM,
+    AD_PREFETCH_SIZE, AD_PREFETCH_TTL, AD_CREATIVE_CACHE_SIZE, AD_CREATIVE_CACHE_TTL
+)
+from bot.database import reserve_ad_slot, release_ad_slot
+from bot.metrics import REGISTRY, QUEUE_DEPTH, cache_hit
 
 logger = logging.getLogger(__name__)
 
 RICHADS_API_URL = "http://15068.xml.adx1.com/telegram-mb"
 
+class CreativeCache:
+    """LRU of Telegram file_ids for ad creatives, keyed by a hash of the creative URL"""
+
+    _BROKEN = ""
+
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+
+    @staticmethod
+    def _key(url: str) -> str:
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def _lookup(self, url: str) -> Optional[str]:
+        key = self._key(url)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, file_id = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return file_id
+
+    def get(self, url: str) -> Optional[str]:
+        """Return the cached file_id for a creative, if any"""
+        return self._lookup(url) or None
+
+    def is_broken(self, url: str) -> bool:
+        """True if this creative already failed to send"""
+        return self._lookup(url) == self._BROKEN
+
+    def put(self, url: str, file_id: str):
+        key = self._key(url)
+        self._entries[key] = (time.monotonic() + self.ttl, file_id)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def mark_broken(self, url: str):
+        self.put(url, self._BROKEN)
+
+    def discard(self, url: str):
+        self._entries.pop(self._key(url), None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
 class RichAdsManager:
     def __init__(self):
         self.publisher_id = RICHADS_PUBLISHER_ID
@@ -17,17 +78,53 @@ class RichAdsManager:
         self.production = True
         self.for_premium = AD_FOR_PREMIUM
 
+        # One pooled keep-alive session for every ad network call
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Prefetched ads per language: {lang: deque[(expires_at, ad)]}
+        self._buffers: Dict[str, deque] = {}
+        self._refills: Dict[str, asyncio.Task] = {}
+        # Impression pings are fire-and-forget, drained by impression_worker()
+        self._impressions: asyncio.Queue = asyncio.Queue(maxsize=500)
+        # Ad deliveries run off the handler path; one pending delivery per user
+        self._deliveries: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self._pending_users = set()
+        # Telegram file_ids of creatives we already uploaded once
+        self._creatives = CreativeCache(AD_CREATIVE_CACHE_SIZE, AD_CREATIVE_CACHE_TTL)
+
     def is_enabled(self) -> bool:
         """Check if RichAds is configured"""
         return bool(self.publisher_id)
 
+    @staticmethod
+    def _lang(language_code: str) -> str:
+        return language_code[:2].lower() if language_code else "en"
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on first use"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=10)
+            )
+        return self._session
+
+    async def close(self):
+        """Close the shared session and stop pending refills"""
+        for task in self._refills.values():
+            task.cancel()
+        self._refills.clear()
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
     async def fetch_ad(self, language_code: str = "en", telegram_id: str = None) -> Optional[List[Dict[str, Any]]]:
         """Fetch ad from RichAds API"""
         if not self.is_enabled():
             return None
 
         payload = {
-            "language_code": language_code[:2].lower() if language_code else "en",
+            "language_code": self._lang(language_code),
             "publisher_id": self.publisher_id,
             "production": self.production
         }
@@ -38,31 +135,88 @@ class RichAdsManager:
             payload["telegram_id"] = str(telegram_id)
 
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(RICHADS_API_URL, json=payload, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                    if response.status == 200:
-                        ads = await response.json()
-                        if ads and len(ads) > 0:
-                            logger.info(f"RichAds: Ad received for user {telegram_id}")
-                            return ads
-                        logger.info(f"RichAds: No ads available for user {telegram_id}")
-                        return None
-                    else:
-                        logger.warning(f"RichAds: API Error {response.status} for user {telegram_id}")
-                        return None
+            async with self._get_session().post(RICHADS_API_URL, json=payload) as response:
+                if response.status == 200:
+                    ads = await response.json()
+                    if ads and len(ads) > 0:
+                        logger.info(f"RichAds: Ad received for user {telegram_id}")
+                        return ads
+                    logger.info(f"RichAds: No ads available for user {telegram_id}")
+                    return None
+                else:
+                    logger.warning(f"RichAds: API Error {response.status} for user {telegram_id}")
+                    return None
         except Exception as e:
             logger.error(f"RichAds: Fetch error for user {telegram_id}: {e}")
             return None
 
+    def prefetch(self, language_code: str = "en"):
+        """Top up the ad buffer for a language in the background"""
+        if not self.is_enabled():
+            return
+        lang = self._lang(language_code)
+        task = self._refills.get(lang)
+        if task and not task.done():
+            return
+        self._refills[lang] = asyncio.create_task(self._refill(lang))
+
+    async def _refill(self, lang: str):
+        try:
+            buffer = self._buffers.setdefault(lang, deque(maxlen=AD_PREFETCH_SIZE))
+            attempts = 0
+            while len(buffer) < AD_PREFETCH_SIZE and attempts < AD_PREFETCH_SIZE:
+                attempts += 1
+                ads = await self.fetch_ad(language_code=lang)
+                if not ads:
+                    break
+                expires_at = time.monotonic() + AD_PREFETCH_TTL
+                for ad in ads:
+                    buffer.append((expires_at, ad))
+        finally:
+            self._refills.pop(lang, None)
+
+    def take_ad(self, language_code: str = "en") -> Optional[Dict[str, Any]]:
+        """Pop a fresh buffered ad without touching the network"""
+        lang = self._lang(language_code)
+        buffer = self._buffers.get(lang)
+        ad = None
+        now = time.monotonic()
+        while buffer:
+            expires_at, candidate = buffer.popleft()
+            if expires_at > now:
+                ad = candidate
+                break
+        cache_hit("ad_buffer", ad is not None)
+        # Always keep the buffer warm for the next user
+        self.prefetch(lang)
+        return ad
+
+    def queue_impression(self, notification_url: str):
+        """Queue an impression ping without waiting for it"""
+        if not notification_url:
+            return
+        try:
+            self._impressions.put_nowait(notification_url)
+        except asyncio.QueueFull:
+            logger.debug("RichAds: Impression queue full, dropping ping")
+
+    async def impression_worker(self):
+        """Drain queued impression pings over the shared session"""
+        while True:
+            notification_url = await self._impressions.get()
+            try:
+                await self.notify_impression(notification_url)
+            finally:
+                self._impressions.task_done()
+
     async def notify_impression(self, notification_url: str):
         """Notify RichAds that ad impression happened"""
         if not notification_url:
             return
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(html.unescape(notification_url), timeout=5) as response:
-                    if response.status == 200:
-                        logger.debug("RichAds: Impression tracked")
+            async with self._get_session().get(html.unescape(notification_url), timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status == 200:
+                    logger.debug("RichAds: Impression tracked")
         except Exception as e:
             logger.debug(f"RichAds: Impression error: {e}")
 
@@ -71,25 +225,18 @@ class RichAdsManager:
         if not self.is_enabled():
             return
 
-        user = await get_user(user_id)
-        if not user:
-            return
-        
-        # Check premium settings
-        if user.get("role") in ["premium", "admin", "owner"] and not self.for_premium:
-            return
-        
-        # Check daily limit
-        ad_count = await get_ad_count_today(user_id)
-        if ad_count >= AD_DAILY_LIMIT:
-            logger.info(f"RichAds: Daily limit reached for user {user_id}")
+        # Role, ban and daily limit are checked and counted in one statement,
+        # before a buffered ad is spent on a user who can't be shown one
+        if not await reserve_ad_slot(user_id, AD_DAILY_LIMIT, include_premium=self.for_premium):
+            logger.info(f"RichAds: Daily limit reached or ads disabled for user {user_id}")
             return
 
-        ads = await self.fetch_ad(language_code=lang_code, telegram_id=str(user_id))
-        if not ads:
+        ad = self.take_ad(lang_code)
+        if not ad:
+            logger.debug(f"RichAds: No buffered ad for {self._lang(lang_code)}, skipping user {user_id}")
+            await release_ad_slot(user_id)
             return
 
-        ad = ads[0]
         try:
             click_url = html.unescape(ad.get("link", ""))
             image_url = html.unescape(ad.get("image") or ad.get("image_preload") or "")
@@ -109,32 +256,19 @@ class RichAdsManager:
                 [InlineKeyboardButton(f"👉 {button_text}", url=click_url)]
             ])
 
-            # Try to send as video first if available
-            if video_url:
+            # Try to send as video first if available; creatives known to
+            # fail as video go straight to the photo fallback
+            if video_url and not self._creatives.is_broken(video_url):
                 try:
-                    await client.send_video(
-                        chat_id=user_id,
-                        video=video_url,
-                        caption=caption,
-                        reply_markup=reply_markup
-                    )
+                    await self._send_creative(client, user_id, "video", video_url, caption, reply_markup)
                     logger.info(f"RichAds: Video ad displayed to {user_id}")
                 except Exception as ve:
                     logger.warning(f"RichAds: Failed to send video ad: {ve}. Falling back to photo.")
+                    self._creatives.mark_broken(video_url)
                     if image_url:
-                        await client.send_photo(
-                            chat_id=user_id,
-                            photo=image_url,
-                            caption=caption,
-                            reply_markup=reply_markup
-                        )
+                        await self._send_creative(client, user_id, "photo", image_url, caption, reply_markup)
             elif image_url:
-                await client.send_photo(
-                    chat_id=user_id,
-                    photo=image_url,
-                    caption=caption,
-                    reply_markup=reply_markup
-                )
+                await self._send_creative(client, user_id, "photo", image_url, caption, reply_markup)
             else:
                 await client.send_message(
                     chat_id=user_id,
@@ -145,21 +279,70 @@ class RichAdsManager:
             logger.info(f"RichAds: Ad successfully displayed to user {user_id}")
             
             # Track impression
-            notification_url = ad.get("notification_url")
-            if notification_url:
-                await self.notify_impression(notification_url)
-            
-            await increment_ad_count(user_id)
+            self.queue_impression(ad.get("notification_url"))
             
         except Exception as e:
             # Silently handle errors showing ads to prevent log clutter and disruptions
-            pass
+            await release_ad_slot(user_id)
+
+    async def _send_creative(self, client, user_id, kind, url, caption, reply_markup):
+        """Send a photo/video creative, reusing the Telegram file_id after the first upload"""
+        send = client.send_video if kind == "video" else client.send_photo
+        file_id = self._creatives.get(url)
+        cache_hit("ad_creative", file_id is not None)
+        if file_id:
+            try:
+                return await send(user_id, file_id, caption=caption, reply_markup=reply_markup)
+            except Exception as e:
+                # Stale or foreign file_id, forget it and fall back to the URL
+                logger.debug(f"RichAds: Cached creative failed, refetching: {e}")
+                self._creatives.discard(url)
+
+        sent = await send(user_id, url, caption=caption, reply_markup=reply_markup)
+        media = getattr(sent, kind, None) if sent else None
+        if media and media.file_id:
+            self._creatives.put(url, media.file_id)
+        return sent
+
+    def enqueue_ad(self, client, user_id, lang_code="en") -> bool:
+        """Schedule an ad for background delivery, once per user at a time"""
+        if not self.is_enabled() or user_id in self._pending_users:
+            return False
+        try:
+            self._deliveries.put_nowait((client, user_id, lang_code))
+        except asyncio.QueueFull:
+            logger.debug(f"RichAds: Delivery queue full, skipping user {user_id}")
+            return False
+        self._pending_users.add(user_id)
+        return True
+
+    async def delivery_worker(self):
+        """Deliver queued ads; run AD_DELIVERY_WORKERS of these"""
+        while True:
+            client, user_id, lang_code = await self._deliveries.get()
+            try:
+                await self.show_ad(client, user_id, lang_code)
+            except Exception as e:
+                logger.error(f"RichAds: Delivery error for user {user_id}: {e}")
+            finally:
+                self._pending_users.discard(user_id)
+                self._deliveries.task_done()
 
 # Global instance and legacy compatibility
 richads_manager = RichAdsManager()
+
+def _collect_ad_metrics():
+    QUEUE_DEPTH.set(richads_manager._deliveries.qsize(), queue="ad_delivery")
+    QUEUE_DEPTH.set(richads_manager._impressions.qsize(), queue="ad_impression")
+
+REGISTRY.add_collector(_collect_ad_metrics)
+
 async def fetch_ad(user_id, lang_code="en"):
     ads = await richads_manager.fetch_ad(lang_code, str(user_id))
     return ads[0] if ads else None
 
 async def show_ad(client, user_id, lang_code="en"):
     await richads_manager.show_ad(client, user_id, lang_code)
+
+def queue_ad(client, user_id, lang_code="en"):
+    return richads_manager.enqueue_ad(client, user_id, lang_code)
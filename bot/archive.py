@@ -0,0 +1,153 @@
+import time
+import asyncio
+import logging
+import collections
+from typing import Dict, Iterator, List, Optional
+from bot.config import (
+    DUMP_CHANNEL_ID, ARCHIVE_ENABLED, ARCHIVE_BATCH, ARCHIVE_BATCH_WAIT, ARCHIVE_RATE, ARCHIVE_QUEUE_SIZE
+)
+from bot.database import get_setting, get_archived, save_archived, delete_archived
+from bot.metrics import REGISTRY, cache_hit
+from bot.rpc import patience
+
+logger = logging.getLogger(__name__)
+
+ARCHIVED = REGISTRY.counter("bot_archive_messages_total", "Delivered messages handed to the archiver by result", ("result",))
+ARCHIVE_BACKLOG = REGISTRY.gauge("bot_archive_backlog", "Deliveries waiting to be copied to the dump channel")
+
+# Nobody waits on archive copies, so they may sit in the RPC gateway instead of being refused
+ARCHIVE_PATIENCE = 300
+# messages.forwardMessages takes at most this many ids
+FORWARD_LIMIT = 100
+
+# One delivery: the source message it came from and the bot's messages in the user's chat
+ArchiveItem = collections.namedtuple(
+    "ArchiveItem", ["source_chat_id", "source_message_id", "file_unique_id", "chat_id", "message_ids"]
+)
+
+def file_unique_id(msg) -> Optional[str]:
+    """Identifies the file behind a source message, so an edited message isn't served its old file"""
+    media = getattr(msg, msg.media.value, None) if msg.media else None
+    return getattr(media, "file_unique_id", None)
+
+def _batches(items: List[ArchiveItem]) -> Iterator[List[ArchiveItem]]:
+    batch, size = [], 0
+    for item in items:
+        if batch and size + len(item.message_ids) > FORWARD_LIMIT:
+            yield batch
+            batch, size = [], 0
+        batch.append(item)
+        size += len(item.message_ids)
+    if batch:
+        yield batch
+
+class Archiver:
+    """Copies delivered files into the dump channel and serves repeat links from there.
+
+    submit() only queues, so the user-facing path never waits on archiving.
+    run() gathers deliveries for up to batch_wait seconds and copies each
+    user's share with one ForwardMessages call (as a copy, without a
+    forward header). Calls are spaced to `rate` a minute, and the dump
+    message ids are recorded against the source message. lookup() returns
+    an entry only while the source message still holds the same file.
+    """
+
+    def __init__(self, enabled: bool, batch: int, batch_wait: float, rate: float, queue_size: int):
+        self.enabled = enabled
+        self.batch = batch
+        self.batch_wait = batch_wait
+        self.rate = rate
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+
+    def submit(self, source_chat_id, source_message_id, unique_id, chat_id, message_ids: List[int]):
+        if not self.enabled or not message_ids:
+            return
+        try:
+            self._queue.put_nowait(ArchiveItem(source_chat_id, source_message_id, unique_id, chat_id, message_ids))
+        except asyncio.QueueFull:
+            ARCHIVED.inc(len(message_ids), result="skipped")
+
+    async def lookup(self, source_chat_id, source_message_id, unique_id) -> Optional[Dict]:
+        if not self.enabled:
+            return None
+        entry = await get_archived(source_chat_id, source_message_id)
+        hit = entry is not None and entry["file_unique_id"] == unique_id
+        cache_hit("archive", hit)
+        return entry if hit else None
+
+    async def forget(self, source_chat_id, source_message_id):
+        """Drop an entry whose dump copy can't be used any more"""
+        await delete_archived(source_chat_id, source_message_id)
+
+    async def _channel(self):
+        setting = await get_setting("dump_channel_id")
+        value = str((setting or {}).get("value") or DUMP_CHANNEL_ID or "").strip()
+        if not value:
+            return None
+        return int(value) if value.lstrip("-").isdigit() else value
+
+    async def _gather(self) -> List[ArchiveItem]:
+        items = [await self._queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while sum(len(item.message_ids) for item in items) < self.batch:
+            try:
+                items.append(await asyncio.wait_for(self._queue.get(), max(0.0, deadline - time.monotonic())))
+            except asyncio.TimeoutError:
+                break
+        return items
+
+    async def run(self, client):
+        """Archive queued deliveries until cancelled; needs a started bot client"""
+        if not self.enabled:
+            return
+        while True:
+            items = await self._gather()
+            try:
+                await self._archive(client, items)
+            except Exception as e:
+                logger.error(f"Archive batch failed: {e}")
+                ARCHIVED.inc(sum(len(item.message_ids) for item in items), result="failed")
+
+    async def _archive(self, client, items: List[ArchiveItem]):
+        channel = await self._channel()
+        if channel is None:
+            ARCHIVED.inc(sum(len(item.message_ids) for item in items), result="no_channel")
+            return
+        by_chat: Dict[int, List[ArchiveItem]] = {}
+        for item in items:
+            by_chat.setdefault(item.chat_id, []).append(item)
+        entries = []
+        for chat_id, chat_items in by_chat.items():
+            for batch in _batches(chat_items):
+                ids = [message_id for item in batch for message_id in item.message_ids]
+                try:
+                    with patience(ARCHIVE_PATIENCE):
+                        copies = await client.forward_messages(channel, chat_id, ids, send_copy=True)
+                except Exception as e:
+                    # Usually the user deleted the messages or blocked the bot
+                    logger.debug(f"Archiving {len(ids)} messages from {chat_id} failed: {e}")
+                    ARCHIVED.inc(len(ids), result="failed")
+                    copies = None
+                if copies is not None:
+                    copies = copies if isinstance(copies, list) else [copies]
+                    if len(copies) == len(ids):
+                        ARCHIVED.inc(len(ids), result="archived")
+                        offset = 0
+                        for item in batch:
+                            dump_ids = [m.id for m in copies[offset:offset + len(item.message_ids)]]
+                            offset += len(item.message_ids)
+                            entries.append((item.source_chat_id, item.source_message_id, item.file_unique_id,
+                                            copies[0].chat.id, dump_ids))
+                    else:
+                        # Telegram skips messages that are gone, so the copies can't be matched up
+                        ARCHIVED.inc(len(ids), result="failed")
+                await asyncio.sleep(60 / self.rate)
+        if entries:
+            await save_archived(entries)
+
+archiver = Archiver(ARCHIVE_ENABLED, ARCHIVE_BATCH, ARCHIVE_BATCH_WAIT, ARCHIVE_RATE, ARCHIVE_QUEUE_SIZE)
+
+def _collect_archive_metrics():
+    ARCHIVE_BACKLOG.set(archiver._queue.qsize())
+
+REGISTRY.add_collector(_collect_archive_metrics)
@@ -0,0 +1,272 @@
+import math
+import time
+import asyncio
+import itertools
+import logging
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+from pyrogram import raw
+from pyrogram.client import Client
+from bot.config import app, API_ID, API_HASH, LOGIN_POOL_SIZE, LOGIN_MAX_CONCURRENT, LOGIN_STEP_TIMEOUT
+from bot.database import save_session_string
+from bot.metrics import REGISTRY, cache_hit
+from bot.rpc import install as install_gateway
+
+logger = logging.getLogger(__name__)
+
+LOGINS = REGISTRY.counter("bot_logins_total", "Finished /login attempts by outcome", ("result",))
+ACTIVE_LOGINS = REGISTRY.gauge("bot_active_logins", "Logins waiting for a phone number, code or password")
+IDLE_AUTH_CLIENTS = REGISTRY.gauge("bot_idle_auth_clients", "Connected auth clients parked for the next /login")
+
+class LoginEnded(Exception):
+    """The login was ended (deadline, /cancel_login, a new /login) while one of its auth calls was running"""
+
+class TimerWheel:
+    """Hashed timer wheel with `resolution`-second ticks.
+
+    schedule() and cancel() are O(1) whatever the number of timers, and each
+    tick only looks at one slot. The tick task runs only while timers are
+    pending, so an idle wheel costs nothing.
+    """
+
+    def __init__(self, slots: int = 64, resolution: float = 1.0):
+        self.resolution = resolution
+        self._slots: List[Dict[Hashable, Tuple[int, Callable]]] = [{} for _ in range(slots)]
+        self._where: Dict[Hashable, int] = {}
+        self._origin = time.monotonic()
+        self._tick = 0
+        self._task: Optional[asyncio.Task] = None
+
+    def _current_tick(self) -> int:
+        return int((time.monotonic() - self._origin) / self.resolution)
+
+    def schedule(self, key: Hashable, delay: float, callback: Callable[[Hashable], None]):
+        """Call callback(key) in about delay seconds, replacing any timer already set for key"""
+        self.cancel(key)
+        if not self._where:
+            # Nothing pending, so the wheel may have stood still; skip the idle ticks
+            self._tick = self._current_tick()
+        tick = max(self._current_tick() + math.ceil(delay / self.resolution), self._tick + 1)
+        slot = tick % len(self._slots)
+        self._slots[slot][key] = (tick, callback)
+        self._where[key] = slot
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def cancel(self, key: Hashable):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del self._slots[slot][key]
+
+    async def _run(self):
+        while self._where:
+            await asyncio.sleep(max(0.0, self._origin + (self._tick + 1) * self.resolution - time.monotonic()))
+            # Catch up on every tick a busy loop made us miss
+            now = self._current_tick()
+            while self._tick < now:
+                self._tick += 1
+                self._fire(self._tick)
+
+    def _fire(self, tick: int):
+        bucket = self._slots[tick % len(self._slots)]
+        for key in [key for key, (due, _) in bucket.items() if due <= tick]:
+            _, callback = bucket.pop(key)
+            del self._where[key]
+            try:
+                callback(key)
+            except Exception as e:
+                logger.error(f"Timer callback for {key} failed: {e}")
+
+    def __len__(self):
+        return len(self._where)
+
+async def _disconnect(client: Client):
+    try:
+        await client.disconnect()
+    except Exception:
+        pass
+
+class AuthClientPool:
+    """Connected, signed-out clients for /login.
+
+    Connecting means a TCP handshake and a fresh auth key, which is most of
+    the wait before "OTP Code sent". A client whose attempt ended without
+    signing in goes back to the pool for the next login; up to `size` are
+    kept, the rest are disconnected.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: List[Client] = []
+        self._names = itertools.count(1)
+
+    async def acquire(self) -> Client:
+        while self._idle:
+            client = self._idle.pop()
+            if client.is_connected:
+                cache_hit("auth_client", True)
+                return client
+        cache_hit("auth_client", False)
+        client = Client(
+            f"auth_{next(self._names)}",
+            api_id=int(API_ID) if API_ID else 0,
+            api_hash=str(API_HASH) if API_HASH else "",
+            in_memory=True,
+            # Surface FloodWait on send_code to the user instead of sleeping through it
+            sleep_threshold=0
+        )
+        await client.connect()
+        return client
+
+    async def release(self, client: Client, reusable: bool = True):
+        if reusable and client.is_connected and len(self._idle) < self.size:
+            self._idle.append(client)
+        else:
+            await _disconnect(client)
+
+    def __len__(self):
+        return len(self._idle)
+
+class LoginSession:
+    """One user's /login in progress"""
+    __slots__ = ("user_id", "step", "client", "phone", "phone_code_hash", "reusable", "busy", "ended")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.step = "PHONE"
+        self.client: Optional[Client] = None
+        self.phone: Optional[str] = None
+        self.phone_code_hash: Optional[str] = None
+        # Cleared once Telegram ties the auth key to an account (2FA pending or signed in)
+        self.reusable = True
+        # An auth call is running; its outcome can't be known yet, so the client is never pooled
+        self.busy = False
+        # Set by end() and complete(); a handler still running a step must drop it
+        self.ended = False
+
+class LoginManager:
+    """Open logins, their step deadlines and their auth clients.
+
+    Every step gets LOGIN_STEP_TIMEOUT seconds on a timer wheel; at most
+    LOGIN_MAX_CONCURRENT logins run at once. A successful login hands its
+    signed-in client to the download session cache instead of disconnecting.
+    """
+
+    def __init__(self, pool: AuthClientPool, max_concurrent: int, step_timeout: float):
+        self.pool = pool
+        self.max_concurrent = max_concurrent
+        self.step_timeout = step_timeout
+        self.timers = TimerWheel()
+        self._sessions: Dict[int, LoginSession] = {}
+
+    def get(self, user_id: int) -> Optional[LoginSession]:
+        return self._sessions.get(user_id)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def begin(self, user_id: int) -> Optional[LoginSession]:
+        """Open a login at the PHONE step; None when too many are already running"""
+        await self.end(user_id, "restarted")
+        if len(self._sessions) >= self.max_concurrent:
+            LOGINS.inc(result="refused")
+            return None
+        session = LoginSession(user_id)
+        self._sessions[user_id] = session
+        self.advance(session, "PHONE")
+        return session
+
+    def advance(self, session: LoginSession, step: str):
+        """Move to step and give the user a fresh deadline for it"""
+        session.step = step
+        self.timers.schedule(session.user_id, self.step_timeout, self._expired)
+
+    async def connect(self, session: LoginSession) -> Client:
+        if session.client is None:
+            client = await self.pool.acquire()
+            if session.ended:
+                # Nothing was sent on it yet, so it is still clean
+                await self.pool.release(client)
+                raise LoginEnded()
+            session.client = client
+        return session.client
+
+    @asynccontextmanager
+    async def call(self, session: LoginSession):
+        """Wrap every auth call of a step.
+
+        An end() meanwhile disconnects the client instead of pooling it,
+        and the step then raises LoginEnded, whatever the call returned.
+        """
+        session.busy = True
+        try:
+            yield
+        except Exception:
+            if session.ended:
+                raise LoginEnded() from None
+            raise
+        finally:
+            session.busy = False
+        if session.ended:
+            raise LoginEnded()
+
+    async def end(self, user_id: int, result: str, session: Optional[LoginSession] = None) -> bool:
+        """Close the user's login (only if it is still `session`, when given), pooling its client if it's clean"""
+        current = self._sessions.get(user_id)
+        if current is None or (session is not None and current is not session):
+            return False
+        del self._sessions[user_id]
+        current.ended = True
+        self.timers.cancel(user_id)
+        if current.client is not None:
+            await self.pool.release(current.client, current.reusable and not current.busy)
+        LOGINS.inc(result=result)
+        return True
+
+    def _expired(self, user_id: int):
+        asyncio.create_task(self._expire(user_id))
+
+    async def _expire(self, user_id: int):
+        if not await self.end(user_id, "expired"):
+            return
+        try:
+            await app.send_message(user_id, "⚠️ Login session expired due to inactivity.")
+        except Exception:
+            pass
+
+    async def complete(self, session: LoginSession) -> bool:
+        """Save the signed-in session and hand its live client to the download cache; False if the login was already ended"""
+        if session.ended or self._sessions.get(session.user_id) is not session:
+            return False
+        del self._sessions[session.user_id]
+        session.ended = True
+        self.timers.cancel(session.user_id)
+        client = session.client
+        session_string = await client.export_session_string()
+        await save_session_string(session.user_id, session_string)
+        LOGINS.inc(result="success")
+        try:
+            # The rest of Client.start() for a client that signed in by hand
+            install_gateway(client)
+            await client.invoke(raw.functions.updates.GetState())
+            client.me = await client.get_me()
+            await client.initialize()
+        except Exception as e:
+            # The session is saved; the first download will just start its own client
+            logger.warning(f"Handoff of login client for {session.user_id} failed: {e}")
+            await _disconnect(client)
+            return True
+        from bot.handlers import adopt_user_client
+        adopt_user_client(session.user_id, client)
+        return True
+
+logins = LoginManager(AuthClientPool(LOGIN_POOL_SIZE), LOGIN_MAX_CONCURRENT, LOGIN_STEP_TIMEOUT)
+
+def _collect_login_metrics():
+    ACTIVE_LOGINS.set(len(logins))
+    IDLE_AUTH_CLIENTS.set(len(logins.pool))
+
+REGISTRY.add_collector(_collect_login_metrics)
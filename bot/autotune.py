@@ -0,0 +1,187 @@
+import json
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from bot.config import (
+    AUTOTUNE_ENABLED, AUTOTUNE_MIN_BYTES, AUTOTUNE_MAX_WORKERS, AUTOTUNE_SAVE_INTERVAL,
+    get_smart_chunk_size, get_smart_download_workers
+)
+from bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+SETTINGS_KEY = "transfer_autotune"
+CHUNK_STEPS = (128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024)
+MIN_WORKERS = 1
+# A run this much slower than the moving average counts as congestion
+SLOWDOWN = 0.85
+EWMA_WEIGHT = 0.3
+
+AUTOTUNE_WORKERS = REGISTRY.gauge("bot_autotune_workers", "Tuned in-flight chunk requests per DC", ("dc",))
+AUTOTUNE_CHUNK = REGISTRY.gauge("bot_autotune_chunk_bytes", "Tuned chunk size per DC", ("dc",))
+AUTOTUNE_THROUGHPUT = REGISTRY.gauge("bot_autotune_throughput_bytes", "Smoothed per-DC download throughput in bytes/s", ("dc",))
+
+class DcState:
+    """AIMD controller for one DC.
+
+    `workers` is the window of in-flight getFile requests for the whole DC,
+    shared by every transfer currently running against it.
+    """
+
+    def __init__(self, chunk_size=CHUNK_STEPS[-1], workers=8):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.throughput = 0.0
+        self.best = None  # (throughput, chunk_size, workers)
+        self.samples = 0
+        self.active = 0
+
+    def record(self, speed, flood_waits, errors):
+        self.samples += 1
+        if flood_waits or errors:
+            # Multiplicative decrease; timeouts also mean smaller chunks
+            self.workers = max(MIN_WORKERS, self.workers // 2)
+            if errors:
+                self.chunk_size = CHUNK_STEPS[max(0, CHUNK_STEPS.index(self.chunk_size) - 1)]
+            return
+        if self.throughput and speed < self.throughput * SLOWDOWN:
+            self.workers = max(MIN_WORKERS, self.workers - 1)
+        else:
+            # Additive increase, bigger chunks first since they save round trips
+            step = CHUNK_STEPS.index(self.chunk_size)
+            if step < len(CHUNK_STEPS) - 1:
+                self.chunk_size = CHUNK_STEPS[step + 1]
+            else:
+                self.workers = min(AUTOTUNE_MAX_WORKERS, self.workers + 1)
+        self.throughput = speed if not self.throughput else (1 - EWMA_WEIGHT) * self.throughput + EWMA_WEIGHT * speed
+        if not self.best or speed > self.best[0]:
+            self.best = (speed, self.chunk_size, self.workers)
+
+    def to_dict(self):
+        return {
+            "chunk_size": self.chunk_size,
+            "workers": self.workers,
+            "throughput": round(self.throughput),
+            "best": list(self.best) if self.best else None,
+            "samples": self.samples,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        chunk_size = data.get("chunk_size")
+        state.chunk_size = chunk_size if chunk_size in CHUNK_STEPS else CHUNK_STEPS[-1]
+        state.workers = max(MIN_WORKERS, min(AUTOTUNE_MAX_WORKERS, int(data.get("workers", 8))))
+        state.throughput = float(data.get("throughput") or 0)
+        state.samples = int(data.get("samples") or 0)
+        best = data.get("best")
+        if best:
+            state.best = tuple(best)
+            # Restart from the best known point rather than wherever we left off
+            if best[1] in CHUNK_STEPS:
+                state.chunk_size = best[1]
+                state.workers = max(MIN_WORKERS, min(AUTOTUNE_MAX_WORKERS, int(best[2])))
+        return state
+
+class TransferAutotuner:
+    """Per-DC chunk size and parallelism learned from finished downloads.
+
+    Files under AUTOTUNE_MIN_BYTES are latency bound and keep the static
+    get_smart_* heuristics. State is stored in the settings table so the
+    next process starts from the best settings seen so far.
+    """
+
+    def __init__(self):
+        self._dcs: Dict[int, DcState] = {}
+        self._loaded = False
+        self._dirty = False
+        self._last_save = 0.0
+        self._save_task: Optional[asyncio.Task] = None
+
+    def state(self, dc_id) -> DcState:
+        if dc_id not in self._dcs:
+            self._dcs[dc_id] = DcState(
+                get_smart_chunk_size(AUTOTUNE_MIN_BYTES * 16),
+                get_smart_download_workers(AUTOTUNE_MIN_BYTES * 16)
+            )
+        return self._dcs[dc_id]
+
+    def suggest(self, dc_id, file_size) -> Tuple[int, int]:
+        """Chunk size and worker count for a new download from dc_id"""
+        if not AUTOTUNE_ENABLED or dc_id is None or file_size < AUTOTUNE_MIN_BYTES:
+            return get_smart_chunk_size(file_size), get_smart_download_workers(file_size)
+        state = self.state(dc_id)
+        # Split the DC window between transfers that are already running
+        workers = max(MIN_WORKERS, state.workers // (state.active + 1))
+        parts = -(-file_size // state.chunk_size)
+        return state.chunk_size, min(workers, parts)
+
+    @contextmanager
+    def track(self, dc_id):
+        """Count a transfer as sharing the DC while the block runs"""
+        if dc_id is None:
+            yield
+            return
+        state = self.state(dc_id)
+        state.active += 1
+        try:
+            yield
+        finally:
+            state.active -= 1
+
+    def record(self, dc_id, file_size, seconds, concurrent=1, flood_waits=0, errors=0):
+        """Feed one finished (or failed) download back into the controller"""
+        if not AUTOTUNE_ENABLED or dc_id is None or file_size < AUTOTUNE_MIN_BYTES or seconds <= 0:
+            return
+        # Scale by the transfers sharing the DC so the window tracks DC throughput
+        speed = file_size / seconds * max(1, concurrent)
+        self.state(dc_id).record(speed, flood_waits, errors)
+        self._dirty = True
+        if self._loaded and time.monotonic() - self._last_save > AUTOTUNE_SAVE_INTERVAL:
+            if not self._save_task or self._save_task.done():
+                self._save_task = asyncio.get_event_loop().create_task(self.save())
+
+    async def load(self):
+        from bot.database import get_setting
+        setting = await get_setting(SETTINGS_KEY)
+        if setting and setting.get("json_value"):
+            try:
+                data = json.loads(setting["json_value"])
+                self._dcs = {int(dc): DcState.from_dict(values) for dc, values in data.items()}
+            except (ValueError, TypeError, AttributeError) as e:
+                logger.warning(f"Ignoring corrupt autotune state: {e}")
+        self._loaded = True
+        self._last_save = time.monotonic()
+        if self._dcs:
+            logger.info("Autotune restored: " + ", ".join(
+                f"DC{dc} {s.chunk_size // 1024}KB x{s.workers}" for dc, s in sorted(self._dcs.items())
+            ))
+
+    async def save(self):
+        if not self._loaded or not self._dirty:
+            return
+        from bot.database import update_setting
+        self._dirty = False
+        self._last_save = time.monotonic()
+        data = {str(dc): state.to_dict() for dc, state in self._dcs.items()}
+        await update_setting(SETTINGS_KEY, None, json.dumps(data))
+
+    def reset(self):
+        """Forget what was learned; the next suggestion starts from the static defaults again"""
+        self._dcs.clear()
+        self._dirty = False
+
+    def snapshot(self):
+        return {dc: state.to_dict() for dc, state in sorted(self._dcs.items())}
+
+autotuner = TransferAutotuner()
+
+def _collect_autotune_metrics():
+    for dc, state in autotuner._dcs.items():
+        AUTOTUNE_WORKERS.set(state.workers, dc=dc)
+        AUTOTUNE_CHUNK.set(state.chunk_size, dc=dc)
+        AUTOTUNE_THROUGHPUT.set(round(state.throughput), dc=dc)
+
+REGISTRY.add_collector(_collect_autotune_metrics)
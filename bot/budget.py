@@ -0,0 +1,225 @@
+import time
+import asyncio
+import inspect
+import itertools
+import collections
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional
+from bot.config import (
+    TRANSFER_SLOTS, TRANSFER_BUFFER_MB, DOWNLOAD_RATE_LIMIT_MB, UPLOAD_RATE_LIMIT_MB, IN_MEMORY_BUFFER_MB
+)
+from bot.metrics import REGISTRY
+
+MB = 1024 * 1024
+
+# What acquire() actually granted after clamping to the pool; release() must give back exactly this
+Grant = collections.namedtuple("Grant", ["slots", "nbytes"])
+
+BUDGET_SLOTS = REGISTRY.gauge("bot_budget_slots_in_use", "Chunk-transfer slots currently granted")
+BUDGET_BUFFER = REGISTRY.gauge("bot_budget_buffer_bytes", "Transfer buffer memory currently granted")
+BUDGET_WAITERS = REGISTRY.gauge("bot_budget_waiters", "Chunk requests waiting for a slot or buffer memory")
+IN_MEMORY_BYTES = REGISTRY.gauge("bot_in_memory_file_bytes", "Bytes held by small files kept in memory between download and upload")
+BUDGET_THROTTLE_SECONDS = REGISTRY.counter(
+    "bot_budget_throttle_seconds_total", "Seconds transfers slept on the byte-rate cap", ("direction",)
+)
+
+class RateLimiter:
+    """Token bucket in bytes/s with a one second burst; None means unlimited"""
+
+    def __init__(self, rate: Optional[float]):
+        self.rate = rate
+        self._tokens = rate or 0
+        self._updated = time.monotonic()
+
+    async def consume(self, nbytes, direction=""):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        # Go into debt and sleep it off, so concurrent callers queue up behind each other
+        self._tokens -= nbytes
+        if self._tokens < 0:
+            delay = -self._tokens / self.rate
+            BUDGET_THROTTLE_SECONDS.inc(delay, direction=direction)
+            await asyncio.sleep(delay)
+
+class _Waiter:
+    __slots__ = ("ticket", "slots", "nbytes", "future", "seq")
+
+    def __init__(self, ticket, slots, nbytes, future, seq):
+        self.ticket = ticket
+        self.slots = slots
+        self.nbytes = nbytes
+        self.future = future
+        self.seq = seq
+
+class Ticket:
+    """One transfer's view of the budget"""
+
+    def __init__(self, budget: "TransferBudget", direction: str):
+        self.budget = budget
+        self.direction = direction
+        self.in_flight = 0
+
+    @asynccontextmanager
+    async def chunk(self, nbytes, slots=1):
+        """Hold a slot and `nbytes` of buffer for one chunk request"""
+        await self.budget.rates[self.direction].consume(nbytes, self.direction)
+        grant = await self.budget.acquire(self, slots, nbytes)
+        try:
+            yield
+        finally:
+            self.budget.release(self, *grant)
+
+    @asynccontextmanager
+    async def hold(self, nbytes, slots):
+        """Hold slots and buffer for a whole transfer the library chunks itself"""
+        grant = await self.budget.acquire(self, slots, nbytes)
+        try:
+            yield
+        finally:
+            self.budget.release(self, *grant)
+
+    def throttled(self, progress_callback=None):
+        """Progress callback that applies the byte-rate cap to library transfers.
+
+        Pyrogram awaits the progress callback between parts, so sleeping here
+        pushes back on its part producer.
+        """
+        limiter = self.budget.rates[self.direction]
+        if not limiter.rate:
+            return progress_callback
+        last = 0
+
+        async def progress(current, total, *args):
+            nonlocal last
+            delta, last = current - last, current
+            if delta > 0:
+                await limiter.consume(delta, self.direction)
+            if progress_callback:
+                result = progress_callback(current, total, *args)
+                if inspect.isawaitable(result):
+                    await result
+        return progress
+
+class TransferBudget:
+    """Process-wide pool of chunk-transfer slots and buffer memory.
+
+    Every client (the bot and each cached user client) draws from the same
+    pool. When requests queue up, the next grant goes to the transfer with
+    the fewest chunks in flight, so one large file can't starve small ones;
+    the head of that order is never skipped, so big requests don't starve
+    either.
+    """
+
+    def __init__(self, slots: int, buffer_bytes: int, download_rate=None, upload_rate=None):
+        self.slots = slots
+        self.buffer_bytes = buffer_bytes
+        # Configured size; scale() shrinks the pool relative to it and back
+        self._base = (slots, buffer_bytes)
+        self.rates = {"download": RateLimiter(download_rate), "upload": RateLimiter(upload_rate)}
+        self.slots_used = 0
+        self.buffer_used = 0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+
+    def ticket(self, direction: str) -> Ticket:
+        return Ticket(self, direction)
+
+    def _fits(self, slots, nbytes):
+        return self.slots_used + slots <= self.slots and self.buffer_used + nbytes <= self.buffer_bytes
+
+    def _grant(self, ticket, slots, nbytes):
+        self.slots_used += slots
+        self.buffer_used += nbytes
+        ticket.in_flight += slots
+
+    def _clamp(self, slots, nbytes):
+        # A single request larger than the whole pool would otherwise wait forever
+        return min(slots, self.slots), min(nbytes, self.buffer_bytes)
+
+    def try_acquire(self, ticket: Ticket, slots=1, nbytes=0) -> Optional[Grant]:
+        """Grant immediately or not at all; never queues"""
+        slots, nbytes = self._clamp(slots, nbytes)
+        if self._waiters or not self._fits(slots, nbytes):
+            return None
+        self._grant(ticket, slots, nbytes)
+        return Grant(slots, nbytes)
+
+    async def acquire(self, ticket: Ticket, slots=1, nbytes=0) -> Grant:
+        slots, nbytes = self._clamp(slots, nbytes)
+        if not self._waiters and self._fits(slots, nbytes):
+            self._grant(ticket, slots, nbytes)
+            return Grant(slots, nbytes)
+        waiter = _Waiter(ticket, slots, nbytes, asyncio.get_event_loop().create_future(), next(self._seq))
+        self._waiters.append(waiter)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif not waiter.future.cancelled():
+                # Granted between the wake-up and the cancel
+                self.release(ticket, waiter.slots, waiter.nbytes)
+            raise
+        # scale() may have clamped the request again while it waited
+        return Grant(waiter.slots, waiter.nbytes)
+
+    def release(self, ticket: Ticket, slots=1, nbytes=0):
+        """Give back a Grant; not clamped, since the pool may have been resized since it was granted"""
+        self.slots_used -= slots
+        self.buffer_used -= nbytes
+        ticket.in_flight -= slots
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._waiters:
+            waiter = min(self._waiters, key=lambda w: (w.ticket.in_flight, w.seq))
+            if waiter.future.done():
+                self._waiters.remove(waiter)
+                continue
+            if not self._fits(waiter.slots, waiter.nbytes):
+                return
+            self._waiters.remove(waiter)
+            self._grant(waiter.ticket, waiter.slots, waiter.nbytes)
+            waiter.future.set_result(None)
+
+    def scale(self, factor: float):
+        """Resize the pool to factor of its configured size.
+
+        Grants already held are kept; shrinking only stops new ones until
+        usage drops below the new size, growing wakes waiters at once.
+        """
+        slots, buffer_bytes = self._base
+        self.slots = max(1, int(slots * factor)) if slots else 0
+        self.buffer_bytes = max(1, int(buffer_bytes * factor))
+        for waiter in self._waiters:
+            # A waiter bigger than the shrunk pool would never fit and would block everyone behind it
+            waiter.slots, waiter.nbytes = self._clamp(waiter.slots, waiter.nbytes)
+        self._dispatch()
+
+    def snapshot(self) -> Dict:
+        return {
+            "slots": f"{self.slots_used}/{self.slots}",
+            "buffer_mb": f"{self.buffer_used / MB:.1f}/{self.buffer_bytes / MB:.0f}",
+            "waiting": len(self._waiters),
+        }
+
+budget = TransferBudget(
+    TRANSFER_SLOTS,
+    int(TRANSFER_BUFFER_MB * MB),
+    download_rate=DOWNLOAD_RATE_LIMIT_MB * MB or None,
+    upload_rate=UPLOAD_RATE_LIMIT_MB * MB or None
+)
+
+# Small files held whole in memory from download to upload; buffer only, no slots
+in_memory = TransferBudget(0, int(IN_MEMORY_BUFFER_MB * MB))
+
+def _collect_budget_metrics():
+    BUDGET_SLOTS.set(budget.slots_used)
+    BUDGET_BUFFER.set(budget.buffer_used)
+    BUDGET_WAITERS.set(len(budget._waiters))
+    IN_MEMORY_BYTES.set(in_memory.buffer_used)
+
+REGISTRY.add_collector(_collect_budget_metrics)
@@ -0,0 +1,145 @@
+import time
+import asyncio
+import inspect
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Set
+from bot.metrics import REGISTRY
+
+CANCELLATIONS = REGISTRY.counter("bot_cancellations_total", "Transfers cancelled by /cancel or /killall")
+ABORT_SECONDS = REGISTRY.histogram(
+    "bot_cancel_abort_seconds", "Time from a cancel request until the transfer had released everything"
+)
+
+class Cancelled(Exception):
+    """The transfer's cancel token was triggered"""
+
+class CancelToken:
+    """Per-transfer cancellation flag.
+
+    Transfers call check() at chunk boundaries and in progress callbacks;
+    race() additionally wakes a transfer blocked on a queue or a FloodWait
+    sleep as soon as cancel() is called.
+    """
+
+    def __init__(self, owner=None):
+        self.owner = owner
+        self.cancelled_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._cancelled = asyncio.Event()
+        self._finished = asyncio.Event()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancelled_at is not None
+
+    def cancel(self):
+        if self.cancelled_at is None:
+            self.cancelled_at = time.monotonic()
+            self._cancelled.set()
+
+    def check(self):
+        if self.cancelled_at is not None:
+            raise Cancelled(f"Transfer for {self.owner} was cancelled")
+
+    async def race(self, aw):
+        """Await aw, abandoning it with Cancelled once the token fires"""
+        self.check()
+        task = asyncio.ensure_future(aw)
+        waiter = asyncio.ensure_future(self._cancelled.wait())
+        try:
+            await asyncio.wait((task, waiter), return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            waiter.cancel()
+            if not task.done():
+                task.cancel()
+                # Let the abandoned work run its cleanup before reporting the abort
+                await asyncio.gather(task, return_exceptions=True)
+        if task.cancelled():
+            self.check()
+        return task.result()
+
+    async def sleep(self, seconds):
+        try:
+            await asyncio.wait_for(self._cancelled.wait(), seconds)
+        except asyncio.TimeoutError:
+            return
+        self.check()
+
+    def progress(self, client, progress_callback=None):
+        """Progress callback that stops a library transfer via client.stop_transmission()"""
+        async def progress(current, total, *args):
+            if self.cancelled_at is not None:
+                client.stop_transmission()
+            if progress_callback:
+                result = progress_callback(current, total, *args)
+                if inspect.isawaitable(result):
+                    await result
+        return progress
+
+    def finish(self):
+        if self.finished_at is not None:
+            return
+        self.finished_at = time.monotonic()
+        self._finished.set()
+        if self.cancelled_at is not None:
+            ABORT_SECONDS.observe(self.finished_at - self.cancelled_at)
+
+    @property
+    def abort_seconds(self) -> Optional[float]:
+        if self.cancelled_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.cancelled_at
+
+    async def wait_finished(self, timeout):
+        try:
+            await asyncio.wait_for(self._finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+# Token for callers that never cancel
+NEVER = CancelToken("nobody")
+
+class CancelRegistry:
+    """Open cancel tokens by user id"""
+
+    def __init__(self):
+        self._tokens: Dict[int, Set[CancelToken]] = {}
+
+    @contextmanager
+    def open(self, user_id):
+        token = CancelToken(user_id)
+        self._tokens.setdefault(user_id, set()).add(token)
+        try:
+            yield token
+        finally:
+            tokens = self._tokens.get(user_id)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens[user_id]
+            token.finish()
+
+    def active(self, user_id) -> bool:
+        return bool(self._tokens.get(user_id))
+
+    def cancel(self, user_id) -> List[CancelToken]:
+        tokens = list(self._tokens.get(user_id, ()))
+        for token in tokens:
+            if not token.cancelled:
+                CANCELLATIONS.inc()
+            token.cancel()
+        return tokens
+
+    def cancel_all(self) -> List[CancelToken]:
+        return [token for user_id in list(self._tokens) for token in self.cancel(user_id)]
+
+    def __len__(self):
+        return sum(len(tokens) for tokens in self._tokens.values())
+
+async def wait_aborted(tokens: List[CancelToken], timeout: float = 30):
+    """Wait for cancelled transfers to unwind; returns (abort durations, still running)"""
+    await asyncio.gather(*(token.wait_finished(timeout) for token in tokens))
+    durations = [token.abort_seconds for token in tokens if token.abort_seconds is not None]
+    return durations, len(tokens) - len(durations)
+
+cancellations = CancelRegistry()
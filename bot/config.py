@@ -26,6 +26,7 @@ CRYPTO_ADDRESS = os.environ.get("CRYPTO_ADDRESS", "Contact Owner")
 CARD_PAYMENT_LINK = os.environ.get("CARD_PAYMENT_LINK", "Contact Owner")
 DATABASE_PATH = os.environ.get("DATABASE_PATH", "telegram_bot.db")
 DUMP_CHANNEL_ID = os.environ.get("DUMP_CHANNEL_ID")
+SESSION_SECRET = os.environ.get("SESSION_SECRET")  # Encrypts stored user sessions; derived from BOT_TOKEN when unset
 
 # Performance Settings
 MAX_CONCURRENT_DOWNLOADS = 4
@@ -61,13 +62,86 @@ def get_smart_upload_workers(file_size):
     """
     return 2
 
+# Album (media group) re-uploads on the private path
+ALBUM_PARALLEL_DOWNLOADS = int(os.environ.get("ALBUM_PARALLEL_DOWNLOADS", 4))  # Members downloaded at once
+ALBUM_PARALLEL_UPLOADS = int(os.environ.get("ALBUM_PARALLEL_UPLOADS", 4))  # Members uploaded at once
+
+# Thumbnails and local media probing (bot/thumbnails.py)
+THUMB_CACHE_MB = float(os.environ.get("THUMB_CACHE_MB", 8))  # In-memory thumbnails keyed by file_unique_id
+FFMPEG_ENABLED = os.environ.get("FFMPEG_ENABLED", "True").lower() == "true"  # Used only if ffmpeg/ffprobe are on PATH
+FFMPEG_TIMEOUT = int(os.environ.get("FFMPEG_TIMEOUT", 20))  # Seconds per ffmpeg/ffprobe run
+
+# Per-DC chunk size / parallelism learned from live throughput (bot/autotune.py)
+AUTOTUNE_ENABLED = os.environ.get("AUTOTUNE_ENABLED", "True").lower() == "true"
+AUTOTUNE_MIN_BYTES = int(os.environ.get("AUTOTUNE_MIN_BYTES", 8 * 1024 * 1024))  # Smaller files keep the static heuristics
+AUTOTUNE_MAX_WORKERS = int(os.environ.get("AUTOTUNE_MAX_WORKERS", 16))  # Ceiling for in-flight chunk requests per DC
+AUTOTUNE_SAVE_INTERVAL = int(os.environ.get("AUTOTUNE_SAVE_INTERVAL", 300))  # Seconds between state saves
+
+# Process-wide transfer budget shared by the bot and all user clients (bot/budget.py)
+TRANSFER_SLOTS = int(os.environ.get("TRANSFER_SLOTS", 32))  # Chunk requests in flight across all transfers
+TRANSFER_BUFFER_MB = float(os.environ.get("TRANSFER_BUFFER_MB", 96))  # Memory for chunks in flight
+DOWNLOAD_RATE_LIMIT_MB = float(os.environ.get("DOWNLOAD_RATE_LIMIT_MB", 0))  # MB/s, 0 = uncapped
+UPLOAD_RATE_LIMIT_MB = float(os.environ.get("UPLOAD_RATE_LIMIT_MB", 0))  # MB/s, 0 = uncapped
+IN_MEMORY_MAX_MB = float(os.environ.get("IN_MEMORY_MAX_MB", 4))  # Files up to this size never touch the disk
+IN_MEMORY_BUFFER_MB = float(os.environ.get("IN_MEMORY_BUFFER_MB", 64))  # Total held by in-memory files; beyond it they go to disk
+
+# Worker processes for private-path transfers (bot/workers.py); budgets above are split between them
+TRANSFER_WORKERS = int(os.environ.get("TRANSFER_WORKERS", 0))  # 0 = transfers run in the bot process; each worker costs ~80 MB; needs DISK_QUOTA_GB
+WORKER_PING_INTERVAL = int(os.environ.get("WORKER_PING_INTERVAL", 10))  # Seconds between health pings
+WORKER_PING_TIMEOUT = int(os.environ.get("WORKER_PING_TIMEOUT", 30))  # A worker silent this long is killed and restarted
+WORKER_CANCEL_TIMEOUT = int(os.environ.get("WORKER_CANCEL_TIMEOUT", 15))  # Seconds to wait for a worker to confirm a cancel
+
+# Disk space for downloads/ (bot/disk.py)
+DISK_QUOTA_GB = float(os.environ.get("DISK_QUOTA_GB", 0))  # Max reserved by downloads at once, 0 = whatever the volume allows
+DISK_MIN_FREE_MB = float(os.environ.get("DISK_MIN_FREE_MB", 512))  # Headroom kept free on the volume
+DISK_RESERVE_TIMEOUT = int(os.environ.get("DISK_RESERVE_TIMEOUT", 120))  # Seconds a download queues for space before it is refused
+DISK_SWEEP_INTERVAL = int(os.environ.get("DISK_SWEEP_INTERVAL", 600))  # Seconds between orphan sweeps
+DISK_ORPHAN_AGE = int(os.environ.get("DISK_ORPHAN_AGE", 1800))  # Unowned files untouched this long are deleted
+
+# /login (bot/auth.py)
+LOGIN_MAX_CONCURRENT = int(os.environ.get("LOGIN_MAX_CONCURRENT", 10))  # Logins in progress at once; each holds a connected client
+LOGIN_POOL_SIZE = int(os.environ.get("LOGIN_POOL_SIZE", 2))  # Signed-out auth clients kept connected for the next /login
+LOGIN_STEP_TIMEOUT = int(os.environ.get("LOGIN_STEP_TIMEOUT", 300))  # Seconds allowed for each of the phone, code and password steps
+
+# Premium expiry sweeper (bot/premium.py)
+PREMIUM_SWEEP_MAX_SLEEP = int(os.environ.get("PREMIUM_SWEEP_MAX_SLEEP", 3600))  # Longest wait between sweeps when no expiry is due sooner
+PREMIUM_NOTIFY_RATE = float(os.environ.get("PREMIUM_NOTIFY_RATE", 20))  # Expiry notices sent per second
+
+# Telegram RPC gateway in front of the bot and every user client (bot/rpc.py)
+RPC_SEND_RATE = float(os.environ.get("RPC_SEND_RATE", 25))  # Messages sent per second per client; Telegram allows bots about 30
+RPC_EDIT_RATE = float(os.environ.get("RPC_EDIT_RATE", 20))  # Message edits per second per client
+RPC_READ_RATE = float(os.environ.get("RPC_READ_RATE", 20))  # get_messages, history and username lookups per second per client
+RPC_CHAT_RATE = float(os.environ.get("RPC_CHAT_RATE", 1))  # Sends and edits per second into one private chat
+RPC_GROUP_RATE = float(os.environ.get("RPC_GROUP_RATE", 20))  # Sends and edits per minute into one group or channel
+RPC_MAX_WAIT = float(os.environ.get("RPC_MAX_WAIT", 30))  # Longest a call is held for pacing or a FloodWait before it is refused
+RPC_FLOOD_RETRIES = int(os.environ.get("RPC_FLOOD_RETRIES", 3))  # FloodWait retries per call
+
+# Dump channel archive that doubles as a file cache (bot/archive.py); the channel is /set_dump or DUMP_CHANNEL_ID
+ARCHIVE_ENABLED = os.environ.get("ARCHIVE_ENABLED", "True").lower() == "true"
+ARCHIVE_BATCH = int(os.environ.get("ARCHIVE_BATCH", 50))  # Delivered messages gathered per archive batch
+ARCHIVE_BATCH_WAIT = float(os.environ.get("ARCHIVE_BATCH_WAIT", 5))  # Seconds a batch waits for more deliveries
+ARCHIVE_RATE = float(os.environ.get("ARCHIVE_RATE", 12))  # Copy calls into the dump channel per minute; keep below RPC_GROUP_RATE
+ARCHIVE_QUEUE_SIZE = int(os.environ.get("ARCHIVE_QUEUE_SIZE", 1000))  # Deliveries waiting to be archived; more are skipped
+
+# Download job queue persisted in SQLite (bot/jobs.py)
+JOB_MAX_RUNNING = int(os.environ.get("JOB_MAX_RUNNING", 16))  # Jobs claimed at once; the rest wait in the table
+JOB_CLAIM_BATCH = int(os.environ.get("JOB_CLAIM_BATCH", 8))  # Jobs leased per claim query
+JOB_LEASE_SECONDS = int(os.environ.get("JOB_LEASE_SECONDS", 30))  # A job whose lease lapses this long is taken over (its process died)
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 3))  # Claims before an interrupted job is given up
+JOB_RETENTION_HOURS = float(os.environ.get("JOB_RETENTION_HOURS", 24))  # Finished jobs are kept this long
+
+# Memory-pressure governor (bot/memory.py)
+MEMORY_LIMIT_MB = float(os.environ.get("MEMORY_LIMIT_MB", 1300))  # Address-space cap (RLIMIT_AS) set at startup, 0 = none; the governor works against it
+MEMORY_SOFT_PCT = float(os.environ.get("MEMORY_SOFT_PCT", 75))  # % of the cap where caches and transfer budgets shrink
+MEMORY_HARD_PCT = float(os.environ.get("MEMORY_HARD_PCT", 90))  # % of the cap where new jobs wait and idle sessions are all dropped
+MEMORY_SAMPLE_INTERVAL = float(os.environ.get("MEMORY_SAMPLE_INTERVAL", 2))  # Seconds between memory samples
+MEMORY_GC_THRESHOLD = int(os.environ.get("MEMORY_GC_THRESHOLD", 5000))  # Allocations between young-generation collections while memory is fine
+
 # Optimization for 1.5GB RAM VPS and faster execution
 # Event loop is already initialized in main.py
 active_downloads = set()
-cancel_flags = set()
 global_download_semaphore = asyncio.Semaphore(MAX_CONCURRENT_DOWNLOADS)
 global_upload_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPLOADS)
-login_states = {}
 
 # Verification
 missing_vars = []
@@ -84,6 +158,11 @@ RICHADS_PUBLISHER_ID = os.environ.get("RICHADS_PUBLISHER_ID", "792361")
 RICHADS_WIDGET_ID = os.environ.get("RICHADS_WIDGET_ID", "351352")
 AD_DAILY_LIMIT = int(os.environ.get("AD_DAILY_LIMIT", 5))
 AD_FOR_PREMIUM = os.environ.get("AD_FOR_PREMIUM", "False").lower() == "true"
+AD_PREFETCH_SIZE = int(os.environ.get("AD_PREFETCH_SIZE", 3))  # Ads kept ready per language
+AD_PREFETCH_TTL = int(os.environ.get("AD_PREFETCH_TTL", 300))  # Seconds before a buffered ad goes stale
+AD_DELIVERY_WORKERS = int(os.environ.get("AD_DELIVERY_WORKERS", 2))  # Background ad senders
+AD_CREATIVE_CACHE_SIZE = int(os.environ.get("AD_CREATIVE_CACHE_SIZE", 200))  # Creative file_ids kept
+AD_CREATIVE_CACHE_TTL = int(os.environ.get("AD_CREATIVE_CACHE_TTL", 86400))  # Seconds a file_id is trusted
 
 # Update client with higher max_concurrent_transmissions
 app = Client(
@@ -2,9 +2,12 @@ import os
 import sqlite3
 import logging
 import asyncio
-from datetime import datetime, timedelta
+import time
+import functools
 from typing import Optional, Dict, List
 from bot.config import OWNER_ID
+from bot.metrics import DB_QUERY_SECONDS
+from bot.session_crypto import seal, unseal, SessionKeyError
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -23,6 +26,224 @@ def _get_connection():
     conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+def _timed(func):
+    """Record the latency of a database call under its function name"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, op=func.__name__)
+    return wrapper
+
+def _now() -> int:
+    return int(time.time())
+
+def _today() -> int:
+    """UTC midnight of the current day, in epoch seconds"""
+    now = _now()
+    return now - now % 86400
+
+def format_date(timestamp, with_time=True) -> Optional[str]:
+    """Render a stored epoch timestamp for users; None stays None"""
+    if timestamp is None:
+        return None
+    return time.strftime("%Y-%m-%d %H:%M UTC" if with_time else "%Y-%m-%d", time.gmtime(timestamp))
+
+def _epoch(column):
+    """SQL that turns a legacy ISO date/datetime column into epoch seconds"""
+    return f"CAST(strftime('%s', {column}) AS INTEGER)"
+
+def _migration_1_initial(cursor):
+    """The original TEXT-keyed schema; a no-op on databases created before migrations existed"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id TEXT PRIMARY KEY,
+            role TEXT DEFAULT 'free',
+            downloads_today INTEGER DEFAULT 0,
+            last_download_date TEXT,
+            is_agreed_terms INTEGER DEFAULT 0,
+            phone_session_string TEXT,
+            premium_expiry_date TEXT,
+            is_banned INTEGER DEFAULT 0,
+            ads_today INTEGER DEFAULT 0,
+            last_ad_date TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS settings (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            json_value TEXT,
+            updated_at TEXT
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)')
+
+def _migration_2_integer_schema(cursor):
+    """INTEGER user ids, epoch-second dates, sessions in their own table.
+
+    users keys on an INTEGER PRIMARY KEY (the rowid itself, so a lookup is
+    one b-tree search). settings is WITHOUT ROWID: small rows keyed by text.
+    sessions stays a rowid table because its rows are large.
+    Day columns (last_download_date, last_ad_date) hold the UTC midnight.
+    """
+    cursor.execute('''
+        CREATE TABLE users_v2 (
+            telegram_id INTEGER PRIMARY KEY,
+            role TEXT NOT NULL DEFAULT 'free',
+            downloads_today INTEGER NOT NULL DEFAULT 0,
+            last_download_date INTEGER,
+            is_agreed_terms INTEGER NOT NULL DEFAULT 0,
+            premium_expiry_date INTEGER,
+            is_banned INTEGER NOT NULL DEFAULT 0,
+            ads_today INTEGER NOT NULL DEFAULT 0,
+            last_ad_date INTEGER,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO users_v2
+        SELECT CAST(telegram_id AS INTEGER), COALESCE(role, 'free'), COALESCE(downloads_today, 0),
+               {_epoch('last_download_date')}, COALESCE(is_agreed_terms, 0), {_epoch('premium_expiry_date')},
+               COALESCE(is_banned, 0), COALESCE(ads_today, 0), {_epoch('last_ad_date')},
+               {_epoch('created_at')}, {_epoch('updated_at')}
+        FROM users
+        WHERE telegram_id GLOB '[0-9]*' OR telegram_id GLOB '-[0-9]*'
+    ''')
+    cursor.execute('''
+        CREATE TABLE sessions (
+            user_id INTEGER PRIMARY KEY,
+            session_string TEXT NOT NULL,
+            updated_at INTEGER
+        )
+    ''')
+    cursor.execute(f'''
+        INSERT OR IGNORE INTO sessions
+        SELECT CAST(telegram_id AS INTEGER), phone_session_string, {_epoch('updated_at')}
+        FROM users
+        WHERE phone_session_string IS NOT NULL AND phone_session_string != ''
+          AND (telegram_id GLOB '[0-9]*' OR telegram_id GLOB '-[0-9]*')
+    ''')
+    cursor.execute('DROP TABLE users')
+    cursor.execute('ALTER TABLE users_v2 RENAME TO users')
+    cursor.execute('CREATE INDEX idx_users_role ON users(role)')
+    # Only premium users carry an expiry; the expiry sweep reads just these rows
+    cursor.execute('CREATE INDEX idx_users_premium_expiry ON users(premium_expiry_date) WHERE premium_expiry_date IS NOT NULL')
+    # Broadcasts walk this instead of the table; keyed on is_banned so it covers telegram_id (the rowid)
+    cursor.execute('CREATE INDEX idx_users_active ON users(is_banned) WHERE is_banned = 0')
+
+    cursor.execute('''
+        CREATE TABLE settings_v2 (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            json_value TEXT,
+            updated_at INTEGER
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute(f"INSERT INTO settings_v2 SELECT key, value, json_value, {_epoch('updated_at')} FROM settings")
+    cursor.execute('DROP TABLE settings')
+    cursor.execute('ALTER TABLE settings_v2 RENAME TO settings')
+
+def _migration_3_quota_grant(cursor):
+    """Slots granted by the latest reserve_quota, so its RETURNING can report them"""
+    cursor.execute('ALTER TABLE users ADD COLUMN last_quota_grant INTEGER NOT NULL DEFAULT 0')
+
+def _migration_4_sealed_sessions(cursor):
+    """Sessions stored encrypted as packed bytes instead of plaintext base64"""
+    cursor.execute('''
+        CREATE TABLE sessions_v4 (
+            user_id INTEGER PRIMARY KEY,
+            session BLOB NOT NULL,
+            updated_at INTEGER
+        )
+    ''')
+    rows = cursor.execute('SELECT user_id, session_string, updated_at FROM sessions').fetchall()
+    for user_id, session_string, updated_at in rows:
+        try:
+            sealed = seal(session_string)
+        except ValueError:
+            logger.warning(f"Dropping unreadable session for user {user_id}; they will need to /login again")
+            continue
+        cursor.execute('INSERT INTO sessions_v4 VALUES (?, ?, ?)', (user_id, sealed, updated_at))
+    cursor.execute('DROP TABLE sessions')
+    cursor.execute('ALTER TABLE sessions_v4 RENAME TO sessions')
+
+def _migration_5_jobs(cursor):
+    """Download requests persisted until they finish, so a restart resumes them"""
+    cursor.execute('''
+        CREATE TABLE jobs (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            link TEXT NOT NULL,
+            status_chat_id INTEGER NOT NULL,
+            status_message_id INTEGER NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_until INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at INTEGER,
+            updated_at INTEGER
+        )
+    ''')
+    # Finished jobs drop out of the index, so claiming stays cheap however many are kept.
+    # SQLite only uses a partial index when the query repeats its WHERE term verbatim.
+    cursor.execute("CREATE INDEX idx_jobs_open ON jobs(state, lease_until) WHERE state IN ('pending', 'running')")
+
+def _migration_6_archive(cursor):
+    """Where each delivered file was archived in the dump channel, keyed by its source message"""
+    cursor.execute('''
+        CREATE TABLE archive (
+            source_chat_id INTEGER NOT NULL,
+            source_message_id INTEGER NOT NULL,
+            file_unique_id TEXT,
+            dump_chat_id INTEGER NOT NULL,
+            dump_message_ids TEXT NOT NULL,
+            created_at INTEGER,
+            PRIMARY KEY (source_chat_id, source_message_id)
+        ) WITHOUT ROWID
+    ''')
+
+def _migration_7_job_quota(cursor):
+    """Download slots a job holds and the day they were taken, so a resumed job doesn't pay twice"""
+    cursor.execute('ALTER TABLE jobs ADD COLUMN quota_held INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE jobs ADD COLUMN quota_date INTEGER NOT NULL DEFAULT 0')
+
+# (version, migration) in order; PRAGMA user_version records the last one applied
+MIGRATIONS = [
+    (1, _migration_1_initial),
+    (2, _migration_2_integer_schema),
+    (3, _migration_3_quota_grant),
+    (4, _migration_4_sealed_sessions),
+    (5, _migration_5_jobs),
+    (6, _migration_6_archive),
+    (7, _migration_7_job_quota),
+]
+
+def _migrate(conn):
+    current = conn.execute('PRAGMA user_version').fetchone()[0]
+    for version, migration in MIGRATIONS:
+        if version <= current:
+            continue
+        started = time.perf_counter()
+        cursor = conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            migration(cursor)
+            cursor.execute(f'PRAGMA user_version = {version}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Applied database migration {version} ({migration.__name__}) in {time.perf_counter() - started:.2f}s")
+    return max(current, MIGRATIONS[-1][0])
+
 def init_db():
     global _db_initialized
     if _db_initialized:
@@ -30,61 +251,39 @@ def init_db():
     
     try:
         conn = _get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id TEXT PRIMARY KEY,
-                role TEXT DEFAULT 'free',
-                downloads_today INTEGER DEFAULT 0,
-                last_download_date TEXT,
-                is_agreed_terms INTEGER DEFAULT 0,
-                phone_session_string TEXT,
-                premium_expiry_date TEXT,
-                is_banned INTEGER DEFAULT 0,
-                ads_today INTEGER DEFAULT 0,
-                last_ad_date TEXT,
-                created_at TEXT,
-                updated_at TEXT
-            )
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS settings (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                json_value TEXT,
-                updated_at TEXT
-            )
-        ''')
-        
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_role ON users(role)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)')
-        
-        conn.commit()
+        version = _migrate(conn)
         conn.close()
             
         _db_initialized = True
-        logger.info(f"SQLite database initialized: {DATABASE_PATH}")
+        logger.info(f"SQLite database initialized: {DATABASE_PATH} (schema v{version})")
     except Exception as e:
         logger.error(f"SQLite initialization error: {e}")
         raise
 
+def _user_row(row) -> Dict:
+    user = dict(row)
+    user['is_banned'] = bool(user['is_banned'])
+    user['is_agreed_terms'] = bool(user['is_agreed_terms'])
+    if 'has_session' in user:
+        user['has_session'] = bool(user['has_session'])
+    return user
+
+@_timed
 async def get_user(user_id) -> Optional[Dict]:
     try:
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
-            cursor.execute('SELECT * FROM users WHERE telegram_id = ?', (str(user_id),))
+            cursor.execute('''
+                SELECT users.*, sessions.user_id IS NOT NULL AS has_session
+                FROM users LEFT JOIN sessions ON sessions.user_id = users.telegram_id
+                WHERE users.telegram_id = ?
+            ''', (int(user_id),))
             row = cursor.fetchone()
             conn.close()
         
         if row:
-            user = dict(row)
-            user['is_banned'] = bool(user['is_banned'])
-            user['is_agreed_terms'] = bool(user['is_agreed_terms'])
-            
-            return user
+            return _user_row(row)
         
         if OWNER_ID and str(user_id) == str(OWNER_ID):
             user = await create_user(user_id)
@@ -98,49 +297,31 @@ async def get_user(user_id) -> Optional[Dict]:
         logger.error(f"Error getting user {user_id}: {e}")
         return None
 
+@_timed
 async def create_user(user_id) -> Optional[Dict]:
     try:
-        now = datetime.utcnow().isoformat()
-        today = datetime.utcnow().date().isoformat()
+        now = _now()
+        today = _today()
         
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
-            
-            cursor.execute('SELECT 1 FROM users WHERE telegram_id = ?', (str(user_id),))
-            if cursor.fetchone():
-                conn.close()
-                # Instead of calling get_user which acquires lock again, 
-                # we return the user dict structure directly if it exists.
-                # In a real app we might want to fetch, but for registration 
-                # this is fine or we should fetch without lock.
-                return {
-                    "telegram_id": str(user_id),
-                    "role": "free", # Default, will be updated by caller if needed
-                    "downloads_today": 0,
-                    "last_download_date": today,
-                    "is_agreed_terms": False,
-                    "phone_session_string": None,
-                    "premium_expiry_date": None,
-                    "is_banned": False,
-                    "created_at": now
-                }
-            
+            # An existing user is left untouched; callers only need the registration defaults
             cursor.execute('''
-                INSERT INTO users (telegram_id, role, downloads_today, last_download_date, 
-                                   is_agreed_terms, is_banned, ads_today, created_at, updated_at)
+                INSERT OR IGNORE INTO users (telegram_id, role, downloads_today, last_download_date,
+                                             is_agreed_terms, is_banned, ads_today, created_at, updated_at)
                 VALUES (?, 'free', 0, ?, 0, 0, 0, ?, ?)
-            ''', (str(user_id), today, now, now))
+            ''', (int(user_id), today, now, now))
             conn.commit()
             conn.close()
         
         return {
-            "telegram_id": str(user_id),
+            "telegram_id": int(user_id),
             "role": "free",
             "downloads_today": 0,
             "last_download_date": today,
             "is_agreed_terms": False,
-            "phone_session_string": None,
+            "has_session": False,
             "premium_expiry_date": None,
             "is_banned": False,
             "created_at": now
@@ -149,176 +330,233 @@ async def create_user(user_id) -> Optional[Dict]:
         logger.error(f"Error creating user {user_id}: {e}")
         return None
 
+@_timed
 async def update_user_terms(user_id, agreed=True):
     try:
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET is_agreed_terms = ?, updated_at = ? WHERE telegram_id = ?',
-                           (1 if agreed else 0, datetime.utcnow().isoformat(), str(user_id)))
+                           (1 if agreed else 0, _now(), int(user_id)))
             conn.commit()
             conn.close()
     except Exception as e:
         logger.error(f"Error updating terms for {user_id}: {e}")
 
+@_timed
 async def save_session_string(user_id, session_string):
     try:
+        sealed = seal(session_string)
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
-            cursor.execute('UPDATE users SET phone_session_string = ?, updated_at = ? WHERE telegram_id = ?',
-                           (session_string, datetime.utcnow().isoformat(), str(user_id)))
+            cursor.execute('''
+                INSERT INTO sessions (user_id, session, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET session = excluded.session,
+                                                   updated_at = excluded.updated_at
+            ''', (int(user_id), sealed, _now()))
             conn.commit()
             conn.close()
         logger.info(f"Saved session for user {user_id}")
     except Exception as e:
         logger.error(f"Error saving session for {user_id}: {e}")
 
+@_timed
+async def get_session_string(user_id) -> Optional[str]:
+    """Decrypt a user's stored session; only called when a user client has to be started"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT session FROM sessions WHERE user_id = ?', (int(user_id),))
+            row = cursor.fetchone()
+            conn.close()
+        return unseal(row["session"]) if row else None
+    except SessionKeyError:
+        logger.error(f"Session for {user_id} can't be decrypted (was SESSION_SECRET or BOT_TOKEN changed?)")
+        return None
+    except Exception as e:
+        logger.error(f"Error loading session for {user_id}: {e}")
+        return None
+
+@_timed
 async def logout_user(user_id):
     try:
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
-            cursor.execute('UPDATE users SET phone_session_string = NULL, updated_at = ? WHERE telegram_id = ?',
-                           (datetime.utcnow().isoformat(), str(user_id)))
+            cursor.execute('DELETE FROM sessions WHERE user_id = ?', (int(user_id),))
             conn.commit()
             conn.close()
         logger.info(f"User {user_id} logged out")
     except Exception as e:
         logger.error(f"Error logging out user {user_id}: {e}")
 
+@_timed
 async def set_user_role(user_id, role, duration_days=None):
     try:
         expiry_date = None
         if role == 'premium' and duration_days:
-            expiry_date = (datetime.utcnow() + timedelta(days=int(duration_days))).isoformat()
+            expiry_date = _now() + int(duration_days) * 86400
         
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET role = ?, premium_expiry_date = ?, updated_at = ? WHERE telegram_id = ?',
-                           (role, expiry_date, datetime.utcnow().isoformat(), str(user_id)))
+                           (role, expiry_date, _now(), int(user_id)))
             conn.commit()
             conn.close()
     except Exception as e:
         logger.error(f"Error setting role for {user_id}: {e}")
 
+@_timed
 async def ban_user(user_id, is_banned=True):
     try:
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
             cursor.execute('UPDATE users SET is_banned = ?, updated_at = ? WHERE telegram_id = ?',
-                           (1 if is_banned else 0, datetime.utcnow().isoformat(), str(user_id)))
+                           (1 if is_banned else 0, _now(), int(user_id)))
             conn.commit()
             conn.close()
     except Exception as e:
         logger.error(f"Error banning user {user_id}: {e}")
 
-async def check_and_update_quota(user_id):
+FREE_DAILY_LIMIT = 5
+UNLIMITED_ROLES = ('premium', 'admin', 'owner')
+
+def _is_unlimited(user: Dict) -> bool:
+    if user.get("role") == 'premium' and user.get("premium_expiry_date") and user["premium_expiry_date"] < _now():
+        return False
+    return user.get("role") in UNLIMITED_ROLES
+
+# The role list is UNLIMITED_ROLES written out as SQL
+_UNLIMITED = "(role IN ('premium', 'admin', 'owner') AND NOT (role = 'premium' AND premium_expiry_date IS NOT NULL AND premium_expiry_date < :now))"
+_USED_TODAY = "CASE WHEN last_download_date IS :today THEN downloads_today ELSE 0 END"
+_GRANT = f"CASE WHEN {_UNLIMITED} THEN :n ELSE MIN(:n, MAX(:limit - ({_USED_TODAY}), 0)) END"
+
+# Every SET expression sees the row as it was before the update, so the
+# daily reset and the grant judge the same state. Expired premium users are
+# treated as free here but left for the expiry sweeper to downgrade.
+_RESERVE_QUOTA_SQL = f'''
+    UPDATE users SET
+        last_quota_grant = {_GRANT},
+        downloads_today = ({_USED_TODAY}) + {_GRANT},
+        last_download_date = :today
+    WHERE telegram_id = :user_id AND is_banned = 0
+    RETURNING last_quota_grant, {_UNLIMITED} AS unlimited
+'''
+
+@_timed
+async def reserve_quota(user_id, n=1):
+    """Atomically take up to n of today's download slots.
+
+    One UPDATE ... RETURNING resets the counter on a new day and adds
+    min(n, what's left), so concurrent
+    requests can't both pass the limit. Returns (granted, unlimited);
+    banned or unknown users get (0, False). Hand unused slots back with
+    refund_quota.
+    """
     try:
-        user = await get_user(user_id)
-        if not user:
-            return False, "User not found."
-        
-        if user.get("is_banned"):
-            return False, "You are banned from using this bot."
-        
-        today = datetime.utcnow().date().isoformat()
-        
-        if user.get("role") == 'premium' and user.get("premium_expiry_date"):
-            if user["premium_expiry_date"] < today:
-                await set_user_role(user_id, "free")
-                user["role"] = "free"
-        
-        if user.get("role") in ['premium', 'admin', 'owner']:
-            return True, "Unlimited"
-        
-        if user.get("last_download_date") != today:
-            async with db_lock:
-                conn = _get_connection()
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET downloads_today = 0, last_download_date = ? WHERE telegram_id = ?',
-                               (today, str(user_id)))
-                conn.commit()
-                conn.close()
-            user["downloads_today"] = 0
-        
-        if user.get("downloads_today", 0) >= 5:
-            return False, "Daily limit reached (5/5). Upgrade to Premium for unlimited downloads."
-        
-        return True, f"{user.get('downloads_today', 0)}/5"
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute(_RESERVE_QUOTA_SQL, {
+                "user_id": int(user_id), "n": n, "limit": FREE_DAILY_LIMIT, "today": _today(), "now": _now()
+            })
+            row = cursor.fetchone()
+            conn.commit()
+            conn.close()
+        if row is None:
+            return 0, False
+        return row["last_quota_grant"], bool(row["unlimited"])
     except Exception as e:
-        logger.error(f"Error checking quota for {user_id}: {e}")
-        return False, "Database error."
+        logger.error(f"Error reserving quota for {user_id}: {e}")
+        return 0, False
 
-async def increment_quota(user_id, count=1):
+@_timed
+async def refund_quota(user_id, n):
+    """Return n reserved slots, e.g. when the transfer they were taken for failed"""
+    if n <= 0:
+        return
     try:
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
-            cursor.execute('UPDATE users SET downloads_today = downloads_today + ? WHERE telegram_id = ?',
-                           (count, str(user_id)))
+            # After midnight the counter was reset, so there is nothing to give back
+            cursor.execute('''
+                UPDATE users SET downloads_today = MAX(downloads_today - ?, 0)
+                WHERE telegram_id = ? AND last_download_date = ?
+            ''', (n, int(user_id), _today()))
             conn.commit()
             conn.close()
     except Exception as e:
-        logger.error(f"Error incrementing quota for {user_id}: {e}")
+        logger.error(f"Error refunding quota for {user_id}: {e}")
 
-async def increment_ad_count(user_id):
+@_timed
+async def reserve_ad_slot(user_id, daily_limit, include_premium=False) -> bool:
+    """Count an ad impression in one statement if the user is still under the daily limit"""
     try:
-        today = datetime.utcnow().date().isoformat()
+        today = _today()
         async with db_lock:
             conn = _get_connection()
             cursor = conn.cursor()
-            cursor.execute('UPDATE users SET ads_today = ads_today + 1, last_ad_date = ? WHERE telegram_id = ?',
-                           (today, str(user_id)))
+            cursor.execute('''
+                UPDATE users
+                SET ads_today = CASE WHEN last_ad_date = ? THEN ads_today + 1 ELSE 1 END,
+                    last_ad_date = ?
+                WHERE telegram_id = ?
+                  AND is_banned = 0
+                  AND (? OR role NOT IN ('premium', 'admin', 'owner'))
+                  AND (last_ad_date IS NOT ? OR ads_today < ?)
+                RETURNING ads_today
+            ''', (today, today, int(user_id), 1 if include_premium else 0, today, daily_limit))
+            row = cursor.fetchone()
             conn.commit()
             conn.close()
+        return row is not None
     except Exception as e:
-        logger.error(f"Error incrementing ad count for {user_id}: {e}")
+        logger.error(f"Error reserving ad slot for {user_id}: {e}")
+        return False
 
-async def get_ad_count_today(user_id):
+@_timed
+async def release_ad_slot(user_id):
+    """Give back an ad slot reserved for an impression that never happened"""
     try:
-        user = await get_user(user_id)
-        if not user:
-            return 0
-        
-        today = datetime.utcnow().date().isoformat()
-        if user.get("last_ad_date") != today:
-            async with db_lock:
-                conn = _get_connection()
-                cursor = conn.cursor()
-                cursor.execute('UPDATE users SET ads_today = 0, last_ad_date = ? WHERE telegram_id = ?',
-                               (today, str(user_id)))
-                conn.commit()
-                conn.close()
-            return 0
-        return user.get("ads_today", 0)
-    except Exception as e:
-        logger.error(f"Error getting ad count for {user_id}: {e}")
-        return 0
+        today = _today()
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('UPDATE users SET ads_today = MAX(ads_today - 1, 0) WHERE telegram_id = ? AND last_ad_date = ?',
+                           (int(user_id), today))
+            conn.commit()
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error releasing ad slot for {user_id}: {e}")
 
+@_timed
 async def get_remaining_quota(user_id):
     try:
         user = await get_user(user_id)
         if not user:
             return 0, False
         
-        if user.get("role") in ['premium', 'admin', 'owner']:
+        if _is_unlimited(user):
             return 999999, True
         
-        today = datetime.utcnow().date().isoformat()
+        today = _today()
         downloads_today = user.get("downloads_today", 0)
         
         if user.get("last_download_date") != today:
             downloads_today = 0
         
-        remaining = max(0, 5 - downloads_today)
+        remaining = max(0, FREE_DAILY_LIMIT - downloads_today)
         return remaining, False
     except Exception as e:
         logger.error(f"Error getting remaining quota for {user_id}: {e}")
         return 0, False
 
+@_timed
 async def get_setting(key):
     try:
         async with db_lock:
@@ -335,6 +573,7 @@ async def get_setting(key):
         logger.error(f"Error getting setting {key}: {e}")
         return None
 
+@_timed
 async def update_setting(key, value, json_value=None):
     try:
         async with db_lock:
@@ -344,13 +583,13 @@ async def update_setting(key, value, json_value=None):
                 INSERT INTO settings (key, value, json_value, updated_at)
                 VALUES (?, ?, ?, ?)
                 ON CONFLICT(key) DO UPDATE SET value = ?, json_value = ?, updated_at = ?
-            ''', (key, value, json_value, datetime.utcnow().isoformat(),
-                  value, json_value, datetime.utcnow().isoformat()))
+            ''', (key, value, json_value, _now(), value, json_value, _now()))
             conn.commit()
             conn.close()
     except Exception as e:
         logger.error(f"Error updating setting {key}: {e}")
 
+@_timed
 async def get_all_users() -> List[Dict]:
     try:
         async with db_lock:
@@ -360,17 +599,87 @@ async def get_all_users() -> List[Dict]:
             rows = cursor.fetchall()
             conn.close()
         
-        users = []
-        for row in rows:
-            user = dict(row)
-            user['is_banned'] = bool(user['is_banned'])
-            user['is_agreed_terms'] = bool(user['is_agreed_terms'])
-            users.append(user)
-        return users
+        return [_user_row(row) for row in rows]
     except Exception as e:
         logger.error(f"Error getting all users: {e}")
         return []
 
+@_timed
+async def get_users_by_role(role) -> List[Dict]:
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE role = ?', (role,))
+            rows = cursor.fetchall()
+            conn.close()
+        return [_user_row(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting {role} users: {e}")
+        return []
+
+@_timed
+async def expire_premium_users(now=None) -> List[int]:
+    """Downgrade every premium user whose expiry has passed; returns their ids.
+
+    A single UPDATE over idx_users_premium_expiry, so it touches only the
+    expired rows no matter how many users there are.
+    """
+    now = _now() if now is None else now
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            # Without statistics the planner would rather scan every premium user through idx_users_role
+            cursor.execute('''
+                UPDATE users INDEXED BY idx_users_premium_expiry
+                SET role = 'free', premium_expiry_date = NULL, updated_at = ?
+                WHERE premium_expiry_date IS NOT NULL AND premium_expiry_date <= ? AND role = 'premium'
+                RETURNING telegram_id
+            ''', (now, now))
+            rows = cursor.fetchall()
+            conn.commit()
+            conn.close()
+        return [row[0] for row in rows]
+    except Exception as e:
+        logger.error(f"Error expiring premium users: {e}")
+        return []
+
+@_timed
+async def next_premium_expiry() -> Optional[int]:
+    """Earliest pending premium expiry, read from the front of idx_users_premium_expiry"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT premium_expiry_date FROM users INDEXED BY idx_users_premium_expiry
+                WHERE premium_expiry_date IS NOT NULL AND role = 'premium'
+                ORDER BY premium_expiry_date LIMIT 1
+            ''')
+            row = cursor.fetchone()
+            conn.close()
+        return row[0] if row else None
+    except Exception as e:
+        logger.error(f"Error reading next premium expiry: {e}")
+        return None
+
+@_timed
+async def get_active_user_ids() -> List[int]:
+    """Ids of every user who isn't banned, read from the partial index alone"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('SELECT telegram_id FROM users WHERE is_banned = 0')
+            rows = cursor.fetchall()
+            conn.close()
+        return [row[0] for row in rows]
+    except Exception as e:
+        logger.error(f"Error getting active user ids: {e}")
+        return []
+
+@_timed
 async def get_user_count():
     try:
         async with db_lock:
@@ -383,3 +692,263 @@ async def get_user_count():
     except Exception as e:
         logger.error(f"Error getting user count: {e}")
         return 0
+
+@_timed
+async def enqueue_job(user_id, link, status_chat_id, status_message_id) -> Optional[int]:
+    try:
+        now = _now()
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO jobs (user_id, link, status_chat_id, status_message_id, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (int(user_id), link, int(status_chat_id), int(status_message_id), now, now))
+            job_id = cursor.lastrowid
+            conn.commit()
+            conn.close()
+        return job_id
+    except Exception as e:
+        logger.error(f"Error enqueuing job for {user_id}: {e}")
+        return None
+
+@_timed
+async def claim_jobs(owner, limit, lease_seconds) -> List[Dict]:
+    """Lease up to limit jobs to owner, oldest first, in one UPDATE ... RETURNING.
+
+    Takes pending jobs and running jobs whose lease ran out, i.e. whose
+    process died; each claim counts as an attempt.
+    """
+    if limit <= 0:
+        return []
+    try:
+        now = _now()
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET state = 'running', owner = :owner, lease_until = :lease_until,
+                                attempts = attempts + 1, updated_at = :now
+                WHERE id IN (
+                    SELECT id FROM jobs
+                    WHERE state IN ('pending', 'running')
+                      AND (state = 'pending' OR (lease_until < :now AND owner IS NOT :owner))
+                    ORDER BY id LIMIT :limit
+                )
+                RETURNING *
+            ''', {"owner": owner, "lease_until": now + lease_seconds, "now": now, "limit": limit})
+            rows = cursor.fetchall()
+            conn.commit()
+            conn.close()
+        return sorted((dict(row) for row in rows), key=lambda job: job["id"])
+    except Exception as e:
+        logger.error(f"Error claiming jobs: {e}")
+        return []
+
+@_timed
+async def hold_job_quota(job_id, n):
+    """Record the n slots job_id holds right now, taken today"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute(
+                'UPDATE jobs SET quota_held = ?, quota_date = ? WHERE id = ?', (n, _today(), int(job_id))
+            )
+            conn.commit()
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error recording quota of job {job_id}: {e}")
+
+@_timed
+async def refund_job_quota(job_id) -> int:
+    """Give back the slots an interrupted run of job_id left reserved; returns how many.
+
+    Only slots taken on the user's current counter day are returned, since
+    a new day already reset them.
+    """
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            row = cursor.execute(
+                'SELECT user_id, quota_held, quota_date FROM jobs WHERE id = ?', (int(job_id),)
+            ).fetchone()
+            refunded = 0
+            if row and row["quota_held"] > 0:
+                cursor.execute('''
+                    UPDATE users SET downloads_today = MAX(downloads_today - ?, 0)
+                    WHERE telegram_id = ? AND last_download_date = ?
+                ''', (row["quota_held"], row["user_id"], row["quota_date"]))
+                refunded = row["quota_held"] if cursor.rowcount else 0
+                cursor.execute('UPDATE jobs SET quota_held = 0 WHERE id = ?', (int(job_id),))
+            conn.commit()
+            conn.close()
+        return refunded
+    except Exception as e:
+        logger.error(f"Error refunding quota of job {job_id}: {e}")
+        return 0
+
+@_timed
+async def renew_job_leases(owner, lease_seconds) -> int:
+    """Extend the lease of every job owner is running"""
+    try:
+        now = _now()
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET lease_until = ?, updated_at = ?
+                WHERE state IN ('pending', 'running') AND state = 'running' AND owner = ?
+            ''', (now + lease_seconds, now, owner))
+            renewed = cursor.rowcount
+            conn.commit()
+            conn.close()
+        return renewed
+    except Exception as e:
+        logger.error(f"Error renewing job leases: {e}")
+        return 0
+
+@_timed
+async def finish_job(job_id, state, error=None):
+    """Mark a job done or failed; it is kept until prune_jobs removes it"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET state = ?, error = ?, owner = NULL, lease_until = 0, updated_at = ?
+                WHERE id = ?
+            ''', (state, error, _now(), int(job_id)))
+            conn.commit()
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error finishing job {job_id}: {e}")
+
+@_timed
+async def release_jobs(owner) -> int:
+    """Hand owner's running jobs back to the queue, e.g. on a clean shutdown"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET state = 'pending', owner = NULL, lease_until = 0, updated_at = ?
+                WHERE state IN ('pending', 'running') AND state = 'running' AND owner = ?
+            ''', (_now(), owner))
+            released = cursor.rowcount
+            conn.commit()
+            conn.close()
+        return released
+    except Exception as e:
+        logger.error(f"Error releasing jobs: {e}")
+        return 0
+
+@_timed
+async def cancel_pending_jobs(user_id=None) -> List[Dict]:
+    """Fail jobs nobody has claimed yet, for one user or everyone; returns them"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                UPDATE jobs SET state = 'failed', error = 'cancelled', updated_at = ?
+                WHERE state IN ('pending', 'running') AND state = 'pending' AND (? IS NULL OR user_id = ?)
+                RETURNING id, user_id, status_chat_id, status_message_id
+            ''', (_now(), user_id, user_id))
+            rows = cursor.fetchall()
+            conn.commit()
+            conn.close()
+        return [dict(row) for row in rows]
+    except Exception as e:
+        logger.error(f"Error cancelling pending jobs: {e}")
+        return []
+
+@_timed
+async def prune_jobs(older_than) -> int:
+    """Delete finished jobs last touched before older_than"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (older_than,))
+            deleted = cursor.rowcount
+            conn.commit()
+            conn.close()
+        return deleted
+    except Exception as e:
+        logger.error(f"Error pruning jobs: {e}")
+        return 0
+
+@_timed
+async def count_open_jobs() -> Dict[str, int]:
+    """Pending and running job counts, read from idx_jobs_open"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute("SELECT state, COUNT(*) FROM jobs WHERE state IN ('pending', 'running') GROUP BY state")
+            rows = cursor.fetchall()
+            conn.close()
+        return {row[0]: row[1] for row in rows}
+    except Exception as e:
+        logger.error(f"Error counting jobs: {e}")
+        return {}
+
+@_timed
+async def get_archived(source_chat_id, source_message_id) -> Optional[Dict]:
+    """The dump channel copy of a source message, with dump_message_ids as a list"""
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT file_unique_id, dump_chat_id, dump_message_ids FROM archive
+                WHERE source_chat_id = ? AND source_message_id = ?
+            ''', (int(source_chat_id), int(source_message_id)))
+            row = cursor.fetchone()
+            conn.close()
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["dump_message_ids"] = [int(i) for i in entry["dump_message_ids"].split(",")]
+        return entry
+    except Exception as e:
+        logger.error(f"Error reading archive entry {source_chat_id}/{source_message_id}: {e}")
+        return None
+
+@_timed
+async def save_archived(entries):
+    """Record a batch of (source_chat_id, source_message_id, file_unique_id, dump_chat_id, dump_message_ids)"""
+    try:
+        now = _now()
+        rows = [
+            (int(chat_id), int(message_id), unique_id, int(dump_chat_id), ",".join(str(i) for i in dump_ids), now)
+            for chat_id, message_id, unique_id, dump_chat_id, dump_ids in entries
+        ]
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.executemany('''
+                INSERT OR REPLACE INTO archive (source_chat_id, source_message_id, file_unique_id,
+                                                dump_chat_id, dump_message_ids, created_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', rows)
+            conn.commit()
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error saving {len(entries)} archive entries: {e}")
+
+@_timed
+async def delete_archived(source_chat_id, source_message_id):
+    try:
+        async with db_lock:
+            conn = _get_connection()
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM archive WHERE source_chat_id = ? AND source_message_id = ?',
+                           (int(source_chat_id), int(source_message_id)))
+            conn.commit()
+            conn.close()
+    except Exception as e:
+        logger.error(f"Error deleting archive entry {source_chat_id}/{source_message_id}: {e}")
@@ -0,0 +1,181 @@
+import os
+import time
+import shutil
+import asyncio
+import logging
+from typing import Dict, Optional
+from bot.config import DISK_QUOTA_GB, DISK_MIN_FREE_MB, DISK_RESERVE_TIMEOUT, DISK_SWEEP_INTERVAL, DISK_ORPHAN_AGE
+from bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+DOWNLOAD_DIR = "downloads/"
+MB = 1024 * 1024
+GB = 1024 * MB
+
+DISK_RESERVED = REGISTRY.gauge("bot_disk_reserved_bytes", "Disk space reserved by downloads in progress or awaiting upload")
+DISK_USED = REGISTRY.gauge("bot_disk_download_dir_bytes", "Bytes currently in the downloads directory")
+DISK_FREE = REGISTRY.gauge("bot_disk_free_bytes", "Free bytes on the downloads volume")
+DISK_WAITERS = REGISTRY.gauge("bot_disk_waiters", "Downloads queued for disk space")
+DISK_REFUSED = REGISTRY.counter("bot_disk_refused_total", "Downloads refused for lack of disk space")
+DISK_SWEPT = REGISTRY.counter("bot_disk_swept_bytes_total", "Bytes of orphaned files removed by the janitor")
+
+class DiskFull(Exception):
+    """No disk space could be reserved for a download in time"""
+
+class Reservation:
+    """Space set aside for one download; `path` is its target, or None until known.
+
+    The downloader adds to `written` as bytes land on disk, so admission
+    knows how much of the reservation still needs free space.
+    """
+    __slots__ = ("nbytes", "path", "written")
+
+    def __init__(self, nbytes: int, path: Optional[str] = None):
+        self.nbytes = nbytes
+        self.path = path
+        self.written = 0
+
+def worker_directory(index: int) -> str:
+    """Each transfer worker keeps its downloads, reservations and janitor in its own subdirectory.
+
+    _dir_usage() only looks at files directly in a directory, so the bot's
+    janitor never touches files a worker is still uploading.
+    """
+    return os.path.join(DOWNLOAD_DIR, f"worker_{index}/")
+
+def _dir_usage(directory: str) -> Dict[str, os.stat_result]:
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    try:
+                        files[entry.path] = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        pass
+    except FileNotFoundError:
+        pass
+    return files
+
+class DiskManager:
+    """Admission control and janitor for the downloads directory.
+
+    Every disk download reserves its file_size before the first byte is
+    written and holds it until the file is discarded. A reservation is
+    granted while the total stays under the quota (DISK_QUOTA_GB, or the
+    volume itself when 0) and the volume keeps DISK_MIN_FREE_MB free after
+    the unwritten part of every reservation lands; otherwise it queues, and
+    gives up with DiskFull after DISK_RESERVE_TIMEOUT seconds.
+
+    Free space is only checked against this process's reservations, so
+    transfer workers need DISK_QUOTA_GB set to stay within the volume
+    together (bot.workers refuses to start them without it).
+    """
+
+    def __init__(self, directory: str, quota_bytes: int, min_free_bytes: int):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self.min_free_bytes = min_free_bytes
+        self.reserved = 0
+        self._reservations = set()
+        self._changed = asyncio.Condition()
+        self._waiters = 0
+
+    def _free(self) -> int:
+        try:
+            return shutil.disk_usage(self.directory).free
+        except FileNotFoundError:
+            os.makedirs(self.directory, exist_ok=True)
+            return shutil.disk_usage(self.directory).free
+
+    def _fits(self, nbytes: int) -> bool:
+        if self.quota_bytes and self.reserved + nbytes > self.quota_bytes:
+            return False
+        # Reserved files are partly on disk already; only their remainder still needs room
+        pending = sum(r.nbytes - min(r.written, r.nbytes) for r in self._reservations)
+        return pending + nbytes + self.min_free_bytes <= self._free()
+
+    async def reserve(self, nbytes: int, path: Optional[str] = None, timeout: float = DISK_RESERVE_TIMEOUT) -> Reservation:
+        nbytes = max(0, nbytes)
+        path = os.path.normpath(path) if path else None
+        async with self._changed:
+            if not self._fits(nbytes):
+                self._waiters += 1
+                try:
+                    await asyncio.wait_for(self._changed.wait_for(lambda: self._fits(nbytes)), timeout)
+                except asyncio.TimeoutError:
+                    DISK_REFUSED.inc()
+                    raise DiskFull(f"No room for {nbytes / MB:.1f} MB in {self.directory}")
+                finally:
+                    self._waiters -= 1
+            reservation = Reservation(nbytes, path)
+            self._reservations.add(reservation)
+            self.reserved += nbytes
+        return reservation
+
+    def release(self, reservation: Reservation):
+        if reservation not in self._reservations:
+            return
+        self._reservations.discard(reservation)
+        self.reserved -= reservation.nbytes
+        asyncio.get_event_loop().create_task(self._notify())
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    def _held(self, path: str) -> bool:
+        # Parallel downloads write <path>.<hex>.temp next to their target
+        return any(r.path and (path == r.path or path.startswith(r.path + ".")) for r in self._reservations)
+
+    def sweep(self, max_age: float = DISK_ORPHAN_AGE) -> int:
+        """Delete files no reservation owns that haven't been written for max_age seconds"""
+        now = time.time()
+        removed = 0
+        for path, st in _dir_usage(self.directory).items():
+            if self._held(os.path.normpath(path)) or now - st.st_mtime < max_age:
+                continue
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Janitor could not remove {path}: {e}")
+                continue
+            removed += st.st_size
+        if removed:
+            DISK_SWEPT.inc(removed)
+            logger.info(f"Janitor removed {removed / MB:.1f} MB of orphaned downloads")
+            asyncio.get_event_loop().create_task(self._notify())
+        return removed
+
+    async def janitor(self, interval: int = DISK_SWEEP_INTERVAL):
+        """Sweep everything once at startup (nothing can own a file yet), then orphans periodically"""
+        self.sweep(max_age=0)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Disk janitor error: {e}")
+
+    def snapshot(self) -> Dict:
+        usage = shutil.disk_usage(self.directory) if os.path.isdir(self.directory) else None
+        return {
+            "reserved": self.reserved,
+            "quota": self.quota_bytes,
+            "used": sum(st.st_size for st in _dir_usage(self.directory).values()),
+            "free": usage.free if usage else 0,
+            "total": usage.total if usage else 0,
+            "waiting": self._waiters,
+        }
+
+disk = DiskManager(DOWNLOAD_DIR, int(DISK_QUOTA_GB * GB), int(DISK_MIN_FREE_MB * MB))
+
+def _collect_disk_metrics():
+    snapshot = disk.snapshot()
+    DISK_RESERVED.set(snapshot["reserved"])
+    DISK_USED.set(snapshot["used"])
+    DISK_FREE.set(snapshot["free"])
+    DISK_WAITERS.set(snapshot["waiting"])
+
+REGISTRY.add_collector(_collect_disk_metrics)
@@ -1,26 +1,38 @@
 import asyncio
-import os
 import time
 import io
 import aiofiles
 import re
 import logging
+import functools
+import collections
 from pyrogram import filters, Client
 from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from pyrogram.errors import FloodWait
 from bot.config import (
     app, API_ID, API_HASH, active_downloads, global_download_semaphore, 
-    OWNER_ID, global_upload_semaphore, cancel_flags
+    OWNER_ID, global_upload_semaphore, ALBUM_PARALLEL_DOWNLOADS
+)
+from bot.metrics import (
+    REGISTRY, RPC_SECONDS, DOWNLOAD_QUEUE, ACTIVE_DOWNLOADS, cache_hit
 )
 
 # Session caching dictionary: {user_id: {"client": Client, "last_used": timestamp}}
 user_clients = {}
+# Requests currently using each user's cached client
+_client_requests = collections.Counter()
 
-async def get_user_client(user_id, session_str):
+async def get_user_client(user_id):
     now = time.time()
+    cache_hit("user_client", user_id in user_clients)
     if user_id in user_clients:
         user_clients[user_id]["last_used"] = now
         return user_clients[user_id]["client"]
-    
+
+    # Sessions are stored encrypted and only decrypted when a client actually has to start
+    session_str = await get_session_string(user_id)
+    if not session_str:
+        return None
     client = Client(
         f"user_{user_id}",
         session_string=session_str,
@@ -28,32 +40,94 @@ async def get_user_client(user_id, session_str):
         api_hash=API_HASH,
         in_memory=True
     )
+    install_gateway(client)
     await client.start()
-    user_clients[user_id] = {"client": client, "last_used": now}
-    
-    # Start cleanup task if not already running
-    asyncio.create_task(cleanup_user_clients())
+    _cache_user_client(user_id, client)
     return client
 
+_cleanup_task = None
+
+def _cache_user_client(user_id, client):
+    global _cleanup_task
+    user_clients[user_id] = {"client": client, "last_used": time.time()}
+    # Start cleanup task if not already running
+    if _cleanup_task is None or _cleanup_task.done():
+        _cleanup_task = asyncio.create_task(cleanup_user_clients())
+
+def adopt_user_client(user_id, client):
+    """Cache a client /login just signed in, so the user's first download doesn't reconnect"""
+    previous = user_clients.get(user_id)
+    _cache_user_client(user_id, client)
+    if previous and previous["client"] is not client:
+        asyncio.create_task(previous["client"].stop())
+
+async def drop_user_client(user_id):
+    """Stop and forget the user's cached client, e.g. after /logout, so nothing keeps using the session"""
+    data = user_clients.pop(user_id, None)
+    if data is None:
+        return
+    try:
+        await data["client"].stop()
+    except Exception:
+        pass
+
+async def _release_user_client(user_id):
+    """A request is done with the user's cached client.
+
+    Transfer workers start their own client on the same session, so in
+    worker mode this process only keeps it while a request of the user
+    still needs it, instead of a second live copy idling for ten minutes.
+    """
+    _client_requests[user_id] -= 1
+    if _client_requests[user_id] <= 0:
+        del _client_requests[user_id]
+        if transfer_workers.enabled:
+            await drop_user_client(user_id)
+
+async def evict_user_clients(max_idle) -> int:
+    """Stop cached clients unused for max_idle seconds, except those a running request is using"""
+    now = time.time()
+    to_remove = [
+        user_id for user_id, data in user_clients.items()
+        if now - data["last_used"] > max_idle and user_id not in active_downloads and user_id not in _client_requests
+    ]
+    for user_id in to_remove:
+        client = user_clients.pop(user_id)["client"]
+        try:
+            await client.stop()
+        except:
+            pass
+    return len(to_remove)
+
 async def cleanup_user_clients():
     while True:
         await asyncio.sleep(60)
-        now = time.time()
-        to_remove = []
-        for user_id, data in user_clients.items():
-            if now - data["last_used"] > 600: # 10 minutes
-                to_remove.append(user_id)
-        
-        for user_id in to_remove:
-            client = user_clients.pop(user_id)["client"]
-            try:
-                await client.stop()
-            except:
-                pass
+        await evict_user_clients(600) # 10 minutes
+
+CACHED_USER_CLIENTS = REGISTRY.gauge("bot_cached_user_clients", "Started user clients kept in the session cache")
+
+def _collect_download_metrics():
+    ACTIVE_DOWNLOADS.set(len(active_downloads))
+    CACHED_USER_CLIENTS.set(len(user_clients))
 
-from bot.database import get_user, check_and_update_quota, increment_quota, get_setting, get_remaining_quota
+REGISTRY.add_collector(_collect_download_metrics)
+
+from bot.database import (
+    get_user, get_setting, reserve_quota, refund_quota, hold_job_quota, get_session_string, FREE_DAILY_LIMIT
+)
 from bot.ads import show_ad
-from bot.transfer import download_media_fast, upload_media_fast
+from bot.transfer import download_media_fast, send_album, combined_progress, discard
+from bot.tracing import start_trace
+from bot.singleflight import transfers_in_flight
+from bot.thumbnails import fetch_thumb, complete_video_meta, is_video
+from bot.disk import DiskFull
+from bot.cancellation import cancellations, Cancelled
+from bot.workers import transfer_workers
+from bot.jobs import transfer_jobs
+from bot.rpc import install as install_gateway, patience
+from bot.archive import archiver, file_unique_id
+
+UPGRADE_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("💎 Upgrade to Premium", callback_data="upgrade_prompt")]])
 
 async def progress_bar(current, total, message, type_msg):
     if total == 0:
@@ -128,7 +202,9 @@ async def progress_bar(current, total, message, type_msg):
     else:
         data["last_edit"] = now
         try:
-            await message.edit_text(text)
+            # A progress edit that would have to wait is skipped; the next tick brings a fresher one
+            with patience(0):
+                await message.edit_text(text)
         except Exception:
             pass
 
@@ -159,7 +235,7 @@ async def help_command(client, message):
         "📦 **Batch**\n"
         "Format: `/batch start_link end_link` (Max 50)\n\n"
         "💰 **Quota**\n"
-        "Free users: 5 files/day\n"
+        f"Free users: {FREE_DAILY_LIMIT} files/day\n"
         "Premium users: Unlimited"
     )
     await message.reply(help_text)
@@ -213,7 +289,17 @@ async def batch_handler(client, message):
 async def download_handler(client, message, link_override=None):
     user_id = message.from_user.id
     link = link_override or message.text.strip()
-    
+    status_msg = await message.reply("⏳ Processing...")
+    # The job table keeps the request across restarts; run it here only if it couldn't be stored
+    if not await transfer_jobs.submit(user_id, link, status_msg):
+        await process_link(client, user_id, link, status_msg)
+
+async def process_link(client, user_id, link, status_msg, job_id=None):
+    """Everything one link needs, reported in status_msg; returns the request's trace status.
+
+    job_id is the queued job the request runs for; the slots it holds are
+    recorded there so a run the bot didn't finish can be refunded.
+    """
     chat_id = None
     message_id = None
     
@@ -232,6 +318,7 @@ async def download_handler(client, message, link_override=None):
     is_private = False
     is_group = False
     is_story = False
+    trace = start_trace(user_id, link)
 
     if private_story_match:
         chat_id = int("-100" + private_story_match.group(1))
@@ -275,7 +362,8 @@ async def download_handler(client, message, link_override=None):
         chat_id = public_match.group(1)
         message_id = int(public_match.group(2))
         try:
-            chat = await asyncio.wait_for(client.get_chat(chat_id), timeout=10)
+            with RPC_SECONDS.time(method="get_chat"), trace.span("get_chat"):
+                chat = await asyncio.wait_for(client.get_chat(chat_id), timeout=10)
             chat_type_str = str(chat.type).lower()
             if "group" in chat_type_str:
                 is_group = True
@@ -284,155 +372,401 @@ async def download_handler(client, message, link_override=None):
         except:
             pass
 
-    status_msg = await message.reply("⏳ Processing...")
     user = await get_user(user_id)
-    
-    if (is_private or is_group) and (not user or not user.get('phone_session_string')):
+
+    if not user:
+        trace.finish("unregistered")
+        await status_msg.edit_text("❌ Please /start the bot first.")
+        return trace.status
+
+    if (is_private or is_group) and not user.get('has_session'):
+        trace.finish("login_required")
         await status_msg.edit_text("❌ Login is required for private links. Use /login.")
-        return
+        return trace.status
 
-    await global_download_semaphore.acquire()
-    active_downloads.add(user_id)
+    hold = await QuotaHold.reserve(user_id, job_id)
+    if not hold.granted:
+        if user.get("is_banned"):
+            trace.finish("banned")
+            await status_msg.edit_text("❌ You are banned from using this bot.")
+        else:
+            trace.finish("quota_exceeded")
+            await status_msg.edit_text(DAILY_LIMIT_TEXT, reply_markup=UPGRADE_MARKUP)
+        return trace.status
+
+    trace.set(private=is_private, group=is_group, story=is_story)
     user_client = None
 
+    # /cancel and /killall fire this token; it covers the queue wait as well as the transfer
+    with cancellations.open(user_id) as token:
+        try:
+            if is_private or is_group or is_story:
+                if user.get('has_session'):
+                    with trace.span("user_client", cached=user_id in user_clients):
+                        user_client = await get_user_client(user_id)
+                    if user_client:
+                        _client_requests[user_id] += 1
+            else:
+                user_client = client
+
+            if not user_client:
+                trace.status = "session_error"
+                await status_msg.edit_text("❌ Session error. Please /login again.")
+                return trace.status
+
+            try:
+                with RPC_SECONDS.time(method="get_messages"), trace.span("get_messages"):
+                    msg = await user_client.get_messages(chat_id, message_id)
+            except FloodWait as e:
+                trace.status = "flood_wait"
+                await status_msg.edit_text(FLOOD_TEXT.format(e.value))
+                return trace.status
+            except Exception as e:
+                trace.status = "fetch_error"
+                await status_msg.edit_text(f"❌ Error fetching message: {str(e)}")
+                return trace.status
+        
+            if not msg or not msg.media:
+                trace.status = "no_media"
+                await status_msg.edit_text("❌ No media found in link.")
+                return trace.status
+
+            # Everyone asking for the same message while it's in flight shares one transfer.
+            # The key uses the resolved chat id so @name and numeric links coalesce too.
+            key = (msg.chat.id if msg.chat else chat_id, msg.id)
+            direct = not is_private and not is_group and not is_story
+            deliver = functools.partial(
+                _deliver, client, user_client, user_id, msg, chat_id, message_id, direct, status_msg, trace, token, hold
+            )
+            unique_id = file_unique_id(msg)
+            # A file downloaded before is copied from the dump channel instead of fetched again
+            sent = await _deliver_archived(client, user_id, key, unique_id, trace, hold)
+            for _ in range(0 if sent else 2):
+                if transfers_in_flight.running(key):
+                    await status_msg.edit_text("⏳ This file is already being fetched for someone else, sharing it...")
+                with trace.span("dedup", joined=transfers_in_flight.running(key)):
+                    result, shared = await token.race(transfers_in_flight.do(key, deliver))
+                if not shared:
+                    sent = result.messages if result else None
+                    if result and result.complete and trace.status == "ok":
+                        # Only re-uploads are worth archiving; copies from public channels are already cheap
+                        archiver.submit(key[0], key[1], unique_id, user_id, [m.id for m in sent])
+                    break
+                if result:
+                    sent = await _share_delivery(client, user_id, result, trace, hold)
+                    if sent:
+                        break
+                # The transfer we joined failed or fell short of our quota; try once more on our own
+            else:
+                if not sent:
+                    await status_msg.edit_text("❌ The shared transfer for this file failed. Please send the link again.")
+
+            if sent:
+                hold.used = len(sent)
+                await status_msg.delete()
+        except Cancelled:
+            # Everything is released by now; don't count the status edit as abort time
+            token.finish()
+            trace.status = "cancelled"
+            await status_msg.edit_text("🛑 Download cancelled.")
+        except Exception as e:
+            trace.status = f"error: {type(e).__name__}"
+            await status_msg.edit_text(f"❌ Outer Error: {str(e)}")
+        finally:
+            # Slots reserved for anything that wasn't delivered go back to the user
+            await hold.settle()
+            if user_client is not None and user_client is not client:
+                await _release_user_client(user_id)
+            trace.finish()
+    return trace.status
+
+# What a transfer handed to its requester; complete is False when an album was cut short by quota
+Delivery = collections.namedtuple("Delivery", ["messages", "complete"])
+
+DAILY_LIMIT_TEXT = "❌ Daily limit reached. Upgrade to Premium for unlimited downloads."
+FLOOD_TEXT = "⏳ Telegram is rate-limiting the bot right now. Please send the link again in {} seconds."
+
+class QuotaHold:
+    """Download slots reserved up front for one request.
+
+    The first slot is taken before anything is fetched; albums extend the
+    hold to their size, and whatever isn't marked used is refunded by
+    settle(), so failed or cancelled transfers don't cost the user. A hold
+    taken for a queued job mirrors its size into the job's row, since
+    settle() never runs if the process dies mid-transfer.
+    """
+
+    def __init__(self, user_id, granted, unlimited, job_id=None):
+        self.user_id = user_id
+        self.granted = granted
+        self.unlimited = unlimited
+        self.job_id = job_id
+        self.used = 0
+
+    @classmethod
+    async def reserve(cls, user_id, job_id=None):
+        granted, unlimited = await reserve_quota(user_id, 1)
+        hold = cls(user_id, granted, unlimited, job_id)
+        await hold._record()
+        return hold
+
+    async def _record(self):
+        if self.job_id is not None and not self.unlimited:
+            await hold_job_quota(self.job_id, self.granted - self.used)
+
+    async def extend(self, total):
+        """Grow the hold towards total items; returns how many may be delivered"""
+        if self.unlimited or total <= self.granted:
+            return total
+        more, _ = await reserve_quota(self.user_id, total - self.granted)
+        self.granted += more
+        if more:
+            await self._record()
+        return self.granted
+
+    async def settle(self):
+        unused, self.granted = self.granted - self.used, self.used
+        if unused > 0 and not self.unlimited:
+            await refund_quota(self.user_id, unused)
+        # Delivered slots are spent for good; a resumed run must not refund them
+        await self._record()
+
+async def _deliver_archived(client, user_id, key, unique_id, trace, hold):
+    """Copy an archived file from the dump channel; None when there is no usable copy"""
+    entry = await archiver.lookup(key[0], key[1], unique_id)
+    if entry is None:
+        return None
+    dump_ids = entry["dump_message_ids"]
+    allowed = await hold.extend(len(dump_ids))
     try:
-        if is_private or is_group or is_story:
-            session_str = user.get('phone_session_string') if user else None
-            if session_str:
-                user_client = await get_user_client(user_id, session_str)
+        with trace.span("archive_copy", items=allowed):
+            sent = await client.forward_messages(user_id, entry["dump_chat_id"], dump_ids[:allowed], send_copy=True)
+    except Exception as e:
+        # Deleted from the channel, or the bot lost access; fetch it the normal way and archive it again
+        logging.warning(f"Archived copy of {key} unusable: {e}")
+        await archiver.forget(*key)
+        return None
+    sent = sent if isinstance(sent, list) else [sent]
+    if not sent:
+        await archiver.forget(*key)
+        return None
+    if allowed < len(dump_ids):
+        await _notify_partial(client, user_id, len(sent), len(dump_ids))
+    trace.status = "archived"
+    return sent
+
+async def _notify_partial(client, user_id, delivered, total):
+    try:
+        await client.send_message(
+            user_id,
+            f"⚠️ Only {delivered} of {total} files were sent because your daily limit was reached.",
+            reply_markup=UPGRADE_MARKUP
+        )
+    except Exception as e:
+        logging.debug(f"Partial album notice failed: {e}")
+
+async def _share_delivery(client, user_id, delivery, trace, hold):
+    """Give a follower their own copy of what the leader's transfer delivered, within their quota"""
+    messages = delivery.messages
+    allowed = await hold.extend(len(messages))
+    if allowed < len(messages):
+        messages = messages[:allowed]
+    elif not delivery.complete:
+        # The leader only got part of the album; this user may be entitled to more
+        return None
+    if not messages:
+        return None
+
+    trace.set(dedup="follower")
+    with trace.span("copy_shared", items=len(messages)):
+        if len(messages) > 1 and len(messages) == len(delivery.messages):
+            sent = await client.copy_media_group(chat_id=user_id, from_chat_id=messages[0].chat.id, message_id=messages[0].id)
         else:
-            user_client = client
+            sent = [await m.copy(chat_id=user_id) for m in messages]
+    if len(messages) < len(delivery.messages):
+        await _notify_partial(client, user_id, len(messages), len(delivery.messages))
+    trace.status = "shared"
+    return sent
+
+def _album_item(member, path, thumb=None):
+    """send_album item for one downloaded media group member"""
+    if member.photo:
+        kind, media = "photo", member.photo
+    elif member.video:
+        kind, media = "video", member.video
+    elif member.audio:
+        kind, media = "audio", member.audio
+    else:
+        kind, media = "document", member.document
+    return {
+        "path": path,
+        "kind": kind,
+        "caption": str(member.caption) if member.caption else "",
+        "caption_entities": member.caption_entities,
+        "thumb": thumb,
+        "duration": getattr(media, "duration", 0) or 0,
+        "width": getattr(media, "width", 0) or 0,
+        "height": getattr(media, "height", 0) or 0,
+        "file_name": getattr(media, "file_name", None),
+        "mime_type": getattr(media, "mime_type", None),
+    }
+
+async def _deliver_album(client, user_client, user_id, msg, chat_id, status_msg, trace, token, hold):
+    """Download every member of msg's media group concurrently and re-send them as one album"""
+    with RPC_SECONDS.time(method="get_media_group"), trace.span("get_media_group"):
+        group = await user_client.get_media_group(chat_id, msg.id)
+    group = [m for m in group if m.photo or m.video or m.audio or m.document]
+    total = len(group)
+
+    # Partial quota: free users get as many members as they have downloads left
+    group = group[:await hold.extend(total)]
+    if not group:
+        trace.status = "quota_exceeded"
+        await status_msg.edit_text(DAILY_LIMIT_TEXT, reply_markup=UPGRADE_MARKUP)
+        return None
+
+    paths = []
+    try:
+        size = sum(getattr(m.photo or m.video or m.audio or m.document, "file_size", 0) or 0 for m in group)
+        part = combined_progress(progress_bar, size, (status_msg, f"📥 Downloading album ({len(group)} files)"))
+        limit = asyncio.Semaphore(max(1, ALBUM_PARALLEL_DOWNLOADS))
+
+        async def fetch(index, member):
+            async with limit:
+                media = member.video or member.document or member.audio
+                thumb_task = asyncio.create_task(fetch_thumb(user_client, media)) if media and media.thumbs else None
+                try:
+                    path = await download_media_fast(user_client, member, None, progress_callback=part(index), cancel_token=token)
+                    if path:
+                        paths.append(path)
+                    return path, (await thumb_task if thumb_task else None)
+                finally:
+                    if thumb_task and not thumb_task.done():
+                        thumb_task.cancel()
+
+        with trace.span("album_download", items=len(group)):
+            results = await asyncio.gather(*(fetch(i, m) for i, m in enumerate(group)), return_exceptions=True)
+        token.check()
+
+        items = []
+        for member, result in zip(group, results):
+            if isinstance(result, BaseException) or not result[0]:
+                logging.warning(f"Album member {member.id} failed to download: {result}")
+                continue
+            item = _album_item(member, *result)
+            if item["kind"] == "video" or (item["kind"] == "document" and is_video(member.document)):
+                item["thumb"], meta = await complete_video_meta(
+                    item["path"], member.video or member.document, item["thumb"],
+                    {k: item[k] for k in ("duration", "width", "height")}
+                )
+                item.update(meta)
+            items.append(item)
+        if not items:
+            if all(isinstance(result, DiskFull) for result in results):
+                trace.status = "disk_full"
+                await status_msg.edit_text("⏳ The server is out of storage right now. Please try again in a few minutes.")
+                return None
+            trace.status = "download_failed"
+            await status_msg.edit_text("❌ Download failed: Media might be restricted or unavailable.")
+            return None
+
+        await status_msg.edit_text("📤 Uploading...")
+        with trace.span("album_upload", items=len(items)):
+            sent = await send_album(
+                client, user_id, items,
+                progress_callback=progress_bar,
+                progress_args=(status_msg, f"📤 Uploading album ({len(items)} files)"),
+                cancel_token=token
+            )
+        trace.status = "ok"
+    finally:
+        with trace.span("disk_cleanup"):
+            for path in paths:
+                discard(path)
 
-        if not user_client:
-            await status_msg.edit_text("❌ Session error. Please /login again.")
-            return
+    if len(group) < total:
+        await _notify_partial(client, user_id, len(group), total)
+    return Delivery(sent, len(sent) == total)
 
-        try:
-            msg = await user_client.get_messages(chat_id, message_id)
-        except Exception as e:
-            await status_msg.edit_text(f"❌ Error fetching message: {str(e)}")
-            return
-        
-        if not msg or not msg.media:
-            await status_msg.edit_text("❌ No media found in link.")
-            return
+PHASE_LABELS = {"download": "📥 Downloading", "upload": "📤 Uploading"}
+
+def _status_reporter(status_msg):
+    """relay_media progress as edits of the request's status message"""
+    async def report(current, total, phase):
+        if phase == "upload" and total == 0:
+            await status_msg.edit_text("📤 Uploading...")
+        else:
+            await progress_bar(current, total, status_msg, PHASE_LABELS[phase])
+    return report
 
+async def _deliver(client, user_client, user_id, msg, chat_id, message_id, direct, status_msg, trace, token, hold):
+    """Copy or download/re-upload msg to user_id; returns a Delivery, or None after reporting the failure"""
+    DOWNLOAD_QUEUE.inc()
+    try:
+        with trace.span("queue_wait"):
+            await global_download_semaphore.acquire()
+    finally:
+        DOWNLOAD_QUEUE.dec()
+    active_downloads.add(user_id)
+
+    try:
         # Direct extraction for public channels (no login/is_private/is_group check)
         # If it's a public channel (not is_private and not is_group and not is_story), we just forward/copy
-        if not is_private and not is_group and not is_story:
+        if direct:
             try:
                 await status_msg.edit_text("🚀 Extracting directly...")
-                if msg.media_group_id:
-                    # Handle media group (album)
-                    media_group = await user_client.get_media_group(chat_id, message_id)
-                    await client.copy_media_group(chat_id=user_id, from_chat_id=chat_id, message_id=message_id)
-                else:
-                    await msg.copy(chat_id=user_id)
-                await status_msg.delete()
-                return
+                complete = True
+                with trace.span("copy", album=bool(msg.media_group_id)):
+                    if msg.media_group_id:
+                        # Handle media group (album), trimmed to the remaining quota
+                        group = await user_client.get_media_group(chat_id, message_id)
+                        allowed = await hold.extend(len(group))
+                        if allowed >= len(group):
+                            sent = await client.copy_media_group(chat_id=user_id, from_chat_id=chat_id, message_id=message_id)
+                        else:
+                            sent = [await m.copy(chat_id=user_id) for m in group[:allowed]]
+                            complete = False
+                            await _notify_partial(client, user_id, len(sent), len(group))
+                    else:
+                        sent = [await msg.copy(chat_id=user_id)]
+                trace.status = "copied"
+                return Delivery(sent, complete)
             except Exception as e:
                 logging.error(f"Direct extraction failed: {e}")
                 # Fallback to download/upload if direct copy fails
                 await status_msg.edit_text("⚠️ Direct extraction failed, falling back to download/upload...")
 
+        if msg.media_group_id:
+            return await _deliver_album(client, user_client, user_id, msg, chat_id, status_msg, trace, token, hold)
+
         try:
-            # 1. Extract Original Thumbnail
-            thumb_path = None
-            if hasattr(msg, "video") and msg.video and msg.video.thumbs:
-                try:
-                    thumb_path = await user_client.download_media(msg.video.thumbs[-1])
-                except Exception as e:
-                    logging.debug(f"Thumb download error: {e}")
-            elif hasattr(msg, "document") and msg.document and msg.document.thumbs:
-                try:
-                    thumb_path = await user_client.download_media(msg.document.thumbs[-1])
-                except Exception as e:
-                    logging.debug(f"Thumb download error: {e}")
-
-            # 2. Extract Metadata & Fast Download main media
-            duration = 0
-            width = 0
-            height = 0
-            
-            if msg.video:
-                duration = msg.video.duration or 0
-                width = msg.video.width or 0
-                height = msg.video.height or 0
-            elif msg.document and msg.document.mime_type and msg.document.mime_type.startswith("video/"):
-                # Some videos are sent as documents
-                if hasattr(msg.document, "duration"):
-                    duration = msg.document.duration or 0
-                if hasattr(msg.document, "width"):
-                    width = msg.document.width or 0
-                if hasattr(msg.document, "height"):
-                    height = msg.document.height or 0
-
-            path = await download_media_fast(
-                user_client,
-                msg,
-                None,
-                progress_callback=progress_bar,
-                progress_args=(status_msg, "📥 Downloading")
-            )
-            if path is None:
+            sent = await transfer_workers.relay(client, user_client, user_id, msg, _status_reporter(status_msg), token)
+            if sent is None:
+                trace.status = "download_failed"
                 await status_msg.edit_text("❌ Download failed: Media might be restricted or unavailable.")
-                return
-
-            if not isinstance(path, (str, bytes, os.PathLike)):
-                await status_msg.edit_text(f"❌ Error: Invalid download path returned ({type(path)})")
-                return
-
-            # Safe caption retrieval
-            original_caption = msg.caption if msg and hasattr(msg, "caption") else ""
-            safe_caption = str(original_caption) if original_caption is not None else ""
-
-            await status_msg.edit_text("📤 Uploading...")
-            
-            # 3. Smart Upload with thumbnail and metadata
-            await upload_media_fast(
-                client,
-                user_id,
-                path,
-                caption=safe_caption,
-                thumb=thumb_path,
-                duration=duration,
-                width=width,
-                height=height,
-                progress_callback=progress_bar,
-                progress_args=(status_msg, "📤 Uploading")
-            )
-            
-            # 4. Strict Cleanup
-            if path and os.path.exists(path):
-                os.remove(path)
-            if thumb_path and os.path.exists(thumb_path):
-                os.remove(thumb_path)
-            
-            await status_msg.delete()
-
+                return None
+            trace.status = "ok"
+            return Delivery([sent], True)
+
+        except Cancelled:
+            raise
+        except DiskFull as e:
+            logging.warning(f"Download refused: {e}")
+            trace.status = "disk_full"
+            await status_msg.edit_text("⏳ The server is out of storage right now. Please try again in a few minutes.")
+            return None
+        except FloodWait as e:
+            trace.status = "flood_wait"
+            await status_msg.edit_text(FLOOD_TEXT.format(e.value))
+            return None
         except Exception as e:
+            trace.status = f"error: {type(e).__name__}"
             await status_msg.edit_text(f"❌ Error: {str(e)}")
-        finally:
-            # Emergency cleanup
-            try:
-                if 'path' in locals() and path and os.path.exists(path):
-                    os.remove(path)
-                if 'thumb_path' in locals() and thumb_path and os.path.exists(thumb_path):
-                    os.remove(thumb_path)
-            except:
-                pass
-            active_downloads.discard(user_id)
-            global_download_semaphore.release()
-            # Session is now managed by get_user_client cache
-    except Exception as e:
-        await status_msg.edit_text(f"❌ Outer Error: {str(e)}")
+            return None
     finally:
         active_downloads.discard(user_id)
-        if 'global_download_semaphore' in locals():
-            try:
-                global_download_semaphore.release()
-            except RuntimeError:
-                pass
+        # Released exactly once; a second release would silently raise the download limit
+        global_download_semaphore.release()
 
 @app.on_callback_query(filters.regex("upgrade_prompt"))
 async def upgrade_prompt_callback(client, callback_query):
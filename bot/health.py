@@ -0,0 +1,53 @@
+import os
+import time
+import asyncio
+import logging
+from aiohttp import web
+from bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+HEALTH_PORT = int(os.environ.get("PORT", 8080))
+HEALTH_HOST = os.environ.get("HEALTH_HOST", "0.0.0.0")
+
+_started_at = time.time()
+_runner = None
+
+async def _health(request):
+    return web.json_response({
+        "status": "ok",
+        "uptime": round(time.time() - _started_at, 1)
+    })
+
+async def _metrics(request):
+    return web.Response(
+        text=REGISTRY.render(),
+        content_type="text/plain",
+        charset="utf-8",
+        headers={"X-Content-Type-Options": "nosniff"}
+    )
+
+async def run_health_server(host=HEALTH_HOST, port=HEALTH_PORT):
+    """Serve /health and /metrics on the bot's own event loop"""
+    global _runner
+    web_app = web.Application()
+    web_app.router.add_get("/", _health)
+    web_app.router.add_get("/health", _health)
+    web_app.router.add_get("/metrics", _metrics)
+
+    _runner = web.AppRunner(web_app, access_log=None)
+    await _runner.setup()
+    site = web.TCPSite(_runner, host, port)
+    await site.start()
+    logger.info(f"Health/metrics server listening on {host}:{port}")
+
+async def stop_health_server():
+    global _runner
+    if _runner:
+        await _runner.cleanup()
+        _runner = None
+
+def start_health_check():
+    """Schedule the health server on the current event loop (non-blocking)"""
+    loop = asyncio.get_event_loop()
+    return loop.create_task(run_health_server())
@@ -1,6 +1,6 @@
 from pyrogram import filters
 from bot.config import app
-from bot.database import get_user, check_and_update_quota
+from bot.database import get_user, format_date, FREE_DAILY_LIMIT, UNLIMITED_ROLES
 
 @app.on_message(filters.command("myinfo") & filters.private)
 async def myinfo(client, message):
@@ -12,11 +12,11 @@ async def myinfo(client, message):
         
     role_raw = user.get('role', 'free')
     role = role_raw.upper()
-    quota_info = "Unlimited" if role_raw in ['premium', 'admin', 'owner'] else f"{user.get('downloads_today', 0)}/5"
+    quota_info = "Unlimited" if role_raw in UNLIMITED_ROLES else f"{user.get('downloads_today', 0)}/{FREE_DAILY_LIMIT}"
     
     expiry_info = ""
     if role_raw == 'premium' and user.get('premium_expiry_date'):
-        expiry_info = f"\nExpires: `{user.get('premium_expiry_date')}`"
+        expiry_info = f"\nExpires: `{format_date(user['premium_expiry_date'])}`"
 
     await message.reply(
         f"👤 **User Info**\n"
@@ -24,5 +24,5 @@ async def myinfo(client, message):
         f"Role: **{role}**\n"
         f"Daily Usage: {quota_info}"
         f"{expiry_info}\n"
-        f"Logged in: {'Yes' if user.get('phone_session_string') else 'No'}"
+        f"Logged in: {'Yes' if user.get('has_session') else 'No'}"
     )
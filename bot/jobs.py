@@ -0,0 +1,179 @@
+import os
+import time
+import asyncio
+import logging
+from typing import Dict
+from bot.config import JOB_MAX_RUNNING, JOB_CLAIM_BATCH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETENTION_HOURS
+from bot.database import (
+    enqueue_job, claim_jobs, renew_job_leases, finish_job, release_jobs, cancel_pending_jobs, prune_jobs,
+    refund_job_quota
+)
+from bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+JOBS = REGISTRY.counter("bot_jobs_total", "Download jobs by outcome", ("result",))
+JOBS_RESUMED = REGISTRY.counter("bot_jobs_resumed_total", "Jobs picked up again after the process running them stopped")
+JOBS_RUNNING = REGISTRY.gauge("bot_jobs_running", "Jobs claimed by this process")
+
+# Trace statuses process_link ends with when the user got their files
+DELIVERED = {"ok", "copied", "shared", "archived"}
+
+RESUMING_TEXT = "🔄 The bot restarted. Resuming your download..."
+GAVE_UP_TEXT = "❌ This download was interrupted too many times. Please send the link again."
+CANCELLED_TEXT = "🛑 Download cancelled."
+
+PRUNE_INTERVAL = 3600
+
+class JobQueue:
+    """Download requests kept in the jobs table until they finish.
+
+    Handlers enqueue a job with the request's status message and return.
+    run() leases batches of jobs, oldest first, up to max_running, and
+    renews the leases while they run. Jobs held by a process that died are
+    taken over once their lease lapses, and a clean shutdown hands its jobs
+    back at once, so after a restart the bot resumes them in the same
+    status messages. Only interrupted jobs are retried; failures the user
+    was already told about are final.
+    """
+
+    def __init__(self, max_running: int, batch: int, lease: int, max_attempts: int, retention: float):
+        self.max_running = max_running
+        self.batch = batch
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retention = retention
+        # Unique per process start, so a restarted bot never mistakes the old leases for its own
+        self.owner = f"{os.getpid()}-{os.urandom(4).hex()}"
+        self._tasks: Dict[int, asyncio.Task] = {}
+        # Status messages of jobs submitted by this process; resumed jobs fetch theirs again
+        self._messages: Dict[int, object] = {}
+        self._wake = asyncio.Event()
+        # Set by pause(): submitted jobs stay in the table and running ones carry on
+        self.paused = False
+
+    async def submit(self, user_id, link, status_msg) -> bool:
+        """Queue a link; False if it couldn't be stored and should be run directly"""
+        job_id = await enqueue_job(user_id, link, status_msg.chat.id, status_msg.id)
+        if job_id is None:
+            return False
+        self._messages[job_id] = status_msg
+        self._wake.set()
+        return True
+
+    async def run(self, client):
+        """Claim and run jobs until cancelled; needs a started client to edit status messages"""
+        from bot.handlers import process_link
+        heartbeat = asyncio.create_task(self._heartbeat())
+        last_prune = 0.0
+        try:
+            while True:
+                self._wake.clear()
+                if time.monotonic() - last_prune > PRUNE_INTERVAL:
+                    last_prune = time.monotonic()
+                    await prune_jobs(int(time.time() - self.retention))
+                free = 0 if self.paused else self.max_running - len(self._tasks)
+                jobs = await claim_jobs(self.owner, min(self.batch, free), self.lease)
+                for job in jobs:
+                    self._tasks[job["id"]] = asyncio.create_task(self._run_job(client, process_link, job))
+                if jobs and len(jobs) == min(self.batch, free) and len(self._tasks) < self.max_running:
+                    # A full batch means more may be waiting
+                    continue
+                # Woken by a new or finished job; the timeout picks up leases that lapsed meanwhile
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.lease)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            if self._tasks:
+                await renew_job_leases(self.owner, self.lease)
+
+    async def _status_message(self, client, job):
+        status_msg = self._messages.pop(job["id"], None)
+        if status_msg is not None:
+            return status_msg
+        try:
+            status_msg = await client.get_messages(job["status_chat_id"], job["status_message_id"])
+            if status_msg and not status_msg.empty:
+                return status_msg
+        except Exception as e:
+            logger.debug(f"Status message of job {job['id']} is gone: {e}")
+        return await client.send_message(job["user_id"], "⏳ Processing...")
+
+    async def _run_job(self, client, process, job):
+        result = "failed"
+        try:
+            status_msg = await self._status_message(client, job)
+            if job["quota_held"]:
+                # The run that died never settled its hold; refund it before this run reserves again
+                await refund_job_quota(job["id"])
+            if job["attempts"] > self.max_attempts:
+                result = "gave_up"
+                await finish_job(job["id"], "failed", "interrupted")
+                await status_msg.edit_text(GAVE_UP_TEXT)
+                return
+            if job["attempts"] > 1:
+                JOBS_RESUMED.inc()
+                try:
+                    await status_msg.edit_text(RESUMING_TEXT)
+                except Exception:
+                    pass
+            status = await process(client, job["user_id"], job["link"], status_msg, job["id"])
+            result = "done" if status in DELIVERED else "failed"
+            await finish_job(job["id"], result, None if result == "done" else status)
+        except asyncio.CancelledError:
+            # stop() hands the job back to the table
+            result = "released"
+            raise
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}")
+            await finish_job(job["id"], "failed", f"error: {type(e).__name__}")
+        finally:
+            JOBS.inc(result=result)
+            self._tasks.pop(job["id"], None)
+            self._wake.set()
+
+    def pause(self):
+        """Stop claiming new jobs until resume()"""
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._wake.set()
+
+    async def cancel_pending(self, client, user_id=None) -> int:
+        """Drop jobs that haven't started, for one user or everyone; running ones use cancel tokens"""
+        jobs = await cancel_pending_jobs(user_id)
+        for job in jobs:
+            JOBS.inc(result="cancelled")
+            self._messages.pop(job["id"], None)
+            try:
+                await client.edit_message_text(job["status_chat_id"], job["status_message_id"], CANCELLED_TEXT)
+            except Exception:
+                pass
+        return len(jobs)
+
+    async def stop(self):
+        """Interrupt running jobs and hand them back to the table for the next start"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        released = await release_jobs(self.owner)
+        if released:
+            logger.info(f"Handed {released} unfinished jobs back for the next start")
+
+    def __len__(self):
+        return len(self._tasks)
+
+transfer_jobs = JobQueue(JOB_MAX_RUNNING, JOB_CLAIM_BATCH, JOB_LEASE_SECONDS, JOB_MAX_ATTEMPTS, JOB_RETENTION_HOURS * 3600)
+
+def _collect_job_metrics():
+    JOBS_RUNNING.set(len(transfer_jobs))
+
+REGISTRY.add_collector(_collect_job_metrics)
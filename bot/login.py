@@ -1,11 +1,9 @@
-import asyncio
-import time
 from pyrogram import filters
-from pyrogram.client import Client
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from pyrogram.errors import SessionPasswordNeeded, PhoneCodeInvalid, PasswordHashInvalid
-from bot.config import app, login_states, API_ID, API_HASH
-from bot.database import get_user, create_user, update_user_terms, save_session_string, logout_user
+from bot.config import app, LOGIN_STEP_TIMEOUT
+from bot.database import get_user, create_user, update_user_terms, logout_user
+from bot.auth import logins, LoginEnded
 
 from bot.logger import logger
 
@@ -30,10 +28,10 @@ async def start(client, message):
     if not user:
         user = await create_user(user_id)
     
-    # Show RichAds on start
+    # Show RichAds on start (delivered in the background)
     try:
-        from bot.ads import show_ad
-        await show_ad(client, user_id)
+        from bot.ads import queue_ad
+        queue_ad(client, user_id, message.from_user.language_code or "en")
     except Exception as e:
         logger.error(f"Error showing RichAds: {e}")
     
@@ -59,10 +57,10 @@ async def accept_terms(client, callback_query):
     user_id = callback_query.from_user.id
     await update_user_terms(user_id, True)
     
-    # Show RichAds after accepting terms
+    # Show RichAds after accepting terms (delivered in the background)
     try:
-        from bot.ads import show_ad
-        await show_ad(client, user_id)
+        from bot.ads import queue_ad
+        queue_ad(client, user_id, callback_query.from_user.language_code or "en")
     except Exception as e:
         logger.error(f"Error showing RichAds on T&C accept: {e}")
         
@@ -77,167 +75,120 @@ async def login_start(client, message):
         await message.reply("Please agree to the Terms & Conditions first using /start.")
         return
 
-    if user.get('phone_session_string'):
+    if user.get('has_session'):
         await message.reply("You are already logged in! Contact support if you need to re-login.")
         return
 
-    login_states[user_id] = {"step": "PHONE", "timestamp": time.time()}
+    if not await logins.begin(user_id):
+        await message.reply("⏳ Too many logins are in progress right now. Please try /login again in a minute.")
+        return
     await message.reply(
         "To download from restricted channels, you need to log in.\n\n"
         "Please send your **Phone Number** in international format (e.g., +1234567890).\n\n"
-        "⏳ This session will expire in 5 minutes if no activity is detected."
+        f"⏳ Each step expires after {LOGIN_STEP_TIMEOUT // 60} minutes without activity."
     )
 
-async def cleanup_expired_logins():
-    while True:
-        try:
-            now = time.time()
-            expired_users = [
-                user_id for user_id, state in login_states.items()
-                if now - state.get("timestamp", 0) > 300  # 5 minutes timeout
-            ]
-            for user_id in expired_users:
-                state = login_states[user_id]
-                if "client" in state:
-                    try:
-                        # Ensure we stop the client properly to release threads
-                        await state["client"].stop()
-                    except:
-                        try:
-                            await state["client"].disconnect()
-                        except:
-                            pass
-                del login_states[user_id]
-                try:
-                    await app.send_message(user_id, "⚠️ Login session expired due to inactivity.")
-                except:
-                    pass
-        except Exception as e:
-            logger.error(f"Cleanup error: {e}")
-        await asyncio.sleep(60)
-
-@app.on_message(filters.private & filters.text & ~filters.command(["start", "login", "logout", "cancel", "cancel_login", "myinfo", "setrole", "download", "upgrade", "broadcast", "ban", "unban", "settings", "set_force_sub", "set_dump", "help", "batch", "stats", "killall"]) & ~filters.regex(r"https://t\.me/"))
+@app.on_message(filters.private & filters.text & ~filters.command(["start", "login", "logout", "cancel", "cancel_login", "myinfo", "setrole", "download", "upgrade", "broadcast", "ban", "unban", "settings", "set_force_sub", "set_dump", "help", "batch", "stats", "killall", "traces", "trace_profile"]) & ~filters.regex(r"https://t\.me/"))
 async def handle_login_steps(client, message: Message):
     user_id = message.from_user.id
-    if user_id not in login_states:
+    session = logins.get(user_id)
+    if session is None:
         return
 
-    state = login_states[user_id]
-    step = state["step"]
-
     try:
-        if step == "PHONE":
-            state["timestamp"] = time.time()
+        if session.step == "PHONE":
             phone_number = message.text.strip()
             try:
-                state["client"] = Client(
-                    f"session_{user_id}",
-                    api_id=int(API_ID) if API_ID else 0,
-                    api_hash=str(API_HASH) if API_HASH else "",
-                    in_memory=True,
-                    sleep_threshold=0,
-                    max_concurrent_transmissions=1,
-                    workers=1
-                )
-                await state["client"].connect()
-                sent_code = await state["client"].send_code(phone_number)
+                async with logins.call(session):
+                    auth_client = await logins.connect(session)
+                    sent_code = await auth_client.send_code(phone_number)
+            except LoginEnded:
+                return
             except Exception as e:
                 await message.reply(f"Error sending code: {str(e)}\nPlease try /login again.")
-                if "client" in state:
-                    await state["client"].disconnect()
-                del login_states[user_id]
+                await logins.end(user_id, "failed", session)
                 return
-            state["phone"] = phone_number
-            state["phone_code_hash"] = sent_code.phone_code_hash
-            state["step"] = "CODE"
+            session.phone = phone_number
+            session.phone_code_hash = sent_code.phone_code_hash
+            logins.advance(session, "CODE")
             
             await message.reply("OTP Code sent to your Telegram account. Send it here (e.g. `1 2 3 4 5`).")
 
-        elif step == "CODE":
-            state["timestamp"] = time.time()
+        elif session.step == "CODE":
             code = message.text.replace("-", "").replace(" ", "").strip()
-            temp_client = state["client"]
             
             try:
-                await temp_client.sign_in(state["phone"], state["phone_code_hash"], code)
+                async with logins.call(session):
+                    await session.client.sign_in(session.phone, session.phone_code_hash, code)
+            except LoginEnded:
+                return
             except SessionPasswordNeeded:
-                state["step"] = "PASSWORD"
+                session.reusable = False
+                logins.advance(session, "PASSWORD")
                 await message.reply("Two-Step Verification enabled. Send your **Cloud Password**.")
                 return
             except PhoneCodeInvalid:
+                logins.advance(session, "CODE")
                 await message.reply("Invalid code. Try again.")
                 return
             except Exception as e:
                 logger.error(f"Login code check error: {e}")
                 await message.reply(f"Login failed: {e}")
-                await temp_client.disconnect()
-                del login_states[user_id]
+                await logins.end(user_id, "failed", session)
                 return
 
-            session_string = await temp_client.export_session_string()
-            await save_session_string(user_id, session_string)
-            await temp_client.disconnect()
-            del login_states[user_id]
-            await message.reply("✅ Login Successful!")
+            session.reusable = False
+            if await logins.complete(session):
+                await message.reply("✅ Login Successful!")
 
-        elif step == "PASSWORD":
-            state["timestamp"] = time.time()
+        elif session.step == "PASSWORD":
             password = message.text.strip()
-            temp_client = state["client"]
             
             try:
-                await temp_client.check_password(password)
+                async with logins.call(session):
+                    await session.client.check_password(password)
+            except LoginEnded:
+                return
             except PasswordHashInvalid:
                 await message.reply("❌ Invalid password. Please try /login again.")
-                await temp_client.disconnect()
-                del login_states[user_id]
+                await logins.end(user_id, "failed", session)
                 return
             except Exception as e:
                 logger.error(f"Login password check error: {e}")
                 await message.reply(f"Login failed: {e}")
-                await temp_client.disconnect()
-                del login_states[user_id]
+                await logins.end(user_id, "failed", session)
                 return
 
-            session_string = await temp_client.export_session_string()
-            await save_session_string(user_id, session_string)
-            await temp_client.disconnect()
-            del login_states[user_id]
-            await message.reply("✅ Login Successful!")
+            if await logins.complete(session):
+                await message.reply("✅ Login Successful!")
 
     except Exception as e:
         logger.error(f"handle_login_steps error: {e}")
         await message.reply("Error. Login cancelled.")
-        if "client" in state:
-            await state["client"].disconnect()
-        del login_states[user_id]
+        session.reusable = False
+        await logins.end(user_id, "failed", session)
 
 @app.on_message(filters.command("cancel") & filters.private)
 async def cancel_downloads(client, message):
     user_id = message.from_user.id
-    from bot.config import active_downloads, cancel_flags
+    from bot.cancellation import cancellations, wait_aborted
+    from bot.jobs import transfer_jobs
     
-    if user_id in active_downloads:
-        cancel_flags.add(user_id)
-        active_downloads.discard(user_id) # Force discard immediately as well
-        await message.reply("🛑 Download cancellation request sent. Your process has been removed from active list.")
+    queued = await transfer_jobs.cancel_pending(client, user_id)
+    tokens = cancellations.cancel(user_id)
+    if not tokens:
+        await message.reply(f"🛑 Cancelled {queued} queued downloads." if queued else "No active downloads to cancel.")
+        return
+    durations, stuck = await wait_aborted(tokens, timeout=15)
+    if stuck:
+        await message.reply("🛑 Cancellation sent. Your download is still stopping.")
     else:
-        # Just in case the flag was set but not in active_downloads
-        if user_id in cancel_flags:
-            cancel_flags.discard(user_id)
-        await message.reply("No active downloads to cancel.")
+        await message.reply(f"🛑 Download cancelled in {max(durations):.1f}s.")
 
 @app.on_message(filters.command("cancel_login") & filters.private)
 async def cancel_login(client, message):
     user_id = message.from_user.id
-    if user_id in login_states:
-        state = login_states[user_id]
-        if "client" in state:
-            try:
-                await state["client"].disconnect()
-            except:
-                pass
-        del login_states[user_id]
+    if await logins.end(user_id, "cancelled"):
         await message.reply("✅ Login process cancelled.")
     else:
         await message.reply("No active login process to cancel.")
@@ -248,17 +199,13 @@ async def logout(client, message):
     user = await get_user(user_id)
     
     # Clear any active login session
-    if user_id in login_states:
-        state = login_states[user_id]
-        if "client" in state:
-            try:
-                await state["client"].disconnect()
-            except:
-                pass
-        del login_states[user_id]
+    await logins.end(user_id, "cancelled")
 
-    if user and user.get('phone_session_string'):
+    if user and user.get('has_session'):
         await logout_user(user_id)
+        # /login hands its signed-in client to the download cache; it must not outlive the session
+        from bot.handlers import drop_user_client
+        await drop_user_client(user_id)
         await message.reply("✅ Logged out successfully! Your session has been cleared.")
     else:
         await message.reply("You are not logged in.")
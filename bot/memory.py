@@ -0,0 +1,194 @@
+import os
+import gc
+import time
+import asyncio
+import resource
+import logging
+import collections
+from typing import Dict, Optional, Tuple
+import psutil
+from bot.config import MEMORY_LIMIT_MB, MEMORY_SOFT_PCT, MEMORY_HARD_PCT, MEMORY_SAMPLE_INTERVAL, MEMORY_GC_THRESHOLD
+from bot.budget import budget, in_memory
+from bot.thumbnails import thumb_cache
+from bot.jobs import transfer_jobs
+from bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MEMORY_LEVEL = REGISTRY.gauge("bot_memory_level", "Memory governor level: 0 normal, 1 elevated, 2 critical")
+MEMORY_USAGE = REGISTRY.gauge("bot_memory_usage_bytes", "Memory the governor measures against its limit")
+MEMORY_LIMIT = REGISTRY.gauge("bot_memory_limit_bytes", "Limit the memory governor works against")
+MEMORY_ACTIONS = REGISTRY.counter("bot_memory_actions_total", "Memory governor actions by kind", ("action",))
+GC_PAUSE_SECONDS = REGISTRY.histogram(
+    "bot_gc_pause_seconds", "Garbage collector pauses by generation", ("generation",),
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+
+NORMAL, ELEVATED, CRITICAL = 0, 1, 2
+LEVEL_NAMES = ("normal", "elevated", "critical")
+# Percentage points usage has to fall below a threshold before its level is left, so it doesn't flap
+HYSTERESIS = 5
+
+# What each level allows, relative to the configured sizes. idle is how long an unused
+# user client is kept (None = the regular 10 minute cleanup); pause stops claiming new jobs.
+Policy = collections.namedtuple("Policy", ["budget", "in_memory", "thumbs", "idle", "pause"])
+POLICIES = {
+    NORMAL: Policy(1.0, 1.0, 1.0, None, False),
+    ELEVATED: Policy(0.5, 0.25, 0.25, 120, False),
+    CRITICAL: Policy(0.25, 0.0625, 0.0, 0, True),
+}
+
+def _limit() -> Tuple[int, str]:
+    """The limit to work against and the measure it applies to.
+
+    RLIMIT_AS caps address space, so an allocation fails once VMS reaches
+    it no matter how much of it is resident; without a cap, RSS is
+    measured against MEMORY_LIMIT_MB or the machine's memory.
+    """
+    soft, _ = resource.getrlimit(resource.RLIMIT_AS)
+    if soft != resource.RLIM_INFINITY:
+        return soft, "vms"
+    if MEMORY_LIMIT_MB:
+        return int(MEMORY_LIMIT_MB * 1024 * 1024), "rss"
+    return psutil.virtual_memory().total, "rss"
+
+class MemoryGovernor:
+    """Shrinks what the bot holds in memory as usage nears its limit, and restores it after.
+
+    run() samples usage every `interval` seconds. At `soft` percent of the
+    limit (ELEVATED) the transfer budget, the in-memory file buffer and the
+    thumbnail cache shrink, user clients idle for two minutes are stopped
+    and the collector runs at CPython's default, more frequent thresholds.
+    At `hard` percent (CRITICAL) they shrink further, every user client
+    without a running download is stopped and no new jobs are claimed;
+    queued jobs wait in the table. Each level is left only once usage is
+    HYSTERESIS points below where it was entered, and NORMAL puts back the
+    configured sizes and the tuned collector thresholds.
+    """
+
+    def __init__(self, soft: float, hard: float, interval: float, gc_threshold: int):
+        self.soft = soft
+        self.hard = hard
+        self.interval = interval
+        self.gc_threshold = gc_threshold
+        self.level = NORMAL
+        self.limit = 0
+        self.measure = "rss"
+        self.usage = 0
+        self._process = psutil.Process(os.getpid())
+        self._default_gc = gc.get_threshold()
+        # Configured cache size; policies scale from it
+        self._thumb_base = thumb_cache.max_bytes
+        self._gc_started: Dict[int, float] = {}
+
+    def tune_gc(self):
+        """Collect the young generation less often and time every collection"""
+        gc.set_threshold(self.gc_threshold, *self._default_gc[1:])
+        if self._on_gc not in gc.callbacks:
+            gc.callbacks.append(self._on_gc)
+
+    def freeze(self):
+        """Move everything allocated so far to the permanent generation; call once startup is done.
+
+        Modules, handlers and the started clients live until exit, so
+        later collections skip them instead of walking them every time.
+        """
+        gc.collect()
+        gc.freeze()
+        logger.info(f"Froze {gc.get_freeze_count()} startup objects out of garbage collection")
+
+    def _on_gc(self, phase, info):
+        generation = info["generation"]
+        if phase == "start":
+            self._gc_started[generation] = time.perf_counter()
+        else:
+            started = self._gc_started.pop(generation, None)
+            if started is not None:
+                GC_PAUSE_SECONDS.observe(time.perf_counter() - started, generation=str(generation))
+
+    def sample(self) -> int:
+        info = self._process.memory_info()
+        self.usage = info.vms if self.measure == "vms" else info.rss
+        return self.usage
+
+    def _level_for(self, usage: int) -> int:
+        percent = usage * 100 / self.limit
+        level = NORMAL
+        for candidate, threshold in ((ELEVATED, self.soft), (CRITICAL, self.hard)):
+            if candidate <= self.level:
+                threshold -= HYSTERESIS
+            if percent >= threshold:
+                level = candidate
+        return level
+
+    async def run(self):
+        """Sample and react until cancelled; start it after the RLIMIT_AS cap is set"""
+        self.limit, self.measure = _limit()
+        logger.info(f"Memory governor watching {self.measure.upper()} against {self.limit / 1048576:.0f} MB")
+        while True:
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"Memory governor check failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def check(self):
+        level = self._level_for(self.sample())
+        if level != self.level:
+            logger.warning(
+                f"Memory {LEVEL_NAMES[level]}: {self.usage / 1048576:.0f} of {self.limit / 1048576:.0f} MB {self.measure}"
+            )
+            rising = level > self.level
+            self.level = level
+            self._apply(POLICIES[level])
+            MEMORY_ACTIONS.inc(action=LEVEL_NAMES[level])
+            if rising:
+                # Shrinking the caches only frees memory once the dropped objects are collected
+                gc.collect()
+                MEMORY_ACTIONS.inc(action="collect")
+        idle = POLICIES[self.level].idle
+        if idle is not None:
+            # Lazy: the handlers module registers with the bot and imports most of the package
+            from bot.handlers import evict_user_clients
+            evicted = await evict_user_clients(idle)
+            if evicted:
+                MEMORY_ACTIONS.inc(evicted, action="evict_client")
+
+    def follow(self, level: int):
+        """Take a level measured elsewhere; transfer workers follow the bot process's governor"""
+        if level != self.level:
+            self.level = level
+            self._apply(POLICIES[level])
+            MEMORY_ACTIONS.inc(action=LEVEL_NAMES[level])
+
+    def _apply(self, policy: Policy):
+        budget.scale(policy.budget)
+        in_memory.scale(policy.in_memory)
+        thumb_cache.resize(int(self._thumb_base * policy.thumbs))
+        if policy.pause:
+            transfer_jobs.pause()
+        else:
+            transfer_jobs.resume()
+        if policy is POLICIES[NORMAL]:
+            gc.set_threshold(self.gc_threshold, *self._default_gc[1:])
+        else:
+            gc.set_threshold(*self._default_gc)
+
+    def snapshot(self) -> Optional[Dict]:
+        if not self.limit:
+            return None
+        return {
+            "level": LEVEL_NAMES[self.level],
+            "usage_mb": self.usage / 1048576,
+            "limit_mb": self.limit / 1048576,
+            "measure": self.measure,
+        }
+
+memory_governor = MemoryGovernor(MEMORY_SOFT_PCT, MEMORY_HARD_PCT, MEMORY_SAMPLE_INTERVAL, MEMORY_GC_THRESHOLD)
+
+def _collect_memory_metrics():
+    MEMORY_LEVEL.set(memory_governor.level)
+    MEMORY_USAGE.set(memory_governor.usage)
+    MEMORY_LIMIT.set(memory_governor.limit)
+
+REGISTRY.add_collector(_collect_memory_metrics)
@@ -0,0 +1,217 @@
+import os
+import time
+import bisect
+import logging
+import psutil
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, tuned for Telegram RPCs and SQLite calls
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(labelnames, key, extra=()) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ] + self._samples()
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+class Counter(_Metric):
+    """Monotonic counter"""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        # Unlabelled series are always exported, starting at zero
+        self._values: Dict[Tuple, float] = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+                for key, v in sorted(self._values.items())]
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        # Unlabelled series are always exported, starting at zero
+        self._values: Dict[Tuple, float] = {} if self.labelnames else {(): 0}
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(v)}"
+                for key, v in sorted(self._values.items())]
+
+class Histogram(_Metric):
+    """Bucketed distribution with sum and count"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # {labels: [bucket_counts..., sum, count]}
+        self._values: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        data = self._values.get(key)
+        if data is None:
+            data = self._values[key] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            data[index] += 1
+        data[-2] += value
+        data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the wall time of the wrapped block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return data[-1] if data else 0
+
+    def _samples(self):
+        lines = []
+        for key, data in sorted(self._values.items()):
+            cumulative = 0
+            for bound, hits in zip(self.buckets, data):
+                cumulative += hits
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _format_value(float(bound)))])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {data[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(data[-2])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {data[-1]}")
+        return lines
+
+class MetricsRegistry:
+    """In-process registry rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Callable[[], None]] = []
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def add_collector(self, collector: Callable[[], None]):
+        """Register a callback that refreshes sampled gauges before each scrape"""
+        self._collectors.append(collector)
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.debug(f"Metrics collector failed: {e}")
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+# Transfers
+TRANSFERS = REGISTRY.counter("bot_transfers_total", "Finished transfers by direction and result", ("direction", "result"))
+TRANSFER_BYTES = REGISTRY.counter("bot_transfer_bytes_total", "Bytes moved by direction", ("direction",))
+TRANSFER_SECONDS = REGISTRY.histogram("bot_transfer_seconds", "Transfer wall time by direction", ("direction",))
+DOWNLOAD_QUEUE = REGISTRY.gauge("bot_download_queue_depth", "Requests waiting for a download slot")
+ACTIVE_DOWNLOADS = REGISTRY.gauge("bot_active_downloads", "Users with a download in progress")
+
+# Telegram and database
+RPC_SECONDS = REGISTRY.histogram("bot_rpc_seconds", "Telegram RPC latency by method", ("method",))
+FLOOD_WAITS = REGISTRY.counter("bot_flood_waits_total", "FloodWait errors by method", ("method",))
+FLOOD_WAIT_SECONDS = REGISTRY.counter("bot_flood_wait_seconds_total", "Seconds of FloodWait requested by method", ("method",))
+DB_QUERY_SECONDS = REGISTRY.histogram("bot_db_query_seconds", "SQLite call latency by operation", ("op",))
+
+# Caches and queues
+CACHE_REQUESTS = REGISTRY.counter("bot_cache_requests_total", "Cache lookups by cache and result", ("cache", "result"))
+QUEUE_DEPTH = REGISTRY.gauge("bot_queue_depth", "Items waiting in background queues", ("queue",))
+
+# Process
+PROCESS_RSS = REGISTRY.gauge("bot_process_resident_memory_bytes", "Resident set size of the bot process")
+UPTIME = REGISTRY.gauge("bot_uptime_seconds", "Seconds since the bot process started")
+
+_started_at = time.time()
+
+def cache_hit(cache: str, hit: bool):
+    CACHE_REQUESTS.inc(cache=cache, result="hit" if hit else "miss")
+
+def record_flood_wait(method: str, seconds):
+    FLOOD_WAITS.inc(method=method)
+    FLOOD_WAIT_SECONDS.inc(seconds, method=method)
+
+def _collect_process():
+    PROCESS_RSS.set(psutil.Process(os.getpid()).memory_info().rss)
+    UPTIME.set(round(time.time() - _started_at, 1))
+
+REGISTRY.add_collector(_collect_process)
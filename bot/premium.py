@@ -0,0 +1,104 @@
+import time
+import asyncio
+import logging
+from typing import Optional
+from pyrogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.errors import FloodWait
+from bot.config import PREMIUM_SWEEP_MAX_SLEEP, PREMIUM_NOTIFY_RATE
+from bot.database import expire_premium_users, next_premium_expiry, FREE_DAILY_LIMIT
+from bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PREMIUM_EXPIRED = REGISTRY.counter("bot_premium_expired_total", "Premium users downgraded by the expiry sweeper")
+PREMIUM_NOTICES = REGISTRY.counter("bot_premium_expiry_notices_total", "Premium expiry notices by outcome", ("result",))
+PREMIUM_NOTICE_BACKLOG = REGISTRY.gauge("bot_premium_expiry_notice_backlog", "Expiry notices waiting to be sent")
+PREMIUM_NEXT_EXPIRY = REGISTRY.gauge("bot_premium_next_expiry_seconds", "Seconds until the next premium expiry, -1 if none")
+
+EXPIRED_TEXT = (
+    "⏳ **Your Premium has expired.**\n\n"
+    f"Your account is back on the free plan with {FREE_DAILY_LIMIT} downloads per day.\n"
+    "Upgrade again any time to get unlimited downloads back."
+)
+EXPIRED_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("💎 Renew Premium", callback_data="upgrade_prompt")]])
+
+class ExpirySweeper:
+    """Downgrades expired premium users in bulk and tells them about it.
+
+    The next pending expiry is kept in memory so the sweeper sleeps until
+    exactly then; wake() makes it re-read the schedule after a role change.
+    Sleeps are capped at PREMIUM_SWEEP_MAX_SLEEP in case the database is
+    changed behind its back (e.g. restored from a backup).
+    """
+
+    def __init__(self, max_sleep: int, notify_rate: float):
+        self.max_sleep = max_sleep
+        self.notify_rate = notify_rate
+        self.next_expiry: Optional[int] = None
+        self._wake = asyncio.Event()
+        self._notices: asyncio.Queue = asyncio.Queue()
+
+    def wake(self):
+        self._wake.set()
+
+    def _delay(self) -> float:
+        if self.next_expiry is None:
+            return self.max_sleep
+        return min(self.max_sleep, max(1, self.next_expiry - time.time()))
+
+    async def sweep(self) -> int:
+        expired = await expire_premium_users()
+        if expired:
+            PREMIUM_EXPIRED.inc(len(expired))
+            logger.info(f"Premium expired for {len(expired)} users")
+        for user_id in expired:
+            self._notices.put_nowait(user_id)
+        self.next_expiry = await next_premium_expiry()
+        return len(expired)
+
+    async def run(self, client):
+        """Sweep now, then whenever the next expiry comes due; needs a started client for notices"""
+        notifier = asyncio.create_task(self._notifier(client))
+        try:
+            while True:
+                self._wake.clear()
+                try:
+                    await self.sweep()
+                except Exception as e:
+                    logger.error(f"Premium sweep error: {e}")
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self._delay())
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            notifier.cancel()
+
+    async def _notifier(self, client):
+        # One message per 1/rate seconds keeps a mass expiry well under the bot's send limits
+        while True:
+            user_id = await self._notices.get()
+            PREMIUM_NOTICES.inc(result=await self._notify(client, user_id))
+            await asyncio.sleep(1 / self.notify_rate)
+
+    async def _notify(self, client, user_id) -> str:
+        for _ in range(2):
+            try:
+                await client.send_message(user_id, EXPIRED_TEXT, reply_markup=EXPIRED_MARKUP)
+                return "sent"
+            except FloodWait as e:
+                # Only waits the RPC gateway refused to sit through get here
+                await asyncio.sleep(e.value)
+            except Exception as e:
+                # Usually the user blocked the bot
+                logger.debug(f"Expiry notice to {user_id} failed: {e}")
+                return "failed"
+        return "flood_wait"
+
+premium_expiry = ExpirySweeper(PREMIUM_SWEEP_MAX_SLEEP, PREMIUM_NOTIFY_RATE)
+
+def _collect_premium_metrics():
+    PREMIUM_NOTICE_BACKLOG.set(premium_expiry._notices.qsize())
+    next_expiry = premium_expiry.next_expiry
+    PREMIUM_NEXT_EXPIRY.set(-1 if next_expiry is None else max(0, next_expiry - time.time()))
+
+REGISTRY.add_collector(_collect_premium_metrics)
@@ -0,0 +1,88 @@
+import io
+import os
+import asyncio
+from typing import Awaitable, Callable, Optional
+from pyrogram.types import Message
+from bot.transfer import download_media_fast, upload_media_fast, discard
+from bot.thumbnails import fetch_thumb, complete_video_meta, is_video
+from bot.tracing import span
+
+# report(current, total, phase) with phase "download" or "upload"; (0, 0, "upload") marks the switch
+Reporter = Callable[[int, int, str], Awaitable[None]]
+
+async def relay_media(bot_client, user_client, chat_id, msg: Message, report: Reporter, token=None) -> Optional[Message]:
+    """Download msg's media through user_client and re-upload it to chat_id through bot_client.
+
+    Shared by the bot process and transfer workers. Returns the sent message,
+    or None when the media couldn't be downloaded; DiskFull, Cancelled and
+    transfer errors propagate. Nothing is left on disk either way.
+    """
+    path = None
+    thumb_task = None
+    try:
+        # 1. Original thumbnail, fetched in memory alongside the main download
+        media = msg.video or msg.document or msg.audio
+        if media and getattr(media, "thumbs", None):
+            thumb_task = asyncio.create_task(fetch_thumb(user_client, media))
+
+        # 2. Extract Metadata & Fast Download main media
+        meta = {"duration": 0, "width": 0, "height": 0}
+        if msg.video:
+            meta = {"duration": msg.video.duration or 0, "width": msg.video.width or 0, "height": msg.video.height or 0}
+        elif msg.document and is_video(msg.document):
+            # Some videos are sent as documents
+            meta = {k: getattr(msg.document, k, 0) or 0 for k in meta}
+
+        path = await download_media_fast(
+            user_client,
+            msg,
+            None,
+            progress_callback=report,
+            progress_args=("download",),
+            cancel_token=token
+        )
+        if path is None:
+            return None
+
+        if not isinstance(path, (str, bytes, os.PathLike, io.IOBase)):
+            raise TypeError(f"Invalid download path returned ({type(path)})")
+
+        with span("thumbnail", ready=thumb_task is not None and thumb_task.done()):
+            thumb = await thumb_task if thumb_task else None
+            if msg.video or (msg.document and is_video(msg.document)):
+                thumb, meta = await complete_video_meta(path, msg.video or msg.document, thumb, meta)
+
+        # Safe caption retrieval
+        original_caption = msg.caption if msg and hasattr(msg, "caption") else ""
+        safe_caption = str(original_caption) if original_caption is not None else ""
+
+        await report(0, 0, "upload")
+
+        # 3. Smart Upload with thumbnail and metadata
+        sent = await upload_media_fast(
+            bot_client,
+            chat_id,
+            path,
+            caption=safe_caption,
+            thumb=thumb,
+            duration=meta["duration"],
+            width=meta["width"],
+            height=meta["height"],
+            progress_callback=report,
+            progress_args=("upload",),
+            cancel_token=token
+        )
+
+        # 4. Strict Cleanup
+        with span("disk_cleanup"):
+            discard(path)
+            path = None
+        return sent
+    finally:
+        if thumb_task and not thumb_task.done():
+            thumb_task.cancel()
+        # Emergency cleanup
+        try:
+            discard(path)
+        except Exception:
+            pass
@@ -0,0 +1,221 @@
+import math
+import time
+import random
+import asyncio
+import contextvars
+import logging
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+from pyrogram import raw
+from pyrogram.errors import FloodWait, FloodPremiumWait
+from pyrogram.session import Session
+from bot.config import (
+    RPC_SEND_RATE, RPC_EDIT_RATE, RPC_READ_RATE, RPC_CHAT_RATE, RPC_GROUP_RATE, RPC_MAX_WAIT, RPC_FLOOD_RETRIES
+)
+from bot.metrics import REGISTRY, record_flood_wait
+
+logger = logging.getLogger(__name__)
+
+RPC_WAIT_SECONDS = REGISTRY.histogram("bot_rpc_wait_seconds", "Time calls spent held by the RPC gateway by reason", ("reason",))
+RPC_SHED = REGISTRY.counter("bot_rpc_shed_total", "Calls refused instead of waiting, by method and reason", ("method", "reason"))
+RPC_RETRIES = REGISTRY.counter("bot_rpc_flood_retries_total", "Calls retried after a FloodWait by method", ("method",))
+RPC_CHAT_BUCKETS = REGISTRY.gauge("bot_rpc_chat_buckets", "Per-chat rate limiters held by the bot's gateway")
+
+# Calls paced by a shared per-client bucket for their class; unlisted methods are only held back after a FloodWait
+METHOD_CLASSES = {
+    "messages.SendMessage": "send",
+    "messages.SendMedia": "send",
+    "messages.SendMultiMedia": "send",
+    "messages.ForwardMessages": "send",
+    "messages.EditMessage": "edit",
+    "messages.GetMessages": "read",
+    "channels.GetMessages": "read",
+    "messages.GetHistory": "read",
+    "messages.GetReplies": "read",
+    "messages.GetDiscussionMessage": "read",
+    "stories.GetStoriesByID": "read",
+    "contacts.ResolveUsername": "read",
+    "channels.GetChannels": "read",
+    "channels.GetFullChannel": "read",
+}
+# Classes that also count against the destination chat's own limit
+CHAT_CLASSES = {"send", "edit"}
+CHAT_BURST = 3
+# Idle chat buckets are dropped once there are this many
+CHAT_BUCKETS_MAX = 4096
+
+_patience: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("rpc_patience", default=None)
+
+class Overloaded(FloodWait):
+    """A call refused by the gateway because it would have to wait longer than its caller allows.
+
+    A FloodWait subclass, so callers treat both the same way; value is the wait in seconds.
+    """
+
+    def __init__(self, value: int, method: str):
+        super().__init__(value=value, rpc_name=method)
+        self.method = method
+
+    def __str__(self):
+        return f"Too many {self.method} calls right now; try again in {self.value}s"
+
+class TokenBucket:
+    """rate calls per second with bursts of up to burst, kept as a virtual schedule (GCRA).
+
+    delay() is how long a call arriving now would wait and take() books its
+    slot, so there is no refill task and no waiter list. block() holds the
+    bucket for a FloodWait; a bucket with rate 0 only ever waits for blocks.
+    """
+    __slots__ = ("interval", "tolerance", "_next")
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.tolerance = (max(burst, 1) - 1) * self.interval
+        self._next = 0.0
+
+    def delay(self, now: float) -> float:
+        return max(0.0, self._next - self.tolerance - now)
+
+    def take(self, now: float):
+        self._next = max(self._next, now) + self.interval
+
+    def block(self, now: float, seconds: float):
+        self._next = max(self._next, now + seconds + self.tolerance)
+
+    def idle(self, now: float) -> bool:
+        return self._next <= now
+
+@contextmanager
+def patience(seconds: float):
+    """Calls made in this block wait at most seconds in the gateway and are refused beyond that"""
+    reset = _patience.set(seconds)
+    try:
+        yield
+    finally:
+        _patience.reset(reset)
+
+def _chat_key(query) -> Optional[Tuple[str, int]]:
+    peer = getattr(query, "to_peer", None) or getattr(query, "peer", None)
+    if isinstance(peer, raw.types.InputPeerUser):
+        return ("user", peer.user_id)
+    if isinstance(peer, raw.types.InputPeerChannel):
+        return ("group", peer.channel_id)
+    if isinstance(peer, raw.types.InputPeerChat):
+        return ("group", peer.chat_id)
+    return None
+
+class RpcGateway:
+    """Pacing and FloodWait handling for everything one client invokes.
+
+    Calls are paced by a bucket for their method class (send, edit, read)
+    and, for sends and edits, one for the destination chat (RPC_CHAT_RATE
+    per second in private chats, RPC_GROUP_RATE per minute in groups and
+    channels). A FloodWait blocks the chat's bucket, or the method's when
+    there is no chat, so nothing else walks into it; the call is then
+    retried after the wait plus jitter. A call whose wait would exceed its
+    patience (RPC_MAX_WAIT, a larger sleep_threshold from the caller, or a
+    patience() block) is refused with Overloaded instead.
+    """
+
+    def __init__(self, rates: Dict[str, float], chat_rate: float, group_rate: float, max_wait: float, flood_retries: int):
+        self.max_wait = max_wait
+        self.flood_retries = flood_retries
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self._classes = {kind: TokenBucket(rate, max(1, int(rate))) for kind, rate in rates.items()}
+        self._methods: Dict[str, TokenBucket] = {}
+        self._chats: Dict[Tuple[str, int], TokenBucket] = {}
+
+    @classmethod
+    def from_config(cls) -> "RpcGateway":
+        rates = {"send": RPC_SEND_RATE, "edit": RPC_EDIT_RATE, "read": RPC_READ_RATE}
+        return cls(rates, RPC_CHAT_RATE, RPC_GROUP_RATE / 60, RPC_MAX_WAIT, RPC_FLOOD_RETRIES)
+
+    def _chat_bucket(self, key: Tuple[str, int], now: float) -> TokenBucket:
+        bucket = self._chats.get(key)
+        if bucket is None:
+            if len(self._chats) >= CHAT_BUCKETS_MAX:
+                # An idle bucket behaves exactly like a new one, so dropping it changes nothing
+                self._chats = {k: b for k, b in self._chats.items() if not b.idle(now)}
+            rate = self.chat_rate if key[0] == "user" else self.group_rate
+            bucket = self._chats[key] = TokenBucket(rate, CHAT_BURST)
+        return bucket
+
+    def _patience(self, sleep_threshold: Optional[float]) -> float:
+        scoped = _patience.get()
+        if scoped is not None:
+            return scoped
+        # pyrogram passes 60 for calls it expects to be slow, and -1 for "always wait"; we still shed past max_wait
+        if sleep_threshold is not None and sleep_threshold > self.max_wait:
+            return sleep_threshold
+        return self.max_wait
+
+    async def call(self, invoke, query, retries, timeout, sleep_threshold):
+        name = ".".join(query.QUALNAME.split(".")[1:])
+        limit = self._patience(sleep_threshold)
+        now = time.monotonic()
+        method = self._methods.get(name)
+        if method is None:
+            method = self._methods[name] = TokenBucket(0)
+        kind = METHOD_CLASSES.get(name)
+        buckets = [method]
+        if kind is not None:
+            buckets.append(self._classes[kind])
+        chat = None
+        if kind in CHAT_CLASSES:
+            key = _chat_key(query)
+            if key is not None:
+                chat = self._chat_bucket(key, now)
+                buckets.append(chat)
+
+        for attempt in range(self.flood_retries + 1):
+            now = time.monotonic()
+            wait = max(bucket.delay(now) for bucket in buckets)
+            if wait > limit:
+                RPC_SHED.inc(method=name, reason="throttle")
+                raise Overloaded(math.ceil(wait), name)
+            for bucket in buckets:
+                bucket.take(now)
+            if wait > 0:
+                RPC_WAIT_SECONDS.observe(wait, reason="throttle")
+                await asyncio.sleep(wait)
+            try:
+                # Threshold 0: every FloodWait comes back here instead of sleeping inside the session
+                return await invoke(query, retries, timeout, 0)
+            except (FloodWait, FloodPremiumWait) as e:
+                record_flood_wait(name, e.value)
+                (chat or method).block(time.monotonic(), e.value)
+                if e.value > limit or attempt == self.flood_retries:
+                    RPC_SHED.inc(method=name, reason="flood")
+                    raise
+                RPC_RETRIES.inc(method=name)
+                # Everyone blocked by the same wait would otherwise retry in the same instant
+                delay = e.value * random.uniform(1.0, 1.2) + random.uniform(0, 1)
+                RPC_WAIT_SECONDS.observe(delay, reason="flood")
+                logger.debug(f"FloodWait {e.value}s on {name}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def __len__(self):
+        return len(self._chats)
+
+def install(client, gateway: Optional[RpcGateway] = None) -> RpcGateway:
+    """Route every client.invoke through a gateway; call before the client is started"""
+    gateway = gateway or RpcGateway.from_config()
+    invoke = client.invoke
+
+    async def gated_invoke(query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        return await gateway.call(invoke, query, retries, timeout, sleep_threshold)
+
+    client.invoke = gated_invoke
+    # Session.invoke sleeps through FloodWaits up to max(passed, client.sleep_threshold); with both 0 every
+    # one reaches the gateway. Media sessions (get_file, save_file) pass their own threshold and aren't affected.
+    client.sleep_threshold = 0
+    client.rpc_gateway = gateway
+    return gateway
+
+bot_gateway = RpcGateway.from_config()
+
+def _collect_rpc_metrics():
+    RPC_CHAT_BUCKETS.set(len(bot_gateway))
+
+REGISTRY.add_collector(_collect_rpc_metrics)
@@ -0,0 +1,50 @@
+import os
+import hmac
+import base64
+import hashlib
+import functools
+from typing import Tuple
+import tgcrypto
+from bot.config import SESSION_SECRET, BOT_TOKEN
+
+# Stored form of a user session: version byte, CTR nonce, ciphertext, truncated HMAC.
+# The plaintext is the session string's packed bytes (DC, API id, 256-byte auth key,
+# user id, flags) rather than its base64 text, so a row is ~300 bytes instead of ~360.
+VERSION = b"\x01"
+NONCE_SIZE = 16
+TAG_SIZE = 16
+
+class SessionKeyError(Exception):
+    """A stored session failed authentication: corrupt, or sealed under another secret"""
+
+@functools.lru_cache(maxsize=None)
+def _keys() -> Tuple[bytes, bytes]:
+    secret = SESSION_SECRET or BOT_TOKEN
+    if not secret:
+        raise RuntimeError("SESSION_SECRET (or BOT_TOKEN) must be set to store user sessions")
+    master = hashlib.sha256(secret.encode()).digest()
+    return (
+        hmac.new(master, b"session-encryption", hashlib.sha256).digest(),
+        hmac.new(master, b"session-authentication", hashlib.sha256).digest(),
+    )
+
+def _tag(mac_key: bytes, data: bytes) -> bytes:
+    return hmac.new(mac_key, data, hashlib.sha256).digest()[:TAG_SIZE]
+
+def seal(session_string: str) -> bytes:
+    """Encrypt a Pyrogram session string into its compact stored form"""
+    packed = base64.urlsafe_b64decode(session_string + "=" * (-len(session_string) % 4))
+    enc_key, mac_key = _keys()
+    nonce = os.urandom(NONCE_SIZE)
+    body = VERSION + nonce + tgcrypto.ctr256_encrypt(packed, enc_key, bytearray(nonce), bytearray(1))
+    return body + _tag(mac_key, body)
+
+def unseal(blob: bytes) -> str:
+    """The session string a seal() blob was made from"""
+    enc_key, mac_key = _keys()
+    body, tag = blob[:-TAG_SIZE], blob[-TAG_SIZE:]
+    if body[:1] != VERSION or not hmac.compare_digest(tag, _tag(mac_key, body)):
+        raise SessionKeyError("Stored session failed authentication")
+    nonce, ciphertext = body[1:1 + NONCE_SIZE], body[1 + NONCE_SIZE:]
+    packed = tgcrypto.ctr256_decrypt(ciphertext, enc_key, bytearray(nonce), bytearray(1))
+    return base64.urlsafe_b64encode(packed).decode().rstrip("=")
@@ -0,0 +1,46 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+from bot.metrics import cache_hit
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key into one execution.
+
+    The first caller for a key runs `func`; anyone who arrives while it is
+    still running waits for the same result instead. A failed run hands
+    its followers None (never the exception), so each of them can decide
+    to retry on its own.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def running(self, key) -> bool:
+        return key in self._calls
+
+    def __len__(self):
+        return len(self._calls)
+
+    async def do(self, key, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return (result, shared); shared is True if another caller did the work"""
+        future = self._calls.get(key)
+        cache_hit(self.name, future is not None)
+        if future is not None:
+            # Shielded so a follower giving up doesn't cancel the leader's result
+            return await asyncio.shield(future), True
+
+        future = asyncio.get_event_loop().create_future()
+        self._calls[key] = future
+        try:
+            result = await func()
+        except BaseException:
+            future.set_result(None)
+            raise
+        finally:
+            if self._calls.get(key) is future:
+                del self._calls[key]
+        future.set_result(result)
+        return result, False
+
+# Downloads keyed by the resolved (chat_id, message_id) of the source message
+transfers_in_flight = SingleFlight("transfer_dedup")
@@ -0,0 +1,171 @@
+import io
+import json
+import shutil
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional
+from bot.config import THUMB_CACHE_MB, FFMPEG_ENABLED, FFMPEG_TIMEOUT
+from bot.metrics import REGISTRY, cache_hit
+
+logger = logging.getLogger(__name__)
+
+FFMPEG = shutil.which("ffmpeg") if FFMPEG_ENABLED else None
+FFPROBE = shutil.which("ffprobe") if FFMPEG_ENABLED else None
+
+THUMB_CACHE_BYTES = REGISTRY.gauge("bot_thumb_cache_bytes", "Bytes of thumbnails held in memory")
+
+class ThumbCache:
+    """LRU of thumbnail JPEG bytes keyed by the source media's file_unique_id, bounded in bytes"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        data = self._entries.get(key)
+        if data is not None:
+            self._entries.move_to_end(key)
+        return data
+
+    def put(self, key: str, data: bytes):
+        if not data or len(data) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self._entries[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def resize(self, max_bytes: int):
+        """Change the bound, evicting the least recently used thumbnails that no longer fit"""
+        self.max_bytes = max_bytes
+        while self.size > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+thumb_cache = ThumbCache(int(THUMB_CACHE_MB * 1024 * 1024))
+
+def _as_file(data: bytes) -> io.BytesIO:
+    thumb = io.BytesIO(data)
+    thumb.name = "thumb.jpg"
+    return thumb
+
+def is_video(media) -> bool:
+    mime_type = getattr(media, "mime_type", None) or ""
+    return mime_type.startswith("video/")
+
+async def fetch_thumb(client, media) -> Optional[io.BytesIO]:
+    """The media's own largest thumbnail as an in-memory JPEG, or None"""
+    thumbs = getattr(media, "thumbs", None)
+    key = getattr(media, "file_unique_id", None)
+    if not thumbs or not key:
+        return None
+    data = thumb_cache.get(key)
+    cache_hit("thumbnail", data is not None)
+    if data is None:
+        try:
+            downloaded = await client.download_media(thumbs[-1].file_id, in_memory=True)
+        except Exception as e:
+            logger.debug(f"Thumb download error: {e}")
+            return None
+        if not downloaded:
+            return None
+        data = bytes(downloaded.getbuffer())
+        thumb_cache.put(key, data)
+    return _as_file(data)
+
+async def _run(*args) -> Optional[bytes]:
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(process.communicate(), timeout=FFMPEG_TIMEOUT)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        logger.debug(f"{args[0]} timed out")
+        return None
+    return stdout if process.returncode == 0 else None
+
+async def probe(path: str) -> Dict[str, int]:
+    """duration/width/height of the first video stream via ffprobe; empty if unavailable"""
+    if not FFPROBE:
+        return {}
+    out = await _run(
+        FFPROBE, "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=width,height,duration:format=duration",
+        "-of", "json", path
+    )
+    if not out:
+        return {}
+    try:
+        info = json.loads(out)
+    except ValueError:
+        return {}
+    stream = (info.get("streams") or [{}])[0]
+    duration = stream.get("duration") or info.get("format", {}).get("duration")
+    meta = {}
+    if duration:
+        meta["duration"] = int(float(duration))
+    if stream.get("width"):
+        meta["width"] = int(stream["width"])
+    if stream.get("height"):
+        meta["height"] = int(stream["height"])
+    return meta
+
+async def generate_thumb(path: str, key: Optional[str] = None) -> Optional[io.BytesIO]:
+    """Grab an early frame as a 320px JPEG (Telegram's thumbnail limit) via ffmpeg"""
+    if not FFMPEG:
+        return None
+    if key:
+        data = thumb_cache.get(key)
+        if data:
+            return _as_file(data)
+    data = None
+    # One second in skips black lead-in frames; clips shorter than that use the first frame
+    for offset in ("1", "0"):
+        data = await _run(
+            FFMPEG, "-v", "error", "-ss", offset, "-i", path, "-frames:v", "1",
+            "-vf", "scale=320:320:force_original_aspect_ratio=decrease",
+            "-f", "image2", "-c:v", "mjpeg", "-q:v", "4", "pipe:1"
+        )
+        if data:
+            break
+    if not data:
+        return None
+    if key:
+        thumb_cache.put(key, data)
+    return _as_file(data)
+
+async def complete_video_meta(path: str, media, thumb, meta: Dict[str, int]):
+    """Fill a missing thumbnail and zero duration/width/height for a downloaded video.
+
+    Streaming playback needs all three attributes; Telegram leaves them at 0
+    for many videos sent as documents. Returns (thumb, meta).
+    """
+    # In-memory downloads are skipped: MP4s with a trailing moov atom can't be probed from a pipe
+    if not (FFMPEG or FFPROBE) or not isinstance(path, str):
+        return thumb, meta
+    if not all(meta.get(k) for k in ("duration", "width", "height")):
+        probed = await probe(path)
+        meta = {k: meta.get(k) or probed.get(k, 0) for k in ("duration", "width", "height")}
+    if thumb is None:
+        thumb = await generate_thumb(path, getattr(media, "file_unique_id", None))
+    return thumb, meta
+
+def _collect_thumb_metrics():
+    THUMB_CACHE_BYTES.set(thumb_cache.size)
+
+REGISTRY.add_collector(_collect_thumb_metrics)
@@ -0,0 +1,214 @@
+import os
+import sys
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from collections import deque, Counter
+from contextlib import contextmanager
+from typing import Optional, Dict, List
+
+TRACE_BUFFER_SIZE = int(os.environ.get("TRACE_BUFFER_SIZE", 200))
+# Opt-in stack sampler; keeps profiles for the slowest TRACE_PROFILE_KEEP requests
+TRACE_PROFILER = os.environ.get("TRACE_PROFILER", "False").lower() == "true"
+TRACE_PROFILE_INTERVAL = float(os.environ.get("TRACE_PROFILE_INTERVAL", 0.01))
+TRACE_PROFILE_KEEP = int(os.environ.get("TRACE_PROFILE_KEEP", 5))
+
+_ids = itertools.count(1)
+_current: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+
+# Finished traces, newest last
+traces: deque = deque(maxlen=TRACE_BUFFER_SIZE)
+_active: Dict[int, "Trace"] = {}
+
+class Span:
+    __slots__ = ("name", "start", "end", "attrs")
+
+    def __init__(self, name: str, attrs: Dict):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = attrs
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+class Trace:
+    """Timeline of one download request, split into phase spans"""
+
+    def __init__(self, user_id, link: str):
+        self.id = next(_ids)
+        self.user_id = user_id
+        self.link = link
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.status = "incomplete"
+        self.attrs: Dict = {}
+        self.spans: List[Span] = []
+        self.samples: Optional[Counter] = Counter() if TRACE_PROFILER else None
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        """Time a phase; attributes can be added to the yielded span"""
+        span = Span(name, attrs)
+        self.spans.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.attrs["error"] = type(e).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def finish(self, status: Optional[str] = None):
+        if self.end is not None:
+            return
+        self.end = time.perf_counter()
+        if status:
+            self.status = status
+        _active.pop(self.id, None)
+        if _current.get() is self:
+            _current.set(None)
+        traces.append(self)
+        if self.samples is not None:
+            _profiler.keep_if_slow(self)
+
+def start_trace(user_id, link: str) -> Trace:
+    """Start a trace and make it current for the calling task"""
+    trace = Trace(user_id, link)
+    _active[trace.id] = trace
+    _current.set(trace)
+    if TRACE_PROFILER:
+        _profiler.ensure_running()
+    return trace
+
+def current_trace() -> Optional[Trace]:
+    return _current.get()
+
+@contextmanager
+def span(name: str, **attrs):
+    """Span on the current trace, or a no-op when nothing is being traced"""
+    trace = _current.get()
+    if trace is None:
+        yield Span(name, attrs)
+        return
+    with trace.span(name, **attrs) as s:
+        yield s
+
+def get_trace(trace_id: int) -> Optional[Trace]:
+    for trace in traces:
+        if trace.id == trace_id:
+            return trace
+    return _profiler.slowest.get(trace_id)
+
+def recent_traces(limit: int = 5, slowest: bool = False) -> List[Trace]:
+    items = list(traces)
+    if slowest:
+        return sorted(items, key=lambda t: t.duration, reverse=True)[:limit]
+    return items[-limit:][::-1]
+
+def _format_bytes(size) -> str:
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024.0:
+            return f"{size:.1f} {unit}"
+        size /= 1024.0
+    return f"{size:.1f} TB"
+
+def format_trace(trace: Trace) -> str:
+    lines = [
+        f"#{trace.id} user `{trace.user_id}` **{trace.status}** in `{trace.duration:.2f}s`",
+        f"🔗 {trace.link}",
+    ]
+    if trace.attrs:
+        lines.append("ℹ️ " + ", ".join(f"{k}={v}" for k, v in trace.attrs.items()))
+    for s in trace.spans:
+        details = []
+        for key, value in s.attrs.items():
+            if key == "bytes" and value:
+                details.append(f"{_format_bytes(value)}")
+                if s.duration > 0:
+                    details.append(f"{_format_bytes(value / s.duration)}/s")
+            elif key == "chunk_size" and value:
+                details.append(f"chunk={value // 1024}KB")
+            else:
+                details.append(f"{key}={value}")
+        extra = f" ({', '.join(details)})" if details else ""
+        lines.append(f"  • `{s.name}` {s.duration * 1000:.0f} ms{extra}")
+    return "\n".join(lines)
+
+def format_profile(trace: Trace, top: int = 15) -> str:
+    if not trace.samples:
+        return f"No stack samples for trace #{trace.id}."
+    total = sum(trace.samples.values())
+    lines = [f"🔬 Trace #{trace.id}: {total} samples @ {TRACE_PROFILE_INTERVAL * 1000:.0f} ms"]
+    for stack, hits in trace.samples.most_common(top):
+        lines.append(f"`{hits * 100 / total:5.1f}%` {stack}")
+    return "\n".join(lines)
+
+class _StackSampler:
+    """Samples the event loop thread while traces are active.
+
+    Each sample is charged to every trace in flight at that moment, which is
+    the best attribution a single-threaded loop allows.
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._target = None
+        self._heap: List = []
+        self.slowest: Dict[int, Trace] = {}
+
+    def ensure_running(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._target = threading.get_ident()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="TraceSampler")
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(TRACE_PROFILE_INTERVAL)
+            active = list(_active.values())
+            if not active:
+                continue
+            frame = sys._current_frames().get(self._target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None and len(stack) < 6:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            key = " < ".join(stack)
+            for trace in active:
+                samples = trace.samples
+                if samples is not None:
+                    samples[key] += 1
+
+    def keep_if_slow(self, trace: Trace):
+        """Keep stack samples only for the slowest TRACE_PROFILE_KEEP traces"""
+        entry = (trace.duration, trace.id)
+        if len(self._heap) < TRACE_PROFILE_KEEP:
+            heapq.heappush(self._heap, entry)
+            self.slowest[trace.id] = trace
+            return
+        if entry > self._heap[0]:
+            _, dropped = heapq.heapreplace(self._heap, entry)
+            evicted = self.slowest.pop(dropped, None)
+            if evicted is not None:
+                evicted.samples = None
+            self.slowest[trace.id] = trace
+        else:
+            trace.samples = None
+
+_profiler = _StackSampler()
@@ -1,31 +1,385 @@
+import io
 import os
+import time
+import asyncio
+import inspect
 import logging
-from pyrogram import Client
+import mimetypes
+import secrets
+import weakref
+from collections import deque
+from pyrogram import Client, StopTransmission, raw, utils, enums
+from pyrogram.errors import FloodWait
 from pyrogram.types import Message
 
-from bot.config import get_smart_download_workers
-
-async def download_media_fast(client: Client, message: Message, file_name, progress_callback=None, progress_args=()):
-    """Fast media downloader using parallel chunk requests"""
-    # Get file size to determine worker count
-    file_size = 0
-    if message.document:
-        file_size = message.document.file_size
-    elif message.video:
-        file_size = message.video.file_size
-    elif message.audio:
-        file_size = message.audio.file_size
-    elif message.photo:
-        file_size = message.photo.file_size
-
-    return await client.download_media(
-        message,
-        file_name=file_name or "downloads/",
-        progress=progress_callback if progress_callback else None,
-        progress_args=progress_args
+from pyrogram.file_id import FileId, FileType
+
+from bot.config import ALBUM_PARALLEL_UPLOADS, IN_MEMORY_MAX_MB
+from bot.autotune import autotuner
+from bot.budget import budget, in_memory as memory_budget
+from bot.disk import disk
+from bot.cancellation import Cancelled, NEVER
+from bot.metrics import TRANSFERS, TRANSFER_BYTES, TRANSFER_SECONDS, record_flood_wait
+from bot.tracing import span
+
+# upload.getFile serves at most 1 MB per request; limit must divide it and be 4 KB aligned
+MAX_PART_SIZE = 1024 * 1024
+FLOOD_RETRIES = 5
+# pyrogram save_file: 512 KB parts, "big" (parallel) mode above 10 MB
+SAVE_FILE_PART = 512 * 1024
+SAVE_FILE_BIG = 10 * 1024 * 1024
+IN_MEMORY_MAX_BYTES = int(IN_MEMORY_MAX_MB * 1024 * 1024)
+
+# In-memory downloads -> finalizer returning their reservation to memory_budget
+_memory_holds = weakref.WeakKeyDictionary()
+# On-disk downloads -> their disk space reservation
+_disk_holds = {}
+
+DEFAULT_EXTENSIONS = {
+    "photo": ".jpg",
+    "video": ".mp4",
+    "animation": ".mp4",
+    "video_note": ".mp4",
+    "audio": ".mp3",
+    "voice": ".ogg",
+}
+
+class _UseLibraryDownload(Exception):
+    """The parallel path can't serve this file; let pyrogram download it"""
+
+def _media_dc_id(media):
+    """DC the file lives on, decoded from its file_id"""
+    try:
+        return FileId.decode(media.file_id).dc_id
+    except Exception:
+        return None
+
+def _downloadable_media(message):
+    for kind in ("document", "video", "audio", "photo", "animation", "voice", "video_note"):
+        media = getattr(message, kind, None)
+        if media:
+            return kind, media
+    return None, None
+
+def _valid_chunk_size(chunk_size):
+    if not chunk_size or chunk_size % 4096 or MAX_PART_SIZE % chunk_size:
+        return MAX_PART_SIZE
+    return chunk_size
+
+def _file_location(file_id: FileId):
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    if file_id.file_type == FileType.CHAT_PHOTO:
+        raise _UseLibraryDownload("chat photos are not chunked")
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
     )
 
-async def upload_media_fast(client: Client, chat_id, file_path, caption="", thumb=None, progress_callback=None, progress_args=(), **kwargs):
+def _target_path(kind, media, file_name):
+    """Mirror download_media naming: a directory gets the media's own file name"""
+    if file_name and not file_name.endswith(("/", os.sep)):
+        return file_name
+    name = getattr(media, "file_name", None)
+    if not name:
+        mime_type = getattr(media, "mime_type", None)
+        extension = (mimetypes.guess_extension(mime_type) if mime_type else None) or DEFAULT_EXTENSIONS.get(kind, "")
+        name = f"{kind}_{media.file_unique_id}{extension}"
+    return os.path.join(file_name or disk.directory, os.path.basename(name))
+
+async def _media_session(client: Client, file_id: FileId):
+    """Return the client's media session for the file's DC.
+
+    If none exists yet, pyrogram's own get_file sets it up (including the
+    cross-DC auth export); the first megabyte it fetches is kept. get_file
+    logs and swallows its own errors, FloodWaits included, so a failed
+    setup only shows up as a missing session and the library path is used.
+    """
+    session = client.media_sessions.get(file_id.dc_id)
+    if session is not None:
+        return session, b""
+    first = b""
+    async for chunk in client.get_file(file_id, limit=1):
+        first += chunk
+    session = client.media_sessions.get(file_id.dc_id)
+    if session is None:
+        raise _UseLibraryDownload(f"no media session for DC {file_id.dc_id}")
+    return session, first
+
+async def _get_part(session, location, offset, limit, stats=None, token=NEVER):
+    for attempt in range(FLOOD_RETRIES):
+        try:
+            r = await session.invoke(
+                raw.functions.upload.GetFile(location=location, offset=offset, limit=limit)
+            )
+        except FloodWait as e:
+            record_flood_wait("upload.GetFile", e.value)
+            if stats is not None:
+                stats["flood_waits"] += 1
+            if attempt == FLOOD_RETRIES - 1:
+                raise
+            await token.sleep(e.value)
+            continue
+        if isinstance(r, raw.types.upload.FileCdnRedirect):
+            raise _UseLibraryDownload("file is served from a CDN DC")
+        return r.bytes
+
+async def _report(progress_callback, current, total, progress_args):
+    if not progress_callback:
+        return
+    result = progress_callback(current, total, *progress_args)
+    if inspect.isawaitable(result):
+        await result
+
+def combined_progress(progress_callback, total, progress_args=()):
+    """Fan one progress callback out over several concurrent transfers.
+
+    Returns part(index) -> callback; each part reports its own byte count and
+    the wrapped callback sees the running sum against `total`.
+    """
+    done = {}
+
+    def part(index):
+        async def report(current, _total, *args):
+            done[index] = current
+            if progress_callback:
+                await _report(progress_callback, min(sum(done.values()), total), total, progress_args)
+        return report
+    return part
+
+async def _fetch_parts(session, location, file_size, chunk_size, workers, write, done, progress_callback, progress_args, stats, ticket, token):
+    """Fetch [done, file_size) with `workers` concurrent getFile calls, handing each part to write(offset, data)"""
+    if done:
+        await _report(progress_callback, done, file_size, progress_args)
+    offsets = deque(range(done, file_size, chunk_size))
+
+    async def worker():
+        nonlocal done
+        while offsets:
+            token.check()
+            offset = offsets.popleft()
+            async with ticket.chunk(chunk_size):
+                data = await _get_part(session, location, offset, chunk_size, stats, token)
+                if not data:
+                    raise IOError(f"Empty part at offset {offset}")
+                write(offset, data)
+            done += len(data)
+            await _report(progress_callback, min(done, file_size), file_size, progress_args)
+
+    tasks = [asyncio.create_task(worker()) for _ in range(max(1, min(workers, len(offsets))))]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    if done < file_size:
+        raise IOError(f"Short download: {done}/{file_size} bytes")
+
+async def _download_parallel(client, media, path, file_size, chunk_size, workers, progress_callback, progress_args, stats, ticket, token, in_memory=False, reservation=None):
+    file_id = FileId.decode(media.file_id)
+    location = _file_location(file_id)
+    async with ticket.chunk(MAX_PART_SIZE):
+        session, first = await _media_session(client, file_id)
+    # Keep the warm-up megabyte only if the remaining parts stay aligned
+    if not (first and (len(first) >= file_size or len(first) % chunk_size == 0)):
+        first = b""
+    first = first[:file_size]
+    fetch = (session, location, file_size, chunk_size, workers)
+
+    if in_memory:
+        # Parts are kept as received and joined once; BytesIO shares the joined bytes instead of copying
+        parts = {0: first} if first else {}
+        await _fetch_parts(*fetch, parts.__setitem__, len(first), progress_callback, progress_args, stats, ticket, token)
+        file = io.BytesIO(b"".join(parts[offset] for offset in sorted(parts)))
+        file.name = os.path.basename(path)
+        return file
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temp_path = f"{path}.{secrets.token_hex(4)}.temp"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    def write(offset, data):
+        os.pwrite(fd, data, offset)
+        if reservation is not None:
+            reservation.written += len(data)
+
+    try:
+        if first:
+            write(0, first)
+        await _fetch_parts(*fetch, write, len(first), progress_callback, progress_args, stats, ticket, token)
+    except BaseException:
+        os.close(fd)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    os.close(fd)
+    os.replace(temp_path, path)
+    return path
+
+def _hold_in_memory(file, memory):
+    """Keep the in-memory reservation until discard(file), or until the buffer is garbage collected"""
+    ticket, grant = memory
+    _memory_holds[file] = weakref.finalize(file, ticket.budget.release, ticket, *grant)
+
+def discard(file):
+    """Drop a finished download: delete it from disk, or close the buffer and return its memory"""
+    if isinstance(file, io.IOBase):
+        hold = _memory_holds.pop(file, None)
+        file.close()
+        if hold:
+            hold()
+    elif file:
+        if os.path.exists(file):
+            os.remove(file)
+        reservation = _disk_holds.pop(file, None)
+        if reservation:
+            disk.release(reservation)
+
+async def _reserve_memory(file_size, in_memory, token):
+    """A memory-budget ticket and its grant for file_size bytes, or None to download to disk"""
+    if in_memory is False or not 0 < file_size <= IN_MEMORY_MAX_BYTES:
+        return None
+    ticket = memory_budget.ticket("download")
+    if in_memory:
+        grant = await token.race(memory_budget.acquire(ticket, 0, file_size))
+    else:
+        grant = memory_budget.try_acquire(ticket, 0, file_size)
+        if grant is None:
+            return None
+    return ticket, grant
+
+async def download_media_fast(client: Client, message: Message, file_name, progress_callback=None, progress_args=(), chunk_size=None, workers=None, in_memory=None, cancel_token=None):
+    """Fast media downloader using parallel chunk requests.
+
+    The file is split into chunk_size parts fetched by `workers` concurrent
+    upload.getFile calls on the client's media session. Both default to the
+    autotuner's current settings for the file's DC, and each finished
+    download is fed back to it. Media that can't be chunked (CDN-served
+    files, stories without a document, unknown sizes) goes through
+    download_media.
+
+    Files up to IN_MEMORY_MAX_MB come back as a named BytesIO instead of a
+    path while the in-memory budget has room (in_memory=None); True waits
+    for room, False always uses the disk. Disk downloads first reserve
+    file_size with the disk manager (DiskFull if none frees up). Either way,
+    hand the result to discard() when done with it.
+
+    cancel_token is checked between chunks and in progress callbacks; once
+    it fires the download stops, cleans up and raises Cancelled.
+    """
+    kind, media = _downloadable_media(message)
+    file_size = (media.file_size or 0) if media else 0
+    dc_id = _media_dc_id(media) if media else None
+    tuned = chunk_size is None and workers is None
+    suggested_chunk, suggested_workers = autotuner.suggest(dc_id, file_size)
+    chunk_size = _valid_chunk_size(chunk_size or suggested_chunk)
+    workers = workers or suggested_workers
+    stats = {"flood_waits": 0}
+    ticket = budget.ticket("download")
+    token = cancel_token or NEVER
+    memory = await _reserve_memory(file_size, in_memory, token)
+    target = _target_path(kind, media, file_name) if media else None
+    reservation = None
+    if memory is None:
+        with span("disk_reserve", bytes=file_size):
+            # Raises DiskFull when no room turns up in time
+            reservation = await token.race(disk.reserve(file_size, target))
+    path = None
+
+    start = time.perf_counter()
+    with autotuner.track(dc_id if tuned else None):
+        concurrent = autotuner.state(dc_id).active if tuned and dc_id is not None else 1
+        try:
+            with span(
+                "download",
+                bytes=file_size,
+                dc_id=dc_id,
+                chunk_size=chunk_size,
+                workers=workers
+            ) as download_span:
+                download_span.attrs["in_memory"] = memory is not None
+                if media and file_size:
+                    try:
+                        path = await _download_parallel(
+                            client, media, target, file_size,
+                            chunk_size, workers, progress_callback, progress_args, stats, ticket, token,
+                            in_memory=memory is not None, reservation=reservation
+                        )
+                    except _UseLibraryDownload as e:
+                        logging.debug(f"Parallel download skipped: {e}")
+                if path is None:
+                    download_span.attrs["mode"] = "library"
+                    tuned = False
+                    # Pyrogram streams 1 MB parts one at a time on this path
+                    async with ticket.hold(MAX_PART_SIZE, slots=1):
+                        path = await client.download_media(
+                            message,
+                            file_name=file_name or disk.directory,
+                            in_memory=memory is not None,
+                            progress=ticket.throttled(token.progress(client, progress_callback)),
+                            progress_args=progress_args
+                        )
+                    # stop_transmission makes download_media return None
+                    token.check()
+        except Cancelled:
+            TRANSFERS.inc(direction="download", result="cancelled")
+            raise
+        except Exception:
+            TRANSFERS.inc(direction="download", result="error")
+            if tuned:
+                autotuner.record(dc_id, file_size, time.perf_counter() - start, concurrent, stats["flood_waits"], errors=1)
+            raise
+        finally:
+            if memory is not None:
+                if path:
+                    _hold_in_memory(path, memory)
+                else:
+                    memory_ticket, grant = memory
+                    memory_budget.release(memory_ticket, *grant)
+            elif reservation is not None:
+                if path:
+                    # The library path picks its own file name, and doesn't report what it wrote
+                    reservation.path = os.path.normpath(path)
+                    reservation.written = reservation.nbytes
+                    _disk_holds[path] = reservation
+                else:
+                    disk.release(reservation)
+    elapsed = time.perf_counter() - start
+    if tuned and path:
+        autotuner.record(dc_id, file_size, elapsed, concurrent, stats["flood_waits"])
+    TRANSFER_SECONDS.observe(elapsed, direction="download")
+    TRANSFERS.inc(direction="download", result="ok" if path else "empty")
+    if path:
+        TRANSFER_BYTES.inc(file_size or 0, direction="download")
+    return path
+
+def _source_size(source):
+    """Size of a path or of an in-memory download"""
+    if isinstance(source, io.IOBase):
+        return source.seek(0, os.SEEK_END)
+    return os.path.getsize(source)
+
+def _source_name(source):
+    return getattr(source, "name", "") if isinstance(source, io.IOBase) else source
+
+def _upload_footprint(file_size):
+    """Slots and buffer pyrogram's save_file uses: 3 sessions x 4 workers plus a 16 part queue for big files"""
+    if file_size > SAVE_FILE_BIG:
+        return 12, (12 + 16) * SAVE_FILE_PART
+    return 1, 2 * SAVE_FILE_PART
+
+async def upload_media_fast(client: Client, chat_id, file_path, caption="", thumb=None, progress_callback=None, progress_args=(), cancel_token=None, **kwargs):
     """Refactored upload function focusing on hardware-accelerated transfers via TgCrypto."""
     safe_caption = str(caption) if caption is not None else ""
     
@@ -39,27 +393,154 @@ async def upload_media_fast(client: Client, chat_id, file_path, caption="", thum
     # Merge additional kwargs (like duration, width, height)
     upload_kwargs.update(kwargs)
 
+    # file_path may also be an in-memory download (a named BytesIO)
+    file_size = _source_size(file_path)
+    file_name = _source_name(file_path).lower()
+    ticket = budget.ticket("upload")
+    token = cancel_token or NEVER
+    upload_kwargs["progress"] = ticket.throttled(token.progress(client, progress_callback))
+    if file_name.endswith((".mp4", ".mkv", ".mov", ".avi")):
+        send, extra = client.send_video, {"supports_streaming": True}
+    elif file_name.endswith((".jpg", ".jpeg", ".png", ".webp")):
+        send, extra = client.send_photo, {}
+        # send_photo takes no thumbnail or video attributes
+        for key in ("thumb", "duration", "width", "height"):
+            upload_kwargs.pop(key, None)
+    else:
+        send, extra = client.send_document, {}
+        for key in ("duration", "width", "height"):
+            upload_kwargs.pop(key, None)
+
+    start = time.perf_counter()
     try:
-        if file_path.lower().endswith((".mp4", ".mkv", ".mov", ".avi")):
-            return await client.send_video(
-                chat_id,
-                file_path,
-                supports_streaming=True,
-                **upload_kwargs
-            )
-        
-        if file_path.lower().endswith((".jpg", ".jpeg", ".png", ".webp")):
-            return await client.send_photo(
-                chat_id,
-                file_path,
-                **upload_kwargs
+        slots, buffered = _upload_footprint(file_size)
+        async with ticket.hold(buffered, slots):
+            with span("upload", bytes=file_size, workers=slots):
+                sent = await send(chat_id, file_path, **extra, **upload_kwargs)
+        # stop_transmission makes send_* return None
+        token.check()
+    except Cancelled:
+        TRANSFERS.inc(direction="upload", result="cancelled")
+        raise
+    except Exception:
+        TRANSFERS.inc(direction="upload", result="error")
+        logging.exception("Upload Error:")
+        raise
+    TRANSFER_SECONDS.observe(time.perf_counter() - start, direction="upload")
+    TRANSFERS.inc(direction="upload", result="ok")
+    TRANSFER_BYTES.inc(file_size, direction="upload")
+    return sent
+
+ALBUM_KINDS = ("photo", "video", "audio", "document")
+
+async def _upload_album_item(client: Client, peer, item, ticket, progress):
+    """Upload one album member and return the InputMedia that references it"""
+    path = item["path"]
+    kind = item["kind"]
+    name = os.path.basename(_source_name(path))
+    slots, buffered = _upload_footprint(_source_size(path))
+    async with ticket.hold(buffered, slots):
+        file = await client.save_file(path, progress=ticket.throttled(progress))
+        if file is None:
+            raise IOError(f"Upload of {name} failed")
+        if kind == "photo":
+            media = raw.types.InputMediaUploadedPhoto(file=file)
+        else:
+            thumb = await client.save_file(item["thumb"]) if item.get("thumb") else None
+            file_name = raw.types.DocumentAttributeFilename(file_name=item.get("file_name") or name)
+            if kind == "video":
+                attributes = [
+                    raw.types.DocumentAttributeVideo(
+                        supports_streaming=True,
+                        duration=item.get("duration") or 0,
+                        w=item.get("width") or 0,
+                        h=item.get("height") or 0
+                    ),
+                    file_name
+                ]
+            elif kind == "audio":
+                attributes = [raw.types.DocumentAttributeAudio(duration=item.get("duration") or 0), file_name]
+            else:
+                attributes = [file_name]
+            media = raw.types.InputMediaUploadedDocument(
+                file=file,
+                thumb=thumb,
+                mime_type=item.get("mime_type") or client.guess_mime_type(name) or "application/octet-stream",
+                attributes=attributes,
+                force_file=True if kind == "document" else None
             )
-            
-        return await client.send_document(
-            chat_id,
-            file_path,
-            **upload_kwargs
+        r = await client.invoke(raw.functions.messages.UploadMedia(peer=peer, media=media))
+
+    if kind == "photo":
+        return raw.types.InputMediaPhoto(
+            id=raw.types.InputPhoto(id=r.photo.id, access_hash=r.photo.access_hash, file_reference=r.photo.file_reference)
         )
+    return raw.types.InputMediaDocument(
+        id=raw.types.InputDocument(id=r.document.id, access_hash=r.document.access_hash, file_reference=r.document.file_reference)
+    )
+
+async def send_album(client: Client, chat_id, items, progress_callback=None, progress_args=(), cancel_token=None):
+    """Upload album members in parallel and deliver them with a single SendMultiMedia.
+
+    send_media_group uploads its members one after another; here every
+    member goes through save_file + messages.UploadMedia concurrently
+    (bounded by ALBUM_PARALLEL_UPLOADS and the transfer budget), then the
+    album is sent in one request. Each item is a dict with path, kind
+    (photo/video/audio/document), caption, caption_entities and optional
+    thumb, duration, width, height, file_name and mime_type; path may be
+    an in-memory download.
+    """
+    peer = await client.resolve_peer(chat_id)
+    total = sum(_source_size(item["path"]) for item in items)
+    part = combined_progress(progress_callback, total, progress_args)
+    ticket = budget.ticket("upload")
+    token = cancel_token or NEVER
+    limit = asyncio.Semaphore(max(1, ALBUM_PARALLEL_UPLOADS))
+
+    async def upload(index, item):
+        async with limit:
+            token.check()
+            try:
+                return await _upload_album_item(client, peer, item, ticket, token.progress(client, part(index)))
+            except StopTransmission:
+                raise Cancelled("Album upload was cancelled")
+
+    start = time.perf_counter()
+    try:
+        with span("upload", bytes=total, items=len(items), workers=ALBUM_PARALLEL_UPLOADS):
+            tasks = [asyncio.create_task(upload(i, item)) for i, item in enumerate(items)]
+            try:
+                uploaded = await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            token.check()
+            multi_media = []
+            for media, item in zip(uploaded, items):
+                multi_media.append(
+                    raw.types.InputSingleMedia(
+                        media=media,
+                        random_id=client.rnd_id(),
+                        **await utils.parse_text_entities(
+                            client, item.get("caption") or "", enums.ParseMode.DISABLED, item.get("caption_entities")
+                        )
+                    )
+                )
+            r = await client.invoke(
+                raw.functions.messages.SendMultiMedia(peer=peer, multi_media=multi_media),
+                sleep_threshold=60
+            )
+            sent = await utils.parse_messages(client=client, messages=None, r=r)
+    except Cancelled:
+        TRANSFERS.inc(direction="upload", result="cancelled")
+        raise
     except Exception:
-        logging.exception("Upload Error:")
+        TRANSFERS.inc(direction="upload", result="error")
+        logging.exception("Album Upload Error:")
         raise
+    TRANSFER_SECONDS.observe(time.perf_counter() - start, direction="upload")
+    TRANSFERS.inc(direction="upload", result="ok")
+    TRANSFER_BYTES.inc(total, direction="upload")
+    return sent
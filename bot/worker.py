@@ -0,0 +1,217 @@
+"""Transfer worker process, started by bot.workers as `python -m bot.worker <index> <count>`.
+
+Reads one JSON request per line on stdin (transfer, cancel, ping) and writes
+progress, done, error and pong events as JSON lines on its original stdout.
+Pings carry the bot's memory governor level, which the worker applies to its
+own budgets, caches and user clients.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+
+# Progress events are forwarded at most this often; the bot throttles its edits further
+PROGRESS_INTERVAL = 1.0
+USER_CLIENT_IDLE = 600
+
+logger = logging.getLogger("bot.worker")
+
+class Worker:
+    def __init__(self, index, bot, protocol_fd):
+        self.index = index
+        self.bot = bot
+        self.protocol_fd = protocol_fd
+        self.tokens = {}
+        self.clients = {}
+        self._client_locks = {}
+
+    async def emit(self, event):
+        # Events are far below PIPE_BUF, so each write is atomic and the bot reads them promptly
+        os.write(self.protocol_fd, json.dumps(event).encode() + b"\n")
+
+    def reporter(self, job_id):
+        last = 0.0
+
+        async def report(current, total, phase):
+            nonlocal last
+            now = time.monotonic()
+            if total and current != total and now - last < PROGRESS_INTERVAL:
+                return
+            last = now
+            await self.emit({"id": job_id, "event": "progress", "current": current, "total": total, "phase": phase})
+        return report
+
+    async def user_client(self, user_id):
+        from pyrogram import Client
+        from bot.config import API_ID, API_HASH
+        from bot.database import get_session_string
+        from bot.rpc import install as install_gateway
+
+        async with self._client_locks.setdefault(user_id, asyncio.Lock()):
+            entry = self.clients.get(user_id)
+            if entry is None:
+                session_string = await get_session_string(user_id)
+                if not session_string:
+                    raise LookupError("No stored session for this user. Please /login again.")
+                client = Client(
+                    f"user_{user_id}",
+                    session_string=session_string,
+                    api_id=API_ID,
+                    api_hash=API_HASH,
+                    in_memory=True,
+                    no_updates=True
+                )
+                install_gateway(client)
+                await client.start()
+                entry = self.clients[user_id] = {"client": client, "last_used": time.time(), "jobs": 0}
+            entry["last_used"] = time.time()
+            return entry
+
+    async def transfer(self, request):
+        from bot.cancellation import CancelToken
+        from bot.relay import relay_media
+
+        job_id, user_id = request["id"], request["user_id"]
+        token = self.tokens[job_id] = CancelToken(user_id)
+        entry = None
+        try:
+            entry = await self.user_client(user_id)
+            entry["jobs"] += 1
+            client = entry["client"]
+            peer = request.get("peer")
+            if peer:
+                # A fresh client has no peer cache; the bot process already resolved the chat
+                await client.storage.update_peers([(peer["id"], peer["access_hash"], peer["type"], [], None)])
+            msg = await token.race(client.get_messages(request["chat_id"], request["message_id"]))
+            sent = await relay_media(self.bot, client, user_id, msg, self.reporter(job_id), token)
+            await self.emit({"id": job_id, "event": "done", "message_id": sent.id if sent else None})
+        except Exception as e:
+            await self.emit({"id": job_id, "event": "error", "error": type(e).__name__, "message": str(e)})
+        finally:
+            token.finish()
+            self.tokens.pop(job_id, None)
+            if entry is not None:
+                entry["jobs"] -= 1
+                entry["last_used"] = time.time()
+
+    async def evict_clients(self, max_idle):
+        now = time.time()
+        for user_id, entry in list(self.clients.items()):
+            if entry["jobs"] == 0 and now - entry["last_used"] > max_idle:
+                self.clients.pop(user_id)
+                try:
+                    await entry["client"].stop()
+                except Exception:
+                    pass
+
+    async def reap_clients(self):
+        while True:
+            await asyncio.sleep(60)
+            await self.evict_clients(USER_CLIENT_IDLE)
+
+    async def serve(self, reader):
+        while True:
+            line = await reader.readline()
+            if not line:
+                # The bot process is gone
+                break
+            request = json.loads(line)
+            op = request.get("op")
+            if op == "transfer":
+                asyncio.create_task(self.transfer(request))
+            elif op == "cancel":
+                token = self.tokens.get(request["id"])
+                if token:
+                    token.cancel()
+            elif op == "ping":
+                from bot.disk import disk
+                from bot.memory import memory_governor, POLICIES
+                # Shrink budgets and caches along with the bot process
+                memory_governor.follow(request.get("memory", 0))
+                idle = POLICIES[memory_governor.level].idle
+                if idle is not None:
+                    await self.evict_clients(idle)
+                # The bot's /stats adds these to its own disk figures
+                await self.emit({"event": "pong", "disk": disk.snapshot()})
+
+def bot_client(index, count):
+    from pyrogram import Client
+    from bot.config import API_ID, API_HASH, BOT_TOKEN
+
+    # A file session, so a restarted worker reuses its authorization instead of importing the
+    # bot token again; named after the bot's id, so a token for another bot gets a fresh one
+    return Client(
+        f"worker_{BOT_TOKEN.split(':')[0]}_{index}",
+        api_id=API_ID,
+        api_hash=API_HASH,
+        bot_token=BOT_TOKEN,
+        no_updates=True,
+        max_concurrent_transmissions=max(1, 12 // count)
+    )
+
+async def start_bot(index, count):
+    from pyrogram.errors import Unauthorized
+    from bot.rpc import install as install_gateway
+
+    bot = bot_client(index, count)
+    install_gateway(bot)
+    try:
+        await bot.start()
+    except Unauthorized:
+        # The token was revoked since the session was saved; drop it and sign in again
+        logger.warning(f"Stored session of transfer worker {index} is no longer authorized, signing in again")
+        await bot.storage.delete()
+        bot = bot_client(index, count)
+        install_gateway(bot)
+        await bot.start()
+    return bot
+
+async def main(index, count, protocol_fd):
+    from bot.autotune import autotuner
+    from bot.disk import disk, worker_directory
+
+    loop = asyncio.get_event_loop()
+    reader = asyncio.StreamReader(limit=1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    # The bot's janitor skips subdirectories, so this worker sweeps its own (at startup: a dead predecessor's files)
+    disk.directory = worker_directory(index)
+    janitor = asyncio.create_task(disk.janitor())
+    # Start from what the bot has learned; only the bot process saves tuner state
+    await autotuner.load()
+    bot = await start_bot(index, count)
+    worker = Worker(index, bot, protocol_fd)
+    reaper = asyncio.create_task(worker.reap_clients())
+    logger.info(f"Transfer worker {index} ready")
+    try:
+        await worker.serve(reader)
+    finally:
+        reaper.cancel()
+        janitor.cancel()
+        for token in list(worker.tokens.values()):
+            token.cancel()
+        for entry in worker.clients.values():
+            try:
+                await entry["client"].stop()
+            except Exception:
+                pass
+        await bot.stop()
+
+if __name__ == "__main__":
+    index, count = int(sys.argv[1]), int(sys.argv[2])
+    # stdout carries the protocol; prints from config or libraries go to stderr instead
+    protocol_fd = os.dup(1)
+    os.dup2(2, 1)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+    # Pyrogram builds the bot's Client at import time and needs a loop for it
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    from dotenv import load_dotenv
+    load_dotenv()
+    logging.getLogger("pyrogram").setLevel(logging.WARNING)
+    asyncio.get_event_loop().run_until_complete(main(index, count, protocol_fd))
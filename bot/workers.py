@@ -0,0 +1,287 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import itertools
+import logging
+from typing import Dict, List, Optional
+from pyrogram import raw, utils
+from bot.config import (
+    TRANSFER_WORKERS, WORKER_PING_INTERVAL, WORKER_PING_TIMEOUT, WORKER_CANCEL_TIMEOUT,
+    TRANSFER_SLOTS, TRANSFER_BUFFER_MB, DOWNLOAD_RATE_LIMIT_MB, UPLOAD_RATE_LIMIT_MB,
+    IN_MEMORY_BUFFER_MB, DISK_QUOTA_GB, RPC_SEND_RATE, RPC_EDIT_RATE
+)
+from bot.cancellation import Cancelled, NEVER
+from bot.disk import DiskFull
+from bot.memory import memory_governor
+from bot.metrics import REGISTRY
+from bot.relay import relay_media, Reporter
+from bot.tracing import span
+
+logger = logging.getLogger(__name__)
+
+WORKERS_ALIVE = REGISTRY.gauge("bot_transfer_workers_alive", "Transfer worker processes currently running")
+WORKER_RESTARTS = REGISTRY.counter("bot_transfer_worker_restarts_total", "Transfer worker restarts by reason", ("reason",))
+WORKER_JOBS = REGISTRY.counter("bot_transfer_worker_jobs_total", "Transfers handed to worker processes by result", ("result",))
+WORKER_JOBS_IN_FLIGHT = REGISTRY.gauge("bot_transfer_worker_jobs_in_flight", "Transfers currently running in worker processes")
+
+# Longest line a worker may send; progress events and results are tiny
+_LINE_LIMIT = 1024 * 1024
+
+class WorkerUnavailable(Exception):
+    """The user's shard has no running worker; the transfer runs in the bot process instead"""
+
+class WorkerError(Exception):
+    """A transfer failed inside a worker, or the worker died while running it"""
+
+def _worker_env(count: int) -> Dict[str, str]:
+    """Split the process-wide budgets evenly, so N workers together stay within one bot's limits"""
+    env = dict(os.environ)
+    env.update({
+        "TRANSFER_SLOTS": str(max(1, TRANSFER_SLOTS // count)),
+        "TRANSFER_BUFFER_MB": str(TRANSFER_BUFFER_MB / count),
+        "DOWNLOAD_RATE_LIMIT_MB": str(DOWNLOAD_RATE_LIMIT_MB / count),
+        "UPLOAD_RATE_LIMIT_MB": str(UPLOAD_RATE_LIMIT_MB / count),
+        "IN_MEMORY_BUFFER_MB": str(IN_MEMORY_BUFFER_MB / count),
+        "DISK_QUOTA_GB": str(DISK_QUOTA_GB / count),
+        # Every process sends as the same bot, so they share its message rate
+        "RPC_SEND_RATE": str(RPC_SEND_RATE / count),
+        "RPC_EDIT_RATE": str(RPC_EDIT_RATE / count),
+    })
+    return env
+
+def _peer_info(input_peer) -> Optional[Dict]:
+    """What a worker's fresh client needs in its peer cache to reach the chat"""
+    if isinstance(input_peer, raw.types.InputPeerChannel):
+        return {"id": utils.get_channel_id(input_peer.channel_id), "access_hash": input_peer.access_hash, "type": "channel"}
+    if isinstance(input_peer, raw.types.InputPeerChat):
+        return {"id": -input_peer.chat_id, "access_hash": 0, "type": "group"}
+    if isinstance(input_peer, raw.types.InputPeerUser):
+        return {"id": input_peer.user_id, "access_hash": input_peer.access_hash, "type": "user"}
+    return None
+
+class _Job:
+    __slots__ = ("report", "done")
+
+    def __init__(self, report: Reporter):
+        self.report = report
+        self.done: asyncio.Future = asyncio.get_event_loop().create_future()
+
+class TransferWorker:
+    """One worker process (`python -m bot.worker <index> <count>`) and its JSON-lines pipe"""
+
+    def __init__(self, index: int, count: int):
+        self.index = index
+        self.count = count
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.last_seen = 0.0
+        # The worker's disk.snapshot() from its last pong
+        self.disk: Dict = {}
+        self._jobs: Dict[int, _Job] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, "-m", "bot.worker", str(self.index), str(self.count),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            env=_worker_env(self.count), limit=_LINE_LIMIT
+        )
+        self.last_seen = time.monotonic()
+        self._reader = asyncio.create_task(self._read(self.process))
+        logger.info(f"Transfer worker {self.index} started (pid {self.process.pid})")
+
+    async def stop(self):
+        if self.alive:
+            self.process.kill()
+            await self.process.wait()
+
+    async def send(self, message: Dict):
+        self.process.stdin.write(json.dumps(message).encode() + b"\n")
+        await self.process.stdin.drain()
+
+    async def _read(self, process):
+        try:
+            while True:
+                line = await process.stdout.readline()
+                if not line:
+                    break
+                self.last_seen = time.monotonic()
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logger.warning(f"Transfer worker {self.index} sent a bad line: {line[:200]!r}")
+                    continue
+                await self._dispatch(event)
+        finally:
+            await process.wait()
+            # Whatever was running there is lost; its requesters get an error they can retry
+            for job in self._jobs.values():
+                if not job.done.done():
+                    job.done.set_exception(WorkerError("The transfer worker stopped unexpectedly"))
+            self._jobs.clear()
+
+    async def _dispatch(self, event: Dict):
+        if event.get("event") == "pong":
+            self.disk = event.get("disk") or {}
+            return
+        job = self._jobs.get(event.get("id"))
+        if job is None:
+            return
+        kind = event["event"]
+        if kind == "progress":
+            try:
+                await job.report(event["current"], event["total"], event["phase"])
+            except Exception as e:
+                logger.debug(f"Progress report failed: {e}")
+        elif kind == "done":
+            job.done.set_result(event.get("message_id"))
+        elif kind == "error":
+            job.done.set_exception(_rebuild_error(event))
+
+    async def run(self, job_id: int, request: Dict, report: Reporter, token) -> Optional[int]:
+        """Send one transfer and wait for its sent message id, streaming progress to report"""
+        if not self.alive:
+            raise WorkerUnavailable(f"Transfer worker {self.index} is not running")
+        job = _Job(report)
+        self._jobs[job_id] = job
+        try:
+            try:
+                await self.send(dict(request, op="transfer", id=job_id))
+            except ConnectionError as e:
+                raise WorkerUnavailable(f"Transfer worker {self.index} pipe is closed: {e}")
+            try:
+                return await token.race(asyncio.shield(job.done))
+            except Cancelled:
+                # Hold the abort until the worker has let go of its files and slots
+                try:
+                    await self.send({"op": "cancel", "id": job_id})
+                    await asyncio.wait_for(asyncio.shield(job.done), WORKER_CANCEL_TIMEOUT)
+                except Exception:
+                    pass
+                raise
+        finally:
+            self._jobs.pop(job_id, None)
+            if not job.done.done():
+                job.done.cancel()
+
+    def __len__(self):
+        return len(self._jobs)
+
+def _rebuild_error(event: Dict) -> Exception:
+    error, message = event.get("error"), event.get("message", "")
+    if error == "DiskFull":
+        return DiskFull(message)
+    if error == "Cancelled":
+        return Cancelled(message)
+    return WorkerError(message or error)
+
+class WorkerPool:
+    """Transfer worker processes sharded by user id.
+
+    The bot process keeps dispatch, quotas, the queue and the status
+    messages; the single-file download/re-upload runs in worker
+    `user_id % count`, which has its own event loop, user clients and bot
+    connection, so AES and chunk bookkeeping for different users use
+    different cores. The bot process still fetches the message with its
+    own client on the user's session, but stops that client once the
+    user's requests are done rather than caching it next to the worker's.
+    Workers are pinged every WORKER_PING_INTERVAL seconds and restarted
+    with backoff if they exit or stop answering.
+    """
+
+    def __init__(self, count: int):
+        if count and not DISK_QUOTA_GB:
+            # Each process checks free space without seeing the others' reservations; only
+            # split quotas keep them from overcommitting the volume together
+            logger.error("TRANSFER_WORKERS needs DISK_QUOTA_GB set; transfers run in the bot process instead")
+            count = 0
+        self.count = count
+        self.workers: List[TransferWorker] = [TransferWorker(index, count) for index in range(count)]
+        self._ids = itertools.count(1)
+
+    @property
+    def enabled(self) -> bool:
+        return self.count > 0
+
+    def for_user(self, user_id: int) -> TransferWorker:
+        return self.workers[user_id % self.count]
+
+    async def supervise(self):
+        if not self.enabled:
+            return
+        backoff = {worker.index: 1.0 for worker in self.workers}
+        for worker in self.workers:
+            await worker.start()
+        while True:
+            await asyncio.sleep(WORKER_PING_INTERVAL)
+            for worker in self.workers:
+                reason = None
+                if not worker.alive:
+                    reason = "exited"
+                elif time.monotonic() - worker.last_seen > WORKER_PING_TIMEOUT:
+                    reason = "unresponsive"
+                    await worker.stop()
+                if reason is None:
+                    backoff[worker.index] = 1.0
+                    try:
+                        await worker.send({"op": "ping", "memory": memory_governor.level})
+                    except (ConnectionError, RuntimeError):
+                        pass
+                    continue
+                # Back off so a worker that dies at startup doesn't spin
+                WORKER_RESTARTS.inc(reason=reason)
+                logger.warning(f"Transfer worker {worker.index} {reason}, restarting in {backoff[worker.index]:.0f}s")
+                await asyncio.sleep(backoff[worker.index])
+                backoff[worker.index] = min(backoff[worker.index] * 2, 60)
+                try:
+                    await worker.start()
+                except Exception as e:
+                    logger.error(f"Transfer worker {worker.index} failed to start: {e}")
+
+    async def stop(self):
+        for worker in self.workers:
+            await worker.stop()
+
+    async def relay(self, bot_client, user_client, user_id, msg, report: Reporter, token=None):
+        """relay_media in the user's worker when there is one, otherwise in this process"""
+        token = token or NEVER
+        # Public links downloaded through the bot itself need no user session, so they stay here
+        if self.enabled and msg.chat is not None and user_client is not bot_client:
+            worker = self.for_user(user_id)
+            request = {
+                "user_id": user_id,
+                "chat_id": msg.chat.id,
+                "message_id": msg.id,
+                "peer": _peer_info(await user_client.resolve_peer(msg.chat.id)),
+            }
+            try:
+                with span("worker", index=worker.index):
+                    message_id = await worker.run(next(self._ids), request, report, token)
+            except WorkerUnavailable:
+                WORKER_JOBS.inc(result="fallback")
+            except Cancelled:
+                WORKER_JOBS.inc(result="cancelled")
+                raise
+            except Exception:
+                WORKER_JOBS.inc(result="error")
+                raise
+            else:
+                WORKER_JOBS.inc(result="ok" if message_id else "failed")
+                if not message_id:
+                    return None
+                # The requester needs a real Message to share the result with coalesced followers
+                return await bot_client.get_messages(user_id, message_id)
+        return await relay_media(bot_client, user_client, user_id, msg, report, token)
+
+transfer_workers = WorkerPool(TRANSFER_WORKERS)
+
+def _collect_worker_metrics():
+    WORKERS_ALIVE.set(sum(worker.alive for worker in transfer_workers.workers))
+    WORKER_JOBS_IN_FLIGHT.set(sum(len(worker) for worker in transfer_workers.workers))
+
+REGISTRY.add_collector(_collect_worker_metrics)
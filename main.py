@@ -21,19 +21,30 @@ except RuntimeError:
 
 load_dotenv()
 
-from bot.config import app
+from bot.config import app, AD_DELIVERY_WORKERS, MEMORY_LIMIT_MB
 from bot.database import init_db
 from bot.cloud_backup import restore_latest_from_cloud, periodic_cloud_backup
-from bot.login import cleanup_expired_logins
 from bot.logger import cleanup_loop
+from bot.ads import richads_manager
+from bot.health import start_health_check, stop_health_server
+from bot.autotune import autotuner
+from bot.disk import disk
+from bot.premium import premium_expiry
+from bot.workers import transfer_workers
+from bot.jobs import transfer_jobs
+from bot.archive import archiver
+from bot.rpc import install as install_gateway, bot_gateway
+from bot.memory import memory_governor
 import bot.transfer # Ensure transfer is available
 
 # Optimization for 1.5GB RAM VPS
 try:
-    # Set soft memory limit to 1.3GB to leave room for system
-    resource.setrlimit(resource.RLIMIT_AS, (1300 * 1024 * 1024, -1))
+    # Set soft memory limit (1.3GB by default) to leave room for system; the memory governor works against it
+    if MEMORY_LIMIT_MB:
+        resource.setrlimit(resource.RLIMIT_AS, (int(MEMORY_LIMIT_MB * 1024 * 1024), -1))
 except Exception:
     pass
+memory_governor.tune_gc()
 
 logging.getLogger("pyrogram").setLevel(logging.WARNING)
 
@@ -65,9 +76,14 @@ if __name__ == "__main__":
         start_health_check()
         
     loop = asyncio.get_event_loop()
-    loop.create_task(cleanup_expired_logins())
     loop.create_task(cleanup_loop())
     loop.create_task(periodic_cloud_backup(interval_minutes=10))
+    loop.create_task(disk.janitor())
+    loop.create_task(memory_governor.run())
+    loop.create_task(transfer_workers.supervise())
+    loop.create_task(richads_manager.impression_worker())
+    for _ in range(AD_DELIVERY_WORKERS):
+        loop.create_task(richads_manager.delivery_worker())
     
     print("Starting bot...")
     if app:
@@ -82,11 +98,29 @@ if __name__ == "__main__":
 
         async def main_bot():
             asyncio.create_task(check_dc_later())
+            richads_manager.prefetch("en")
+            await autotuner.load()
+            install_gateway(app, bot_gateway)
             await app.start()
+            # Expiry notices go out through the bot, so the sweeper starts once it is connected
+            sweeper = asyncio.create_task(premium_expiry.run(app))
+            # Jobs left unfinished by the last run are resumed from here, editing their status messages
+            jobs = asyncio.create_task(transfer_jobs.run(app))
+            archiving = asyncio.create_task(archiver.run(app))
+            # Everything allocated up to here lives until exit; keep it out of later collections
+            memory_governor.freeze()
             # This is to keep the event loop running while pyrogram's idle() handles signals
             from pyrogram.methods.utilities.idle import idle
             await idle()
+            sweeper.cancel()
+            archiving.cancel()
+            jobs.cancel()
+            await transfer_jobs.stop()
             await app.stop()
+            await transfer_workers.stop()
+            await autotuner.save()
+            await richads_manager.close()
+            await stop_health_server()
 
         try:
             loop.run_until_complete(main_bot())
@@ -0,0 +1,32 @@
+import time
+import asyncio
+from bot.auth import TimerWheel
+
+def test_timer_wheel_catches_up_on_ticks_a_blocked_loop_missed():
+    async def run():
+        wheel = TimerWheel(slots=4, resolution=0.01)
+        fired = []
+        for key, delay in (("a", 0.01), ("b", 0.02), ("c", 0.05), ("late", 1)):
+            wheel.schedule(key, delay, fired.append)
+        # Block the loop for more ticks than the wheel has slots
+        time.sleep(0.08)
+        await asyncio.sleep(0.03)
+        assert fired == ["a", "b", "c"]
+        assert len(wheel) == 1
+        wheel.cancel("late")
+        assert len(wheel) == 0
+    asyncio.run(run())
+
+def test_timer_wheel_replaces_and_cancels():
+    async def run():
+        wheel = TimerWheel(slots=8, resolution=0.02)
+        fired = []
+        wheel.schedule("a", 0.02, fired.append)
+        wheel.schedule("a", 0.1, fired.append)
+        wheel.schedule("b", 0.02, fired.append)
+        wheel.cancel("b")
+        await asyncio.sleep(0.05)
+        assert fired == []
+        await asyncio.sleep(0.1)
+        assert fired == ["a"]
+    asyncio.run(run())
@@ -0,0 +1,41 @@
+import asyncio
+from bot.budget import TransferBudget, MB
+
+def test_release_after_shrink_returns_the_whole_grant():
+    async def run():
+        pool = TransferBudget(32, 96 * MB)
+        ticket = pool.ticket("upload")
+        grant = await pool.acquire(ticket, 12, 14 * MB)
+        pool.scale(0.25)
+        pool.release(ticket, *grant)
+        pool.scale(1.0)
+        assert (pool.slots_used, pool.buffer_used, ticket.in_flight) == (0, 0, 0)
+        assert pool.try_acquire(ticket, 32, 96 * MB) is not None
+    asyncio.run(run())
+
+def test_release_after_grow_returns_only_the_clamped_grant():
+    async def run():
+        pool = TransferBudget(32, 96 * MB)
+        ticket = pool.ticket("upload")
+        pool.scale(0.25)
+        async with ticket.hold(14 * MB, slots=12):
+            assert pool.slots_used == 8
+            pool.scale(1.0)
+        assert (pool.slots_used, pool.buffer_used, ticket.in_flight) == (0, 0, 0)
+    asyncio.run(run())
+
+def test_shrink_reclamps_waiters():
+    async def run():
+        pool = TransferBudget(32, 96 * MB)
+        first, second = pool.ticket("download"), pool.ticket("upload")
+        held = await pool.acquire(first, 4, MB)
+        waiting = asyncio.ensure_future(pool.acquire(second, 32, MB))
+        await asyncio.sleep(0)
+        pool.scale(0.25)
+        pool.release(first, *held)
+        grant = await asyncio.wait_for(waiting, 1)
+        assert grant.slots == 8
+        pool.scale(1.0)
+        pool.release(second, *grant)
+        assert (pool.slots_used, pool.buffer_used) == (0, 0)
+    asyncio.run(run())
@@ -0,0 +1,88 @@
+import base64
+import asyncio
+import sqlite3
+from bot import database, session_crypto
+from bot.database import FREE_DAILY_LIMIT
+
+DAY = 86400
+
+def _use_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, "DATABASE_PATH", str(tmp_path / "bot.db"))
+    monkeypatch.setattr(session_crypto, "SESSION_SECRET", "test-secret")
+    return database.DATABASE_PATH
+
+def _migrated(tmp_path, monkeypatch):
+    _use_db(tmp_path, monkeypatch)
+    conn = database._get_connection()
+    database._migrate(conn)
+    conn.close()
+
+def test_migrations_upgrade_a_legacy_database(tmp_path, monkeypatch):
+    path = _use_db(tmp_path, monkeypatch)
+    session_string = base64.urlsafe_b64encode(bytes(range(200))).decode().rstrip("=")
+    conn = sqlite3.connect(path)
+    database._migration_1_initial(conn.cursor())
+    conn.execute(
+        "INSERT INTO users (telegram_id, role, downloads_today, last_download_date, phone_session_string, created_at, updated_at) "
+        "VALUES ('42', 'premium', 3, '2024-05-01', ?, '2024-04-01 10:00:00', '2024-05-01 12:00:00')",
+        (session_string,)
+    )
+    # Rows keyed by something other than a numeric id are dropped
+    conn.execute("INSERT INTO users (telegram_id) VALUES ('not-a-user')")
+    conn.commit()
+    conn.close()
+
+    conn = database._get_connection()
+    assert database._migrate(conn) == database.MIGRATIONS[-1][0]
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == database.MIGRATIONS[-1][0]
+    jobs = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+    assert {"quota_held", "quota_date"} <= jobs
+    conn.close()
+
+    async def run():
+        user = await database.get_user(42)
+        assert (user["role"], user["downloads_today"], user["has_session"]) == ("premium", 3, True)
+        assert user["last_download_date"] == 1714521600
+        assert await database.get_session_string(42) == session_string
+        assert await database.get_user("not-a-user") is None
+    asyncio.run(run())
+
+def test_reserve_quota_stops_at_the_limit_and_resets_daily(tmp_path, monkeypatch):
+    _migrated(tmp_path, monkeypatch)
+    clock = [100 * DAY + 3600]
+    monkeypatch.setattr(database, "_now", lambda: clock[0])
+
+    async def run():
+        await database.create_user(7)
+        assert await database.reserve_quota(7, FREE_DAILY_LIMIT + 2) == (FREE_DAILY_LIMIT, False)
+        assert await database.reserve_quota(7, 1) == (0, False)
+        await database.refund_quota(7, 1)
+        assert await database.reserve_quota(7, 3) == (1, False)
+
+        # Yesterday's slots can't be refunded into today's counter
+        clock[0] += DAY
+        await database.refund_quota(7, 2)
+        assert await database.reserve_quota(7, 1) == (1, False)
+        await database.refund_quota(7, 5)
+        assert (await database.get_user(7))["downloads_today"] == 0
+    asyncio.run(run())
+
+def test_claim_jobs_takes_over_lapsed_leases_only(tmp_path, monkeypatch):
+    _migrated(tmp_path, monkeypatch)
+    clock = [1_000_000]
+    monkeypatch.setattr(database, "_now", lambda: clock[0])
+
+    async def run():
+        first = await database.enqueue_job(7, "https://t.me/a/1", 7, 1)
+        second = await database.enqueue_job(7, "https://t.me/a/2", 7, 2)
+        assert [job["id"] for job in await database.claim_jobs("dead", 1, 30)] == [first]
+        assert await database.claim_jobs("alive", 0, 30) == []
+
+        # Still leased: only the pending job is handed out
+        assert [job["id"] for job in await database.claim_jobs("alive", 5, 30)] == [second]
+        clock[0] += 31
+        assert await database.renew_job_leases("alive", 30) == 1
+        taken = await database.claim_jobs("alive", 5, 30)
+        assert [(job["id"], job["attempts"]) for job in taken] == [(first, 2)]
+        assert await database.claim_jobs("other", 5, 30) == []
+    asyncio.run(run())
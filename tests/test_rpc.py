@@ -0,0 +1,60 @@
+import asyncio
+import pytest
+from pyrogram import raw
+from pyrogram.errors import FloodWait
+from bot.rpc import TokenBucket, RpcGateway, Overloaded
+
+class _Send:
+    QUALNAME = "functions.messages.SendMessage"
+
+    def __init__(self, user_id):
+        self.peer = raw.types.InputPeerUser(user_id=user_id, access_hash=0)
+
+def _gateway(send_rate=100.0):
+    return RpcGateway({"send": send_rate, "edit": 100.0, "read": 100.0}, 1.0, 1.0, max_wait=0.5, flood_retries=1)
+
+def test_token_bucket_bursts_then_paces():
+    bucket = TokenBucket(2, burst=3)
+    for _ in range(3):
+        assert bucket.delay(0) == 0
+        bucket.take(0)
+    assert bucket.delay(0) == pytest.approx(0.5)
+    bucket.block(0, 10)
+    assert bucket.delay(0) == pytest.approx(10)
+    assert not bucket.idle(10) and bucket.idle(11)
+
+def test_gateway_sheds_calls_that_would_wait_past_their_patience():
+    async def run():
+        gateway = _gateway(send_rate=1)
+        calls = []
+
+        async def invoke(query, retries, timeout, sleep_threshold):
+            calls.append(sleep_threshold)
+            return "sent"
+
+        assert await gateway.call(invoke, _Send(1), 0, 10, None) == "sent"
+        with pytest.raises(Overloaded):
+            await gateway.call(invoke, _Send(2), 0, 10, None)
+        # The gateway handles every FloodWait itself
+        assert calls == [0]
+    asyncio.run(run())
+
+def test_flood_wait_blocks_only_the_chat_it_hit():
+    async def run():
+        gateway = _gateway()
+
+        async def flooded(query, retries, timeout, sleep_threshold):
+            raise FloodWait(value=30)
+
+        async def invoke(query, retries, timeout, sleep_threshold):
+            return "sent"
+
+        # Longer than the call's patience, so it is raised instead of retried
+        with pytest.raises(FloodWait) as raised:
+            await gateway.call(flooded, _Send(1), 0, 10, None)
+        assert not isinstance(raised.value, Overloaded)
+        with pytest.raises(Overloaded) as shed:
+            await gateway.call(invoke, _Send(1), 0, 10, None)
+        assert shed.value.value >= 30
+        assert await gateway.call(invoke, _Send(2), 0, 10, None) == "sent"
+    asyncio.run(run())
@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from bot.singleflight import SingleFlight
+
+def test_followers_share_the_leaders_result():
+    async def run():
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+        calls = []
+
+        async def work():
+            calls.append(1)
+            await release.wait()
+            return "file"
+
+        leader = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("key", work))
+        await asyncio.sleep(0)
+        assert flight.running("key")
+        release.set()
+        assert await leader == ("file", False)
+        assert await follower == ("file", True)
+        assert (calls, len(flight)) == ([1], 0)
+    asyncio.run(run())
+
+def test_followers_get_none_when_the_leader_fails():
+    async def run():
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def fail():
+            await release.wait()
+            raise RuntimeError("boom")
+
+        leader = asyncio.ensure_future(flight.do("key", fail))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do("key", fail))
+        await asyncio.sleep(0)
+        release.set()
+        with pytest.raises(RuntimeError):
+            await leader
+        assert await follower == (None, True)
+        # The failed run is forgotten, so the next caller leads a fresh attempt
+        assert not flight.running("key")
+
+        async def succeed():
+            return "retried"
+        assert await flight.do("key", succeed) == ("retried", False)
+    asyncio.run(run())